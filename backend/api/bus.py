@@ -0,0 +1,100 @@
+"""
+Event bus from scheduler threads to the ASGI event loop.
+
+The loop is captured once at startup (start() in the app lifespan); any
+thread may then post(). Events sit in a bounded queue and a single task on
+the loop hands them to the registered handler, so a burst costs one
+wake-up, not one callback per event. post_latest() keeps only the newest
+event per channel and delivers it at most once per `interval`, for status
+updates where intermediate values don't matter.
+"""
+import asyncio, logging, threading, time
+from collections import deque
+import metrics
+
+log = logging.getLogger(__name__)
+
+MAX_QUEUE = 1000
+
+
+class EventBus:
+    def __init__(self, handler, maxsize: int = MAX_QUEUE):
+        self._handler = handler              # handler(channel, event), called on the loop
+        self._queue: deque[tuple] = deque()
+        self._maxsize = maxsize
+        self._latest: dict[str, tuple] = {}  # channel -> (event, interval)
+        self._sent_at: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._signalled = False
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._wake: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._signalled = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._loop = None
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def _signal(self):
+        """Wake the drain task; only the first post since the last drain crosses threads."""
+        loop = self._loop
+        if loop is None or self._signalled:
+            return
+        self._signalled = True
+        try:
+            loop.call_soon_threadsafe(self._wake.set)
+        except RuntimeError:                 # loop closed during shutdown
+            pass
+
+    def post(self, channel: str, event):
+        """Queue an event (any thread). The oldest is dropped when the queue is full."""
+        if self._loop is None:
+            return
+        with self._lock:
+            if len(self._queue) >= self._maxsize:
+                self._queue.popleft()
+                metrics.WS_DROPPED.inc(reason="bus_full")
+            self._queue.append((channel, event))
+            self._latest.pop(channel, None)  # a newer ordered event supersedes a pending status
+            self._signal()
+
+    def post_latest(self, channel: str, event, interval: float = 0.0):
+        """Replace the channel's pending event; delivered at most once per `interval` seconds."""
+        if self._loop is None:
+            return
+        with self._lock:
+            self._latest[channel] = (event, interval)
+            self._signal()
+
+    async def _run(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            now = time.monotonic()
+            with self._lock:
+                self._signalled = False
+                items = list(self._queue)
+                self._queue.clear()
+                due, retry = [], None
+                for ch, (event, interval) in list(self._latest.items()):
+                    wait = self._sent_at.get(ch, 0) + interval - now
+                    if wait <= 0:
+                        due.append((ch, event))
+                        del self._latest[ch]
+                        self._sent_at[ch] = now
+                    else:
+                        retry = wait if retry is None else min(retry, wait)
+            for ch, event in items + due:
+                try:
+                    self._handler(ch, event)
+                except Exception:
+                    log.exception("Event handler failed for channel %s", ch)
+            if retry is not None:
+                self._loop.call_later(retry, self._wake.set)
@@ -0,0 +1,36 @@
+"""
+Shape-preserving downsampling of chart series with Largest-Triangle-Three-
+Buckets: peaks and troughs survive, flat stretches collapse.
+"""
+import numpy as np
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n: int) -> np.ndarray:
+    """
+    Indices of the `n` points of (x, y) LTTB keeps (first and last always
+    included). Below 3 points there is no middle bucket: n=2 keeps the ends,
+    n=1 the last point.
+    """
+    size = len(x)
+    if size <= n:
+        return np.arange(size)
+    if n < 3:
+        return np.array([0, size - 1][2 - n:] if n > 0 else [], dtype=np.int64)
+    x = np.asarray(x, dtype=float)
+    y = np.nan_to_num(np.asarray(y, dtype=float))
+    every = (size - 2) / (n - 2)
+    out = np.empty(n, dtype=np.int64)
+    out[0], out[-1] = 0, size - 1
+    a = 0
+    for i in range(n - 2):
+        lo, hi = int(i * every) + 1, int((i + 1) * every) + 1
+        # Average of the next bucket (the last point for the final bucket)
+        nlo, nhi = hi, min(int((i + 2) * every) + 1, size)
+        if i == n - 3:
+            avg_x, avg_y = x[-1], y[-1]
+        else:
+            avg_x, avg_y = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        out[i + 1] = a
+    return out
@@ -0,0 +1,60 @@
+"""
+Latest heat ranking held in memory. The scan pipeline publishes a new
+immutable snapshot after each heat pass and again after anomaly detection
+(z-scores); readers grab the current snapshot reference once and page
+through its presorted indexes.
+"""
+import logging
+import numpy as np
+import scans
+import partitions
+
+log = logging.getLogger(__name__)
+
+SORT_COLUMNS = ("total_heat", "trade_heat", "sentiment_heat", "zscore", "change_pct", "volume_ratio", "amount", "turnover_rate")
+
+
+class RankingSnapshot:
+    __slots__ = ("scan_id", "ts", "items", "order")
+
+    def __init__(self, scan_id: int, ts: str, items: list[dict]):
+        self.scan_id = scan_id
+        self.ts = ts
+        self.items = tuple(items)
+        self.order = {}
+        for col in SORT_COLUMNS:
+            vals = np.array([np.nan if it[col] is None else it[col] for it in items], dtype=float)
+            # Descending with NULLs last, like SQLite's ORDER BY ... DESC
+            self.order[col] = np.argsort(-vals, kind="stable")
+
+    def page(self, sort: str, page: int, size: int) -> list[dict]:
+        start = max(page - 1, 0) * size
+        items = self.items
+        return [items[i] for i in self.order[sort][start:start + size]]
+
+
+_current: RankingSnapshot | None = None
+
+
+def current() -> RankingSnapshot | None:
+    return _current
+
+
+def publish(conn, scan_id: int | None = None) -> RankingSnapshot | None:
+    """Build the snapshot for `scan_id` (default: latest heat scan) and swap it in."""
+    global _current
+    scan_id = scan_id or scans.latest(conn, "heat")
+    if not scan_id:
+        return None
+    rows = conn.execute(
+        "SELECT h.code, h.name, h.trade_heat, h.sentiment_heat, h.total_heat, h.zscore, h.ts, "
+        "t.change_pct, t.volume_ratio, t.turnover_rate, t.amount "
+        f"FROM {partitions.for_scan(conn, 'heat_scores', scan_id)} h "
+        f"LEFT JOIN {partitions.for_scan(conn, 'trade_snapshots', scan_id)} t ON t.scan_id=h.scan_id AND t.code=h.code "
+        "WHERE h.scan_id=?",
+        (scan_id,),
+    ).fetchall()
+    snap = RankingSnapshot(scan_id, scans.get(conn, scan_id)["heat_at"], [dict(r) for r in rows])
+    _current = snap
+    log.info("Published ranking snapshot for scan %d (%d stocks)", scan_id, len(snap.items))
+    return snap
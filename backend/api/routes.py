@@ -1,12 +1,22 @@
 import logging
-from fastapi import APIRouter, HTTPException, Depends, Request
+import numpy as np
+from fastapi import APIRouter, HTTPException, Depends, Query, Request
+from fastapi.responses import PlainTextResponse
 from config import get as get_config, update as update_config
-from db import get_conn
+import db
+from engine import rollup
+from api import ranking_cache, downsample
+import scans
+import stock_search
+import metrics
 
 log = logging.getLogger(__name__)
 router = APIRouter(prefix="/api")
 _tokens: set[str] = set()
 
+MAX_POINTS = 2000       # per trend series, whatever the range
+MAX_TREND_CODES = 100   # per batch trend request
+
 
 def _check_auth(request: Request):
     token = request.headers.get("Authorization", "").replace("Bearer ", "")
@@ -14,6 +24,16 @@ def _check_auth(request: Request):
         raise HTTPException(401, "Unauthorized")
 
 
+def _check_metrics_auth(request: Request):
+    """A logged-in token, or auth.metrics_token for scrapers that can't log in."""
+    import secrets
+    scrape_token = get_config()["auth"].get("metrics_token", "")
+    token = request.headers.get("Authorization", "").replace("Bearer ", "")
+    if scrape_token and secrets.compare_digest(token, scrape_token):
+        return
+    _check_auth(request)
+
+
 @router.post("/auth")
 async def auth(body: dict):
     pwd = body.get("password", "")
@@ -30,20 +50,27 @@ async def auth(body: dict):
 @router.get("/status")
 async def system_status(_=Depends(_check_auth)):
     from main import scheduler, get_running_jobs
-    with get_conn() as conn:
-        stock_count = conn.execute("SELECT COUNT(*) as c FROM stock_basic").fetchone()["c"]
-        latest_heat_ts = conn.execute("SELECT MAX(ts) as ts FROM heat_scores").fetchone()["ts"]
-        latest_trade_ts = conn.execute("SELECT MAX(ts) as ts FROM trade_snapshots").fetchone()["ts"]
-        today_anomalies = conn.execute(
-            "SELECT COUNT(*) as c FROM alerts WHERE ts >= date('now','localtime')"
-        ).fetchone()["c"]
-        today_scans = conn.execute(
-            "SELECT COUNT(*) as c FROM job_logs WHERE job_name='collect_trade' AND status='ok' AND ts >= date('now','localtime')"
-        ).fetchone()["c"]
-        # Recent errors
-        recent_errors = conn.execute(
-            "SELECT job_name, message, ts FROM job_logs WHERE status='error' ORDER BY ts DESC LIMIT 5"
-        ).fetchall()
+
+    def _query(conn):
+        heat_scan = scans.latest(conn, "heat")
+        trade_scan = scans.latest(conn, "trade")
+        return {
+            "stock_count": conn.execute("SELECT COUNT(*) as c FROM stock_basic").fetchone()["c"],
+            "latest_heat_ts": scans.get(conn, heat_scan)["heat_at"] if heat_scan else None,
+            "latest_trade_ts": scans.get(conn, trade_scan)["trade_at"] if trade_scan else None,
+            "today_anomalies": conn.execute(
+                "SELECT COUNT(*) as c FROM alerts WHERE ts >= date('now','localtime')"
+            ).fetchone()["c"],
+            "today_scans": conn.execute(
+                "SELECT COUNT(*) as c FROM job_logs WHERE job_name='collect_trade' AND status='ok' AND ts >= date('now','localtime')"
+            ).fetchone()["c"],
+            # Recent errors
+            "recent_errors": [dict(r) for r in conn.execute(
+                "SELECT job_name, message, ts FROM job_logs WHERE status='error' ORDER BY ts DESC LIMIT 5"
+            ).fetchall()],
+        }
+
+    stats = await db.read(_query)
 
     jobs = scheduler.get_jobs()
     next_scan = None
@@ -52,53 +79,85 @@ async def system_status(_=Depends(_check_auth)):
             next_scan = str(j.next_run_time)
 
     return {
-        "stock_count": stock_count,
-        "latest_heat_ts": latest_heat_ts,
-        "latest_trade_ts": latest_trade_ts,
-        "today_anomalies": today_anomalies,
-        "today_scans": today_scans,
+        **stats,
         "next_scan": next_scan,
         "running_jobs": get_running_jobs(),
-        "recent_errors": [dict(r) for r in recent_errors],
     }
 
 
+@router.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics(_=Depends(_check_metrics_auth)):
+    """Prometheus scrape target; set auth.metrics_token and use it as the scrape job's bearer token."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 # ── Heat data ────────────────────────────────────────────────
 
 @router.get("/heat/ranking")
 async def heat_ranking(page: int = 1, size: int = 50, sort: str = "total_heat", _=Depends(_check_auth)):
-    offset = (page - 1) * size
-    allowed_sorts = {"total_heat", "trade_heat", "sentiment_heat", "zscore", "change_pct", "volume_ratio", "amount", "turnover_rate"}
-    if sort not in allowed_sorts:
+    if sort not in ranking_cache.SORT_COLUMNS:
         sort = "total_heat"
-    # For columns from trade_snapshots, prefix with t.
-    sort_col = f"t.{sort}" if sort in ("change_pct", "volume_ratio", "amount", "turnover_rate") else f"h.{sort}"
-    with get_conn() as conn:
-        latest = conn.execute("SELECT MAX(ts) as ts FROM heat_scores").fetchone()
-        if not latest or not latest["ts"]:
+    snap = ranking_cache.current()
+    if snap is None:
+        snap = await db.read(ranking_cache.publish)
+        if snap is None:
             return {"items": [], "total": 0}
-        ts = latest["ts"]
+    return {"items": snap.page(sort, page, size), "total": len(snap.items), "ts": snap.ts, "scan_id": snap.scan_id}
+
+
+def _downsample(rows: list[dict], points: int) -> list[dict]:
+    """LTTB on total_heat down to `points` (capped at MAX_POINTS); other fields follow the kept rows."""
+    limit = min(points, MAX_POINTS) if points > 0 else MAX_POINTS
+    if len(rows) <= limit:
+        return rows
+    x = np.array([r["ts"] for r in rows], dtype="datetime64[s]").astype(np.int64)
+    y = np.array([np.nan if r["total_heat"] is None else r["total_heat"] for r in rows], dtype=float)
+    return [rows[i] for i in downsample.lttb(x, y, limit)]
+
+
+def _trends(conn, codes: list[str], hours: int) -> dict[str, list[dict]]:
+    """
+    Trend rows of every code in one query, from the rollup matching `hours`
+    or, for the last few hours, raw heat. Archiving keeps the rollups, so
+    they serve ranges reaching into archived days; raw windows never do.
+    """
+    table = rollup.table_for_hours(hours)
+    marks = ",".join("?" * len(codes))
+    if table:
         rows = conn.execute(
-            f"SELECT h.code, h.name, h.trade_heat, h.sentiment_heat, h.total_heat, h.zscore, h.ts, "
-            f"t.change_pct, t.volume_ratio, t.turnover_rate, t.amount "
-            f"FROM heat_scores h LEFT JOIN trade_snapshots t ON h.code=t.code "
-            f"AND t.ts=(SELECT MAX(ts) FROM trade_snapshots) "
-            f"WHERE h.ts=? ORDER BY {sort_col} DESC LIMIT ? OFFSET ?",
-            (ts, size, offset),
+            f"SELECT code, total_heat, trade_heat, sentiment_heat, zscore, bucket AS ts FROM {table} "
+            f"WHERE code IN ({marks}) AND bucket >= datetime('now','localtime',? || ' hours') ORDER BY code, bucket",
+            (*codes, f"-{hours}"),
         ).fetchall()
-        total = conn.execute("SELECT COUNT(*) as c FROM heat_scores WHERE ts=?", (ts,)).fetchone()["c"]
-    return {"items": [dict(r) for r in rows], "total": total, "ts": ts}
+    else:
+        rows = conn.execute(
+            "SELECT code, total_heat, trade_heat, sentiment_heat, zscore, ts FROM heat_scores "
+            f"WHERE code IN ({marks}) AND ts >= datetime('now','localtime',? || ' hours') ORDER BY code, ts",
+            (*codes, f"-{hours}"),
+        ).fetchall()
+    out: dict[str, list[dict]] = {c: [] for c in codes}
+    for r in rows:
+        d = dict(r)
+        out[d.pop("code")].append(d)
+    return out
 
 
 @router.get("/heat/trend/{code}")
-async def heat_trend(code: str, hours: int = 24, _=Depends(_check_auth)):
-    with get_conn() as conn:
-        rows = conn.execute(
-            "SELECT total_heat, trade_heat, sentiment_heat, zscore, ts FROM heat_scores "
-            "WHERE code=? AND ts >= datetime('now','localtime',? || ' hours') ORDER BY ts",
-            (code, f"-{hours}"),
-        ).fetchall()
-    return [dict(r) for r in rows]
+async def heat_trend(code: str, hours: int = 24, points: int = Query(0, ge=0), _=Depends(_check_auth)):
+    rows = (await db.read(_trends, [code], hours))[code]
+    return _downsample(rows, points)
+
+
+@router.get("/heat/trends")
+async def heat_trends(codes: str, hours: int = 24, points: int = Query(0, ge=0), _=Depends(_check_auth)):
+    """Trends of several comma-separated codes in one request."""
+    wanted = list(dict.fromkeys(c.strip() for c in codes.split(",") if c.strip()))
+    if not wanted:
+        return {"items": {}}
+    if len(wanted) > MAX_TREND_CODES:
+        raise HTTPException(400, f"At most {MAX_TREND_CODES} codes per request")
+    trends = await db.read(_trends, wanted, hours)
+    return {"items": {c: _downsample(rows, points) for c, rows in trends.items()}}
 
 
 # ── Alerts ───────────────────────────────────────────────────
@@ -106,7 +165,8 @@ async def heat_trend(code: str, hours: int = 24, _=Depends(_check_auth)):
 @router.get("/alerts")
 async def alerts(page: int = 1, size: int = 50, code: str = "", _=Depends(_check_auth)):
     offset = (page - 1) * size
-    with get_conn() as conn:
+
+    def _query(conn):
         if code:
             rows = conn.execute(
                 "SELECT * FROM alerts WHERE code=? ORDER BY ts DESC LIMIT ? OFFSET ?", (code, size, offset)
@@ -115,23 +175,30 @@ async def alerts(page: int = 1, size: int = 50, code: str = "", _=Depends(_check
         else:
             rows = conn.execute("SELECT * FROM alerts ORDER BY ts DESC LIMIT ? OFFSET ?", (size, offset)).fetchall()
             total = conn.execute("SELECT COUNT(*) as c FROM alerts").fetchone()["c"]
-    return {"items": [dict(r) for r in rows], "total": total}
+        return {"items": [dict(r) for r in rows], "total": total}
+
+    return await db.read(_query)
 
 
 @router.get("/alerts/{alert_id}")
 async def alert_detail(alert_id: int, _=Depends(_check_auth)):
-    with get_conn() as conn:
+    def _query(conn):
         alert = conn.execute("SELECT * FROM alerts WHERE id=?", (alert_id,)).fetchone()
         if not alert:
-            raise HTTPException(404, "Alert not found")
+            return None
         alert = dict(alert)
         # Get heat trend around alert time
         trend = conn.execute(
-            "SELECT total_heat, trade_heat, sentiment_heat, zscore, ts FROM heat_scores "
-            "WHERE code=? AND ts BETWEEN datetime(?, '-2 hours') AND datetime(?, '+1 hours') ORDER BY ts",
+            "SELECT total_heat, trade_heat, sentiment_heat, zscore, bucket AS ts FROM heat_rollup_5m "
+            "WHERE code=? AND bucket BETWEEN datetime(?, '-2 hours') AND datetime(?, '+1 hours') ORDER BY bucket",
             (alert["code"], alert["ts"], alert["ts"]),
         ).fetchall()
-    alert["trend"] = [dict(r) for r in trend]
+        alert["trend"] = [dict(r) for r in trend]
+        return alert
+
+    alert = await db.read(_query)
+    if alert is None:
+        raise HTTPException(404, "Alert not found")
     return alert
 
 
@@ -139,16 +206,9 @@ async def alert_detail(alert_id: int, _=Depends(_check_auth)):
 
 @router.get("/stocks")
 async def stock_list(keyword: str = "", _=Depends(_check_auth)):
-    with get_conn() as conn:
-        if keyword:
-            rows = conn.execute(
-                "SELECT code, name, market FROM stock_basic WHERE code LIKE ? OR name LIKE ? LIMIT 50",
-                (f"%{keyword}%", f"%{keyword}%"),
-            ).fetchall()
-        else:
-            rows = conn.execute("SELECT code, name, market FROM stock_basic LIMIT 50").fetchall()
-        total = conn.execute("SELECT COUNT(*) as c FROM stock_basic").fetchone()["c"]
-    return {"items": [dict(r) for r in rows], "total": total}
+    """Type-ahead search by code prefix, name or pinyin initials (see stock_search.py)."""
+    index = stock_search.current()
+    return {"items": index.search(keyword), "total": len(index.items)}
 
 
 # ── Jobs ─────────────────────────────────────────────────────
@@ -163,18 +223,24 @@ async def job_list(_=Depends(_check_auth)):
             "next_run": str(job.next_run_time) if job.next_run_time else None,
             "trigger": str(job.trigger),
         })
-    with get_conn() as conn:
-        logs = conn.execute(
-            "SELECT job_name, status, message, duration_sec, ts FROM job_logs "
-            "WHERE id IN (SELECT MAX(id) FROM job_logs GROUP BY job_name) ORDER BY ts DESC"
-        ).fetchall()
-    return {"jobs": jobs, "logs": [dict(r) for r in logs], "running": get_running_jobs()}
+    # Latest log per job: hop from name to name along idx_job_logs_name_ts instead of grouping every row
+    logs = await db.read(lambda conn: [dict(r) for r in conn.execute(
+        "WITH RECURSIVE names(job_name) AS ("
+        "SELECT MIN(job_name) FROM job_logs "
+        "UNION ALL SELECT (SELECT MIN(job_name) FROM job_logs WHERE job_name > names.job_name) "
+        "FROM names WHERE job_name IS NOT NULL) "
+        "SELECT job_name, status, message, duration_sec, ts FROM job_logs WHERE id IN ("
+        "SELECT (SELECT id FROM job_logs j WHERE j.job_name = names.job_name ORDER BY ts DESC, id DESC LIMIT 1) "
+        "FROM names WHERE job_name IS NOT NULL) ORDER BY ts DESC"
+    ).fetchall()])
+    return {"jobs": jobs, "logs": logs, "running": get_running_jobs()}
 
 
 @router.get("/jobs/logs")
 async def job_logs(job_name: str = "", page: int = 1, size: int = 50, _=Depends(_check_auth)):
     offset = (page - 1) * size
-    with get_conn() as conn:
+
+    def _query(conn):
         if job_name:
             rows = conn.execute(
                 "SELECT * FROM job_logs WHERE job_name=? ORDER BY ts DESC LIMIT ? OFFSET ?", (job_name, size, offset)
@@ -183,18 +249,20 @@ async def job_logs(job_name: str = "", page: int = 1, size: int = 50, _=Depends(
         else:
             rows = conn.execute("SELECT * FROM job_logs ORDER BY ts DESC LIMIT ? OFFSET ?", (size, offset)).fetchall()
             total = conn.execute("SELECT COUNT(*) as c FROM job_logs").fetchone()["c"]
-    return {"items": [dict(r) for r in rows], "total": total}
+        return {"items": [dict(r) for r in rows], "total": total}
+
+    return await db.read(_query)
 
 
 @router.post("/jobs/{job_id}/trigger")
 async def trigger_job(job_id: str, _=Depends(_check_auth)):
-    from main import job_sync_basic, job_collect_trade, job_collect_sentiment, job_calc_heat, job_detect_anomaly, run_scan, _running_jobs
+    from main import job_sync_basic, job_collect_trade, job_collect_sentiment, job_calc_heat, job_detect_anomaly, job_archive, run_scan, _running_jobs
     if job_id in _running_jobs:
         raise HTTPException(409, f"Job {job_id} is already running")
     job_map = {
         "sync_basic": job_sync_basic, "full_scan": run_scan,
         "collect_trade": job_collect_trade, "collect_sentiment": job_collect_sentiment,
-        "calc_heat": job_calc_heat, "detect_anomaly": job_detect_anomaly,
+        "calc_heat": job_calc_heat, "detect_anomaly": job_detect_anomaly, "archive": job_archive,
     }
     fn = job_map.get(job_id)
     if not fn:
@@ -1,45 +1,271 @@
+"""
+WebSocket feed with per-client subscriptions and row-level deltas.
+
+Client -> server
+    {"op": "subscribe", "channels": ["ranking", "anomalies", "jobs"], "codes": ["600519"], "since": {"ranking": 41}}
+    {"op": "unsubscribe", "channels": ["jobs"], "codes": ["600519"]}
+    {"op": "ack", "channel": "ranking", "seq": 42}
+
+Server -> client
+    {"type": "snapshot", "channel": "ranking", "seq": 42, "rows": [...]}
+    {"type": "delta", "channel": "ranking", "seq": 43, "base": 42, "upsert": [...], "remove": ["600001"]}
+    {"type": "job_status" | "job_done", "channel": "jobs", ...}
+
+ranking / anomalies / codes are state channels: rows keyed by code, each
+carrying its "rank" in the published list. "codes" is the watchlist
+channel: every scored stock, filtered to the client's codes.
+
+Deltas are computed at send time against the last state written to the
+client, so updates piling up behind a slow client collapse into one
+message. Once a client acks, it has at most one unacknowledged message per
+channel, i.e. every delta is relative to its last acknowledged seq. A
+(re)subscribe with `since` resumes with a delta while that state is still
+kept, otherwise a snapshot is sent.
+"""
 import asyncio
 import json
 import logging
+import threading
+import time
+from collections import OrderedDict, deque
 from fastapi import WebSocket, WebSocketDisconnect
+import metrics
+from api.bus import EventBus
 
 log = logging.getLogger(__name__)
 
-_clients: list[WebSocket] = []
+# State channel -> number of past states kept to compute deltas from
+STATE_CHANNELS = {"ranking": 32, "anomalies": 32, "codes": 4}
+EVENT_CHANNELS = ("jobs",)
+_EVENT_QUEUE = 100       # per-client job events kept while the socket is busy
+_SEND_TIMEOUT = 10       # seconds before a stuck client is dropped
+JOB_STATUS_INTERVAL = 0.5   # job_status bursts collapse into one message per interval
+
+
+def _dumps(msg: dict) -> str:
+    return json.dumps(msg, ensure_ascii=False, default=str)
+
+
+def _seq(value) -> int | None:
+    """A client-sent sequence number, or None unless it is a non-negative integer."""
+    if isinstance(value, bool):
+        return None
+    try:
+        seq = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return seq if seq >= 0 else None
+
+
+def _list(value) -> list:
+    return value if isinstance(value, list) else []
+
+
+class _State:
+    def __init__(self, channel: str, keep: int):
+        self.channel = channel
+        self.seq = 0
+        self.rows: dict[str, dict] = {}
+        self._history: OrderedDict[int, dict] = OrderedDict()
+        self._encoded: dict[int, str | None] = {}     # base -> serialized message to the current seq
+        self._keep = keep
+        self._lock = threading.Lock()
+
+    def publish(self, rows: list[dict]):
+        cur = {r["code"]: {**r, "rank": i} for i, r in enumerate(rows, 1)}
+        with self._lock:
+            # Time-based so a client resuming after a server restart can't match a stale seq
+            self.seq = max(self.seq + 1, int(time.time() * 1000))
+            self.rows = cur
+            self._history[self.seq] = cur
+            self._encoded = {}
+            while len(self._history) > self._keep:
+                self._history.popitem(last=False)
+
+    def message(self, base: int, codes: set[str] | None = None) -> dict | None:
+        """Snapshot or delta taking a client from state `base` to the current one; None if up to date."""
+        with self._lock:
+            seq, cur, old = self.seq, self.rows, self._history.get(base)
+        if seq == base or not seq:
+            return None
+        if old is None:
+            rows = list(cur.values()) if codes is None else [cur[c] for c in codes if c in cur]
+            return {"type": "snapshot", "channel": self.channel, "seq": seq, "rows": rows}
+        keys = cur.keys() | old.keys() if codes is None else codes
+        return {
+            "type": "delta", "channel": self.channel, "seq": seq, "base": base,
+            "upsert": [cur[k] for k in keys if k in cur and old.get(k) != cur[k]],
+            "remove": [k for k in keys if k in old and k not in cur],
+        }
+
+    def encoded(self, base: int) -> tuple[int, str] | None:
+        """(seq, JSON) of message(base), serialized once and shared by every client at `base`."""
+        with self._lock:
+            seq, cache = self.seq, self._encoded
+        if base not in cache:
+            msg = self.message(base)
+            if msg is not None and msg["seq"] != seq:
+                return msg["seq"], _dumps(msg)   # published meanwhile; don't cache under the old seq
+            cache[base] = None if msg is None else _dumps(msg)
+        text = cache[base]
+        return None if text is None else (seq, text)
+
+
+_states = {ch: _State(ch, keep) for ch, keep in STATE_CHANNELS.items()}
+
+
+class _Client:
+    def __init__(self, ws: WebSocket):
+        self.ws = ws
+        self.channels: set[str] = set()
+        self.codes: set[str] = set()
+        self.sent: dict[str, int] = {}      # state channel -> seq last written to the socket
+        self.acked: dict[str, int] = {}     # only tracked once the client starts acking
+        self.dirty: set[str] = set()        # state channels with updates not yet sent
+        self.events: deque[str] = deque()
+        self.acking = False
+        self.wake = asyncio.Event()
+
+    def subscribed(self, channel: str) -> bool:
+        return bool(self.codes) if channel == "codes" else channel in self.channels
+
+    def notify(self, channel: str):
+        if self.subscribed(channel):
+            self.dirty.add(channel)
+            self.wake.set()
+
+    def push_event(self, msg: str):
+        if len(self.events) >= _EVENT_QUEUE:
+            self.events.popleft()
+            metrics.WS_DROPPED.inc(reason="event_queue_full")
+        self.events.append(msg)
+        self.wake.set()
+
+    def handle(self, msg: dict):
+        """Apply one client message; malformed fields are ignored like malformed JSON."""
+        op = msg.get("op")
+        channels = {
+            c for c in _list(msg.get("channels"))
+            if isinstance(c, str) and (c in STATE_CHANNELS or c in EVENT_CHANNELS)
+        }
+        codes = {str(c) for c in _list(msg.get("codes"))}
+        if op == "subscribe":
+            self.channels |= channels - {"codes"}
+            since = msg.get("since")
+            since = since if isinstance(since, dict) else {}
+            for ch in channels & STATE_CHANNELS.keys():
+                self.sent[ch] = self.acked[ch] = _seq(since.get(ch)) or 0     # unknown or bad: snapshot
+            if codes - self.codes:
+                self.codes |= codes
+                self.sent["codes"] = self.acked["codes"] = 0     # new codes need their rows: resend the watchlist
+            for ch in STATE_CHANNELS:
+                self.notify(ch)
+        elif op == "unsubscribe":
+            self.channels -= channels
+            self.codes -= codes
+            self.dirty = {ch for ch in self.dirty if self.subscribed(ch)}
+        elif op == "ack":
+            ch, seq = msg.get("channel"), _seq(msg.get("seq"))
+            if isinstance(ch, str) and ch in STATE_CHANNELS and seq is not None:
+                self.acking = True
+                self.acked[ch] = max(self.acked.get(ch, 0), seq)
+                if ch in self.dirty:
+                    self.wake.set()
+
+    def _may_send(self, channel: str) -> bool:
+        return not self.acking or self.acked.get(channel, 0) >= self.sent.get(channel, 0)
+
+    async def _send(self, text: str):
+        await asyncio.wait_for(self.ws.send_text(text), _SEND_TIMEOUT)
+
+    async def run(self):
+        """Sender loop: drains this client's events and dirty channels, independently of other clients."""
+        try:
+            while True:
+                await self.wake.wait()
+                self.wake.clear()
+                while self.events:
+                    await self._send(self.events.popleft())
+                for ch in list(self.dirty):
+                    if not self._may_send(ch):
+                        continue             # stays dirty until the previous message is acked
+                    self.dirty.discard(ch)
+                    base = self.sent.get(ch, 0)
+                    if ch == "codes":
+                        msg = _states[ch].message(base, self.codes)
+                        out = msg and (msg["seq"], _dumps(msg))
+                    else:
+                        out = _states[ch].encoded(base)
+                    if out is None:
+                        continue
+                    await self._send(out[1])
+                    self.sent[ch] = out[0]
+        except asyncio.TimeoutError:
+            metrics.WS_DROPPED.inc(reason="send_timeout")
+            log.warning("Dropping WebSocket client stuck for %ds", _SEND_TIMEOUT)
+            try:
+                await self.ws.close()
+            except Exception:
+                pass
+        except Exception:
+            pass
+
+
+_clients: set[_Client] = set()
 
 
 async def ws_endpoint(ws: WebSocket):
     await ws.accept()
-    _clients.append(ws)
+    client = _Client(ws)
+    _clients.add(client)
+    metrics.WS_CLIENTS.set(len(_clients))
+    sender = asyncio.create_task(client.run())
     try:
         while True:
-            await ws.receive_text()
+            text = await ws.receive_text()
+            try:
+                msg = json.loads(text)
+            except ValueError:
+                continue
+            if isinstance(msg, dict):
+                client.handle(msg)
     except WebSocketDisconnect:
         pass
     finally:
-        if ws in _clients:
-            _clients.remove(ws)
+        sender.cancel()
+        _clients.discard(client)
+        metrics.WS_CLIENTS.set(len(_clients))
 
 
-async def broadcast(data: dict):
-    msg = json.dumps(data, ensure_ascii=False, default=str)
-    for ws in list(_clients):
-        try:
-            await ws.send_text(msg)
-        except Exception:
-            if ws in _clients:
-                _clients.remove(ws)
+def _fan_out(channel: str, event: tuple[str | None, float]):
+    """Bus handler: mark a state channel dirty, or queue one pre-serialized event, for every subscriber."""
+    text, t0 = event
+    for client in list(_clients):
+        if text is None:
+            client.notify(channel)
+        elif client.subscribed(channel):
+            client.push_event(text)
+    metrics.WS_BROADCAST_DURATION.observe(time.perf_counter() - t0)
+
+
+bus = EventBus(_fan_out)
+
+
+def publish_sync(channel: str, rows: list[dict]):
+    """Replace a state channel's rows (callable from any thread); subscribers get a delta."""
+    t0 = time.perf_counter()
+    _states[channel].publish(rows)
+    bus.post_latest(channel, (None, t0))
 
 
 def broadcast_sync(data: dict):
-    """Sync wrapper for broadcast, safe to call from background threads."""
-    try:
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            asyncio.ensure_future(broadcast(data))
-        else:
-            loop.run_until_complete(broadcast(data))
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        loop.run_until_complete(broadcast(data))
-        loop.close()
+    """Send a job event to "jobs" subscribers (callable from any thread).
+
+    The payload is serialized here, once, while `data` (often the live
+    running-jobs dict) is consistent; job_status updates are coalesced.
+    """
+    event = (_dumps({**data, "channel": "jobs"}), time.perf_counter())
+    if data.get("type") == "job_status":
+        bus.post_latest("jobs", event, JOB_STATUS_INTERVAL)
+    else:
+        bus.post("jobs", event)
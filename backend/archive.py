@@ -0,0 +1,153 @@
+"""
+Columnar cold archive of closed trading days.
+
+Each archived day of trade_snapshots / heat_scores is a directory holding
+one .npy file per column (<archive_dir>/<table>/<YYYY-MM-DD>/<col>.npy),
+opened with memory mapping. Timestamps are stored as seconds since
+midnight and names are dropped (stock_basic has them).
+
+A day is served from SQLite while SQLite still has it (the archive copy of
+a recent day coexists with its partition until the month is closed) and
+from the archive otherwise, so readers never see it twice.
+"""
+import datetime, logging, os, shutil
+import numpy as np
+import pandas as pd
+from config import get as get_config
+import partitions
+
+log = logging.getLogger(__name__)
+
+COLUMNS = {
+    "heat_scores": {
+        "id": "i8", "code": "S8", "trade_heat": "f8", "sentiment_heat": "f8",
+        "total_heat": "f8", "zscore": "f8", "ts": "i4", "scan_id": "i8",
+    },
+    "trade_snapshots": {
+        "id": "i8", "code": "S8", "price": "f8", "change_pct": "f8", "volume": "f8", "amount": "f8",
+        "turnover_rate": "f8", "volume_ratio": "f8", "ts": "i4", "scan_id": "i8",
+    },
+}
+# How each column is selected from SQLite; NULL scan_ids become -1
+_SELECT = {
+    "ts": "CAST(substr(ts,12,2) AS INTEGER)*3600 + CAST(substr(ts,15,2) AS INTEGER)*60 + CAST(substr(ts,18,2) AS INTEGER)",
+    "scan_id": "COALESCE(scan_id, -1)",
+}
+
+
+def _root() -> str:
+    d = get_config()["data"].get("archive_dir", "data/archive")
+    return os.path.join(os.path.dirname(__file__), d)
+
+
+def _next_day(day: str) -> str:
+    return (datetime.date.fromisoformat(day) + datetime.timedelta(days=1)).isoformat()
+
+
+def days(table: str) -> list[str]:
+    """Archived days of `table`, oldest first."""
+    d = os.path.join(_root(), table)
+    if not os.path.isdir(d):
+        return []
+    return sorted(n for n in os.listdir(d) if len(n) == 10 and not n.startswith("."))
+
+
+def hot_days(conn, table: str) -> set[str]:
+    """Days that still have rows in SQLite (scans every partition; meant for rebuilds)."""
+    return {r[0] for r in conn.execute(f"SELECT DISTINCT substr(ts,1,10) FROM {table}")}
+
+
+def write_day(conn, table: str, day: str) -> int:
+    """Export one day of `table` from its partition into the archive; returns the row count."""
+    cols = COLUMNS[table]
+    part = f"{table}_{partitions.month_of(day)}"
+    cur = conn.cursor()
+    cur.row_factory = None
+    cur.execute(
+        f"SELECT {', '.join(_SELECT.get(c, c) for c in cols)} FROM {part} WHERE ts >= ? AND ts < ? ORDER BY id",
+        (day, _next_day(day)),
+    )
+    rows = cur.fetchall()
+    values = list(zip(*rows)) if rows else [()] * len(cols)
+
+    final = os.path.join(_root(), table, day)
+    tmp = os.path.join(_root(), table, f".{day}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for (col, dtype), vals in zip(cols.items(), values):
+        if dtype.startswith("S"):
+            vals = [v.encode("ascii", "replace") for v in vals]
+        np.save(os.path.join(tmp, f"{col}.npy"), np.array(vals, dtype=dtype))
+    os.replace(tmp, final)
+    return len(rows)
+
+
+def load_day(table: str, day: str) -> dict[str, np.ndarray]:
+    """Memory-mapped columns of one archived day."""
+    d = os.path.join(_root(), table, day)
+    return {c: np.load(os.path.join(d, f"{c}.npy"), mmap_mode="r") for c in COLUMNS[table]}
+
+
+def frame(table: str, day: str, code: str | None = None, since: str | None = None) -> pd.DataFrame:
+    """One archived day as a DataFrame with text `ts`, optionally for one code / from `since` on."""
+    cols = load_day(table, day)
+    mask = np.ones(len(cols["id"]), dtype=bool)
+    if code is not None:
+        mask &= cols["code"] == code.encode()
+    if since and since[:10] == day:
+        h, m, s = (int(x) for x in (since[11:19] or "00:00:00").split(":"))
+        mask &= cols["ts"] >= h * 3600 + m * 60 + s
+    df = pd.DataFrame({c: np.asarray(v[mask]) for c, v in cols.items()})
+    df["code"] = df["code"].str.decode("ascii")
+    tod = df["ts"].to_numpy()
+    df["ts"] = [f"{day} {t // 3600:02d}:{t // 60 % 60:02d}:{t % 60:02d}" for t in tod.tolist()]
+    df["scan_id"] = df["scan_id"].where(df["scan_id"] >= 0)
+    return df
+
+
+def read(table: str, since: str, code: str | None = None, skip_days=()) -> pd.DataFrame:
+    """Archived rows with ts >= since, leaving out `skip_days` (days the caller already read from SQLite)."""
+    skip = set(skip_days)
+    wanted = [d for d in days(table) if d >= since[:10] and d not in skip]
+    frames = [frame(table, d, code, since) for d in wanted]
+    if not frames:
+        return pd.DataFrame(columns=list(COLUMNS[table]))
+    return pd.concat(frames, ignore_index=True)
+
+
+def archive_closed_days(conn, keep_days: int) -> dict[str, list[str]]:
+    """
+    Archive every day older than `keep_days` not archived yet, then drop
+    partitions of past months whose days are all archived.
+    """
+    cutoff = (datetime.date.today() - datetime.timedelta(days=keep_days)).isoformat()
+    this_month = partitions.month_of()
+    written: dict[str, list[str]] = {}
+    for tbl in COLUMNS:
+        have = set(days(tbl))
+        for month in partitions.months(conn, tbl):
+            if month > partitions.month_of(cutoff):
+                continue
+            part = f"{tbl}_{month}"
+            found = {r[0] for r in conn.execute(f"SELECT DISTINCT substr(ts,1,10) FROM {part}")}
+            for day in sorted(d for d in found - have if d < cutoff):
+                n = write_day(conn, tbl, day)
+                have.add(day)
+                written.setdefault(tbl, []).append(day)
+                log.info("Archived %s %s (%d rows)", tbl, day, n)
+            if month < this_month and found <= have:
+                partitions.drop(conn, tbl, month)
+    return written
+
+
+def purge_before(day: str) -> list[str]:
+    """Delete archived days older than `day` (retention)."""
+    removed = []
+    for tbl in COLUMNS:
+        for d in days(tbl):
+            if d < day:
+                shutil.rmtree(os.path.join(_root(), tbl, d), ignore_errors=True)
+                removed.append(f"{tbl}/{d}")
+    if removed:
+        log.info("Purged %d archived days", len(removed))
+    return removed
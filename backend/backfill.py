@@ -2,6 +2,10 @@
 回填历史数据：腾讯日K接口（不限流）
 日K只有 [date, open, close, high, low, volume]
 用 volume 和 amplitude 做归一化，足够建立热度基线
+
+用法: python backfill.py [交易日数=15] [并发数=collector.backfill_workers]
+日期范围取上证指数日K的最近 N 个交易日；每只股票抓完即落库并记检查点，
+中断后重跑只抓剩下的股票。
 """
 import os, sys, time, logging
 for k in ("http_proxy", "https_proxy", "HTTP_PROXY", "HTTPS_PROXY"):
@@ -10,134 +14,316 @@ for k in ("http_proxy", "https_proxy", "HTTP_PROXY", "HTTPS_PROXY"):
 sys.path.insert(0, os.path.dirname(__file__))
 
 import requests
+from requests.adapters import HTTPAdapter
+import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
-from db import init_db, get_conn
-from engine import anomaly_detector
+from db import init_db, get_conn, query_frame
+import scans
+import partitions
+import archive
+from engine import anomaly_detector, heat_calculator, rollup
 import config
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 log = logging.getLogger(__name__)
 
+DEFAULT_WORKERS = 8
+CALENDAR_SYMBOL = "sh000001"   # SSE Composite: its daily bars are the trading calendar
+REPORT_EVERY = 200             # stocks between progress lines
+FETCH_ROUNDS = 3               # passes over stocks whose request failed
+
 SESSION = requests.Session()
 SESSION.headers.update({"User-Agent": "Mozilla/5.0"})
 SESSION.trust_env = False
+SESSION.mount("https://", HTTPAdapter(pool_maxsize=32))
 
 KLINE_URL = "https://web.ifzq.gtimg.cn/appstock/app/fqkline/get"
 
+# Fetched K-lines wait here until their day is built; a stock is checkpointed
+# together with its rows, so an interrupted run resumes with the missing stocks
+_TABLES = """
+CREATE TABLE IF NOT EXISTS backfill_klines (
+    run TEXT NOT NULL,
+    date TEXT NOT NULL,
+    code TEXT NOT NULL,
+    name TEXT,
+    price REAL,
+    change_pct REAL,
+    volume REAL,
+    amount REAL,
+    turnover_rate REAL,
+    volume_ratio REAL,
+    PRIMARY KEY (run, date, code)
+);
+CREATE TABLE IF NOT EXISTS backfill_checkpoint (
+    run TEXT NOT NULL,
+    code TEXT NOT NULL,
+    bars INTEGER,
+    done_at DATETIME DEFAULT (datetime('now','localtime')),
+    PRIMARY KEY (run, code)
+);
+"""
 
-def fetch_klines(symbol: str, beg: str, end: str) -> list:
-    try:
-        r = SESSION.get(KLINE_URL, params={"param": f"{symbol},day,{beg},{end},30,qfq"}, timeout=8)
-        data = r.json().get("data", {})
-        key = list(data.keys())[0] if data else None
-        if not key or key == "market":
-            return []
-        return data[key].get("qfqday") or data[key].get("day") or []
-    except:
+
+def _symbol(code: str) -> str:
+    return ("sh" if code.startswith("6") else "sz") + code
+
+
+def fetch_klines(symbol: str, beg: str, end: str, count: int = 30) -> list:
+    """Daily bars [date, open, close, high, low, volume, ...]; raises on request failures."""
+    r = SESSION.get(KLINE_URL, params={"param": f"{symbol},day,{beg},{end},{count},qfq"}, timeout=8)
+    r.raise_for_status()
+    data = r.json().get("data", {})
+    key = list(data.keys())[0] if data else None
+    if not key or key == "market":
         return []
+    return data[key].get("qfqday") or data[key].get("day") or []
 
 
-def backfill(days: int = 15):
-    config.load()
-    init_db()
+def trading_days(days: int, before: datetime.date | None = None) -> list[str]:
+    """The last `days` trading days before `before` (default: today), oldest first."""
+    before = before or datetime.date.today()
+    end = before - datetime.timedelta(days=1)
+    span = days * 2 + 30     # calendar days comfortably holding `days` sessions plus holidays
+    beg = end - datetime.timedelta(days=span)
+    try:
+        bars = fetch_klines(CALENDAR_SYMBOL, beg.isoformat(), end.isoformat(), span)
+        found = sorted({b[0] for b in bars if b and b[0] < before.isoformat()})
+    except Exception as e:
+        log.warning("Trading calendar fetch failed (%s), falling back to weekdays", e)
+        found = []
+    if not found:
+        found = [
+            d.isoformat() for d in (beg + datetime.timedelta(days=i) for i in range(span + 1)) if d.weekday() < 5
+        ]
+    return found[-days:]
 
+
+def _parse(code: str, name: str, klines: list, wanted: set[str]) -> list[dict]:
+    rows = []
+    for k in klines:
+        if len(k) < 6 or k[0] not in wanted:
+            continue
+        o, c, h, l, vol = float(k[1]), float(k[2]), float(k[3]), float(k[4]), float(k[5])
+        if c <= 0:
+            continue
+        change_pct = (c - o) / o * 100 if o > 0 else 0
+        amplitude = (h - l) / l * 100 if l > 0 else 0
+        rows.append({
+            "date": k[0], "code": code, "name": name,
+            "price": c, "change_pct": round(change_pct, 2),
+            "volume": vol, "amount": vol * c,  # approximate
+            "turnover_rate": amplitude,  # proxy
+            "volume_ratio": amplitude,   # proxy
+        })
+    return rows
+
+
+def _fetch_stock(stock: dict, dates: list[str]) -> list[dict] | None:
+    """Parsed bars of one stock for `dates`; None if the request failed (retried on the next run)."""
+    try:
+        klines = fetch_klines(_symbol(stock["code"]), dates[0], dates[-1], len(dates) + 5)
+    except Exception as e:
+        log.debug("K-line fetch failed for %s: %s", stock["code"], e)
+        return None
+    return _parse(stock["code"], stock["name"], klines, set(dates))
+
+
+def fetch_all(run: str, stocks: list[dict], dates: list[str], workers: int) -> dict:
+    """Fetch every stock not checkpointed for `run` with a bounded pool, storing each as it completes."""
     with get_conn() as conn:
-        stocks = conn.execute("SELECT code, name FROM stock_basic").fetchall()
-    stocks = [dict(s) for s in stocks]
-    log.info("Backfilling %d stocks, %d days", len(stocks), days)
-
-    # Collect all klines per stock
-    all_data = {}  # date -> [records]
-    batch = 50
-    for i in range(0, len(stocks), batch):
-        chunk = stocks[i:i + batch]
-        for s in chunk:
-            code, name = s["code"], s["name"]
-            prefix = "sh" if code.startswith("6") else "sz"
-            symbol = f"{prefix}{code}"
-            klines = fetch_klines(symbol, "2026-02-10", "2026-02-26")
-            for k in klines:
-                if len(k) < 6:
-                    continue
-                dt = k[0]
-                o, c, h, l, vol = float(k[1]), float(k[2]), float(k[3]), float(k[4]), float(k[5])
-                if c <= 0:
-                    continue
-                change_pct = (c - o) / o * 100 if o > 0 else 0
-                amplitude = (h - l) / l * 100 if l > 0 else 0
-                if dt not in all_data:
-                    all_data[dt] = []
-                all_data[dt].append({
-                    "code": code, "name": name,
-                    "price": c, "change_pct": round(change_pct, 2),
-                    "volume": vol, "amount": vol * c,  # approximate
-                    "turnover_rate": amplitude,  # proxy
-                    "volume_ratio": amplitude,   # proxy
-                })
-        done = min(i + batch, len(stocks))
-        if done % 500 == 0 or done == len(stocks):
-            log.info("Fetched %d/%d (%.0f%%)", done, len(stocks), done / len(stocks) * 100)
-        time.sleep(0.05)
-
-    # Sort dates, exclude today
-    import datetime
-    today = datetime.date.today().strftime("%Y-%m-%d")
-    dates = sorted(d for d in all_data if d != today)
-    log.info("Trading days: %s", dates)
-
-    for dt in dates:
-        records = all_data[dt]
-        ts = f"{dt} 15:00:00"
-
-        with get_conn() as conn:
-            existing = conn.execute("SELECT COUNT(*) as c FROM trade_snapshots WHERE ts=?", (ts,)).fetchone()["c"]
-            if existing > 100:
-                log.info("Skip %s (%d existing)", dt, existing)
-                continue
+        done = {r[0] for r in conn.execute("SELECT code FROM backfill_checkpoint WHERE run=?", (run,))}
+    todo = [s for s in stocks if s["code"] not in done]
+    log.info("Fetching %d stocks (%d already done) with %d workers", len(todo), len(done), workers)
 
-            conn.executemany(
-                "INSERT INTO trade_snapshots(code,name,price,change_pct,volume,amount,turnover_rate,volume_ratio,ts) "
-                "VALUES(:code,:name,:price,:change_pct,:volume,:amount,:turnover_rate,:volume_ratio,:ts)",
-                [{**r, "ts": ts} for r in records],
-            )
+    stats = {"stocks": 0, "bars": 0, "failed": 0}
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="kline") as pool:
+        futures = {pool.submit(_fetch_stock, s, dates): s["code"] for s in todo}
+        for n, fut in enumerate(as_completed(futures), 1):
+            rows = fut.result()
+            if rows is None:
+                stats["failed"] += 1
+            else:
+                with get_conn() as conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO backfill_klines(run,date,code,name,price,change_pct,volume,amount,turnover_rate,volume_ratio) "
+                        "VALUES(:run,:date,:code,:name,:price,:change_pct,:volume,:amount,:turnover_rate,:volume_ratio)",
+                        [{**r, "run": run} for r in rows],
+                    )
+                    conn.execute(
+                        "INSERT OR REPLACE INTO backfill_checkpoint(run,code,bars) VALUES(?,?,?)", (run, futures[fut], len(rows))
+                    )
+                stats["stocks"] += 1
+                stats["bars"] += len(rows)
+            if n % REPORT_EVERY == 0 or n == len(todo):
+                el = max(time.time() - t0, 1e-9)
+                log.info(
+                    "Fetched %d/%d (%.0f%%) %.1f stocks/s %.0f bars/s, %d failed, ETA %.0fs",
+                    n, len(todo), n / len(todo) * 100, n / el, stats["bars"] / el, stats["failed"], (len(todo) - n) * el / n,
+                )
+    stats["seconds"] = time.time() - t0
+    return stats
+
+
+def _baseline_history(conn, first: str, skip: set[str]) -> pd.DataFrame:
+    """Daily trade_heat already in the rollup that baselines of days from `first` on depend on."""
+    window = config.get()["detection"]["window_size"]
+    before = query_frame(
+        conn,
+        "SELECT code, bucket AS day, trade_heat FROM ("
+        "SELECT code, bucket, trade_heat, ROW_NUMBER() OVER (PARTITION BY code ORDER BY bucket DESC) AS rn "
+        "FROM heat_rollup_1d WHERE bucket < ?) WHERE rn <= ?", (first, window),
+    )
+    within = query_frame(conn, "SELECT code, bucket AS day, trade_heat FROM heat_rollup_1d WHERE bucket >= ?", (first,))
+    # Days being rebuilt are replaced by the new rows
+    return pd.concat([before, within[~within["day"].isin(skip)]], ignore_index=True)
 
-        # Calculate heat
-        df = pd.DataFrame(records)
-        cfg = config.get()["heat_weights"]
 
-        def _norm(s):
-            mn, mx = s.min(), s.max()
-            return (s - mn) / (mx - mn) if mx > mn else pd.Series(0.0, index=s.index)
+def _built_days(conn, dates: list[str]) -> set[str]:
+    """
+    Dates that already have closing heat rows: a backfilled scan, or rows at
+    15:00 in the day's partition written before scans were recorded.
+    """
+    stamps = [f"{d} 15:00:00" for d in dates]
+    done = {r[0][:10] for r in conn.execute(
+        "SELECT started_at FROM scans WHERE heat_at IS NOT NULL AND started_at IN (%s)" % ",".join("?" * len(stamps)),
+        stamps,
+    )}
+    by_month: dict[str, list[str]] = {}
+    for ts in stamps:
+        if ts[:10] not in done:
+            by_month.setdefault(partitions.month_of(ts), []).append(ts)
+    existing = set(partitions.months(conn, "heat_scores"))
+    for month, month_stamps in by_month.items():
+        if month in existing:
+            done |= {r[0][:10] for r in conn.execute(
+                f"SELECT DISTINCT ts FROM heat_scores_{month} WHERE ts IN (%s)" % ",".join("?" * len(month_stamps)),
+                month_stamps,
+            )}
+    return done
 
-        df["trade_heat"] = (
-            _norm(df["volume_ratio"].fillna(0)) * cfg["volume_ratio"]
-            + _norm(df["turnover_rate"].fillna(0)) * cfg["turnover_rate"]
-            + _norm(df["amount"].fillna(0)) * cfg["amount_change"]
+
+def build_days(run: str, dates: list[str], archived: set[str]) -> int:
+    """
+    Turn the staged bars of every date into backfilled scans at once: trade
+    heat is normalized per date in one grouped pass, z-scores come from each
+    stock's rolling daily baseline, and all rows go in in one transaction.
+    Returns the number of heat rows written.
+    """
+    with get_conn() as conn:
+        done = _built_days(conn, dates)
+        todo = [d for d in dates if d not in done and d not in archived]
+        for d in sorted(set(dates) - set(todo)):
+            log.info("Skip %s (%s)", d, "already built" if d in done else "archived")
+        if not todo:
+            return 0
+        df = query_frame(
+            conn,
+            "SELECT date,code,name,price,change_pct,volume,amount,turnover_rate,volume_ratio "
+            "FROM backfill_klines WHERE run=? AND date IN (%s) ORDER BY date, code" % ",".join("?" * len(todo)),
+            [run, *todo],
         )
-        df["sentiment_heat"] = 0.0
-        df["total_heat"] = df["trade_heat"] * cfg["trade"] + df["sentiment_heat"] * cfg["sentiment"]
-        df["zscore"] = 0.0
+        if df.empty:
+            return 0
+        history = _baseline_history(conn, todo[0], set(todo))
+
+    t0 = time.time()
+    cfg = config.get()["heat_weights"]
+    df["trade_heat"] = heat_calculator.calc_trade_heat(df, df["date"])
+    df["sentiment_heat"] = 0.0
+    df["total_heat"] = df["trade_heat"] * cfg["trade"] + df["sentiment_heat"] * cfg["sentiment"]
+    df["ts"] = df["date"] + " 15:00:00"
 
-        with get_conn() as conn:
+    daily = pd.concat([history, df[["code", "date", "trade_heat"]].rename(columns={"date": "day"})], ignore_index=True)
+    z = anomaly_detector.rolling_zscores(daily)
+    df["zscore"] = z.sort_index().to_numpy()[len(history):]
+
+    trade_cols = ["code", "name", "price", "change_pct", "volume", "amount", "turnover_rate", "volume_ratio", "ts", "scan_id"]
+    heat_cols = ["code", "name", "trade_heat", "sentiment_heat", "total_heat", "zscore", "ts", "scan_id"]
+    with get_conn() as conn:
+        start_ids = {}
+        for dt, day_df in df.groupby("date", sort=True):
+            ts = f"{dt} 15:00:00"
+            scan_id = scans.begin(conn, ts)
+            day_df = day_df.assign(scan_id=scan_id)
+            trade_part = partitions.for_scan(conn, "trade_snapshots", scan_id)
+            heat_part = partitions.for_scan(conn, "heat_scores", scan_id)
+            if heat_part not in start_ids:
+                start_ids[heat_part] = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {heat_part}").fetchone()[0]
             conn.executemany(
-                "INSERT INTO heat_scores(code,name,trade_heat,sentiment_heat,total_heat,zscore,ts) "
-                "VALUES(:code,:name,:trade_heat,:sentiment_heat,:total_heat,:zscore,:ts)",
-                [{**r, "ts": ts} for r in df[["code", "name", "trade_heat", "sentiment_heat", "total_heat", "zscore"]].to_dict("records")],
+                f"INSERT INTO {trade_part}({','.join(trade_cols)}) VALUES({','.join('?' * len(trade_cols))})",
+                day_df[trade_cols].itertuples(index=False, name=None),
             )
-        log.info("Backfilled %s: %d stocks", dt, len(records))
+            conn.executemany(
+                f"INSERT INTO {heat_part}({','.join(heat_cols)}) VALUES({','.join('?' * len(heat_cols))})",
+                day_df[heat_cols].itertuples(index=False, name=None),
+            )
+            scans.mark(conn, scan_id, "trade", ts)
+            scans.mark(conn, scan_id, "heat", ts)
+        # Daily baselines (and the finer rollups) straight from the new rows, one pass per partition
+        for part, last_id in start_ids.items():
+            rollup.update_since(conn, last_id, part)
+    el = max(time.time() - t0, 1e-9)
+    log.info("Built %d days (%d heat rows) in %.1fs = %.0f rows/s", len(todo), len(df), el, len(df) / el)
+    return len(df)
+
+
+def backfill(days: int = 15, workers: int | None = None):
+    config.load()
+    init_db()
+    workers = workers or config.get().get("collector", {}).get("backfill_workers", DEFAULT_WORKERS)
+
+    with get_conn() as conn:
+        conn.executescript(_TABLES)
+        stocks = [dict(s) for s in conn.execute("SELECT code, name FROM stock_basic").fetchall()]
+
+    dates = trading_days(days)
+    if not dates:
+        log.info("No trading days to backfill")
+        return
+    run = f"{dates[0]}_{dates[-1]}"
+    log.info("Backfilling %d stocks over %d trading days (%s .. %s)", len(stocks), len(dates), dates[0], dates[-1])
+    with get_conn() as conn:
+        # Progress of a run over another date range can't be resumed
+        conn.execute("DELETE FROM backfill_klines WHERE run != ?", (run,))
+        conn.execute("DELETE FROM backfill_checkpoint WHERE run != ?", (run,))
+
+    t0 = time.time()
+    stats = {"stocks": 0, "bars": 0, "failed": 0, "seconds": 0.0}
+    for _ in range(FETCH_ROUNDS):
+        r = fetch_all(run, stocks, dates, workers)
+        stats.update({k: stats[k] + r[k] for k in ("stocks", "bars", "seconds")}, failed=r["failed"])
+        if not r["failed"]:
+            break
+    if stats["failed"]:
+        log.warning("%d stocks still failing after %d rounds; their rows will be missing", stats["failed"], FETCH_ROUNDS)
+
+    built = build_days(run, dates, set(archive.days("heat_scores")))
+    with get_conn() as conn:
+        # Built days are skipped from now on; only the checkpoint is needed to resume
+        conn.execute("DELETE FROM backfill_klines WHERE run=?", (run,))
+    el = time.time() - t0
+    log.info(
+        "Fetched %d stocks (%d bars, %d failed) in %.1fs = %.1f stocks/s; wrote %d heat rows; total %.1fs",
+        stats["stocks"], stats["bars"], stats["failed"], stats["seconds"],
+        stats["stocks"] / max(stats["seconds"], 1e-9), built, el,
+    )
 
     # Recalculate Z-scores on latest data
     log.info("Recalculating Z-scores...")
     with get_conn() as conn:
-        latest_ts = conn.execute("SELECT MAX(ts) as ts FROM heat_scores").fetchone()["ts"]
-        rows = conn.execute(
-            "SELECT h.code, h.name, h.total_heat, h.trade_heat, h.sentiment_heat, "
+        scan_id = scans.latest(conn, "heat")
+        df = query_frame(
+            conn,
+            "SELECT h.id, h.code, h.name, h.total_heat, h.trade_heat, h.sentiment_heat, h.ts, "
             "t.change_pct, t.volume_ratio "
-            "FROM heat_scores h LEFT JOIN trade_snapshots t ON h.code=t.code "
-            "AND t.ts=(SELECT MAX(ts) FROM trade_snapshots) WHERE h.ts=?", (latest_ts,)
-        ).fetchall()
-    if rows:
-        df = pd.DataFrame([dict(r) for r in rows])
+            f"FROM {partitions.for_scan(conn, 'heat_scores', scan_id)} h "
+            f"LEFT JOIN {partitions.for_scan(conn, 'trade_snapshots', scan_id)} t ON t.scan_id=h.scan_id AND t.code=h.code "
+            "WHERE h.scan_id=?", (scan_id,)
+        )
+    if not df.empty:
         anomalies = anomaly_detector.detect(df)
         log.info("Anomalies with historical baseline: %d", len(anomalies))
         for a in anomalies[:15]:
@@ -150,4 +336,7 @@ def backfill(days: int = 15):
 
 
 if __name__ == "__main__":
-    backfill(int(sys.argv[1]) if len(sys.argv) > 1 else 15)
+    backfill(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 15,
+        int(sys.argv[2]) if len(sys.argv) > 2 else None,
+    )
@@ -0,0 +1,61 @@
+"""
+Micro-benchmark: loading a full-market scan from SQLite into a DataFrame,
+per-row dicts vs. db.query_frame.
+
+    cd backend && python -m bench.bench_fetch [stocks]
+"""
+import os, random, sqlite3, sys, tempfile, time, tracemalloc
+import pandas as pd
+from db import query_frame
+
+SQL = "SELECT code,name,price,change_pct,volume,amount,turnover_rate,volume_ratio FROM trade_snapshots WHERE scan_id=?"
+
+
+def _dicts(conn) -> pd.DataFrame:
+    rows = conn.execute(SQL, (1,)).fetchall()
+    return pd.DataFrame([dict(r) for r in rows])
+
+
+def _frame(conn) -> pd.DataFrame:
+    return query_frame(conn, SQL, (1,))
+
+
+def _measure(fn, conn, repeat=5) -> tuple[float, int]:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn(conn)
+        best = min(best, time.perf_counter() - t0)
+    tracemalloc.start()
+    fn(conn)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def main(stocks: int = 5000):
+    rng = random.Random(7)
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "bench.db"))
+        conn.row_factory = sqlite3.Row
+        conn.execute(
+            "CREATE TABLE trade_snapshots(id INTEGER PRIMARY KEY, code TEXT, name TEXT, price REAL, change_pct REAL, "
+            "volume REAL, amount REAL, turnover_rate REAL, volume_ratio REAL, scan_id INTEGER)"
+        )
+        conn.execute("CREATE INDEX idx_scan ON trade_snapshots(scan_id, code)")
+        conn.executemany(
+            "INSERT INTO trade_snapshots(code,name,price,change_pct,volume,amount,turnover_rate,volume_ratio,scan_id) "
+            "VALUES(?,?,?,?,?,?,?,?,1)",
+            [(f"{600000 + i}", f"股票{i}", rng.uniform(2, 200), rng.uniform(-10, 10), rng.uniform(1e3, 1e7),
+              rng.uniform(1e3, 1e7), rng.uniform(0, 20), rng.uniform(0, 5)) for i in range(stocks)],
+        )
+        assert _dicts(conn).equals(_frame(conn)), "loaders disagree"
+        print(f"{stocks} rows")
+        for label, fn in (("dict per row", _dicts), ("query_frame", _frame)):
+            t, peak = _measure(fn, conn)
+            print(f"  {label:<13}: {t * 1000:7.1f} ms  peak {peak / 1e6:6.2f} MB")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:2]))
@@ -0,0 +1,54 @@
+"""
+Micro-benchmark: Tencent quote parsing, per-line dicts vs. _parse_payload.
+
+    cd backend && python -m bench.bench_parser [stocks] [batch_size]
+"""
+import random, sys, time
+import pandas as pd
+from collector.trade_collector import _parse_line, _parse_payload, _build_symbol
+from bench.payloads import fake_name, quote_payload
+
+
+def _legacy(payload: bytes) -> pd.DataFrame:
+    rows = []
+    for line in payload.decode("gbk").split(";"):
+        d = _parse_line(line)
+        if d and d["price"] > 0:
+            rows.append(d)
+    return pd.DataFrame(rows)
+
+
+def _columnar(payload: bytes) -> pd.DataFrame:
+    return pd.DataFrame(_parse_payload(payload))
+
+
+def _best_of(fn, payloads, repeat=5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for p in payloads:
+            fn(p)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main(stocks: int = 5000, batch: int = 80):
+    rng = random.Random(42)
+    codes = [f"{rng.choice(['60', '00', '30'])}{i:04d}" for i in range(stocks)]
+    names = {c: fake_name(rng) for c in codes}
+    symbols = [_build_symbol(c) for c in codes]
+    payloads = [quote_payload(symbols[i:i + batch], names, rng) for i in range(0, stocks, batch)]
+
+    a, b = _legacy(b"".join(payloads)), _columnar(b"".join(payloads))
+    assert a.equals(b.astype(a.dtypes.to_dict())), "parsers disagree"
+
+    t_legacy = _best_of(_legacy, payloads)
+    t_columnar = _best_of(_columnar, payloads)
+    size = sum(map(len, payloads)) / 1e6
+    print(f"{stocks} stocks in {len(payloads)} payloads ({size:.1f} MB)")
+    print(f"  _parse_line + dicts : {t_legacy * 1000:8.1f} ms")
+    print(f"  _parse_payload      : {t_columnar * 1000:8.1f} ms  ({t_legacy / t_columnar:.1f}x)")
+
+
+if __name__ == "__main__":
+    main(*(int(a) for a in sys.argv[1:3]))
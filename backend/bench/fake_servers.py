@@ -0,0 +1,84 @@
+"""
+Local stand-ins for the upstream market-data hosts (Tencent quotes, guba,
+10jqka hot list, webhook receiver), replaying payloads from bench.payloads.
+"""
+import json, random, threading, time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bench.payloads import quote_payload, guba_page, ths_hot_list
+
+
+class FakeMarket:
+    """Serves every fake host from one port; routes by path."""
+
+    def __init__(self, universe: list[dict], latency_ms: float = 0.0, max_symbols: int = 0, seed: int = 3):
+        self.names = {s["code"]: s["name"] for s in universe}
+        self.codes = list(self.names)
+        self.latency = latency_ms / 1000
+        self.max_symbols = max_symbols          # 0 = accept any list length
+        self.requests = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def rng(self) -> random.Random:
+        with self._lock:
+            return random.Random(self._rng.random())
+
+    def _handler(self):
+        market = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: bytes, ctype: str):
+                self.send_response(status)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if market.latency:
+                    time.sleep(market.latency)
+                path = self.path
+                if path.startswith("/q="):
+                    market.requests["quote"] += 1
+                    symbols = path[3:].split(",")
+                    if market.max_symbols and len(symbols) > market.max_symbols:
+                        return self._send(414, b"", "text/plain")
+                    body = quote_payload(symbols, market.names, market.rng())
+                    return self._send(200, body, "text/html; charset=GBK")
+                if path.startswith("/list,"):
+                    market.requests["guba"] += 1
+                    code = path[len("/list,"):].split(".")[0]
+                    return self._send(200, guba_page(code, market.rng()).encode(), "text/html; charset=utf-8")
+                if path.startswith("/ths"):
+                    market.requests["ths"] += 1
+                    body = json.dumps(ths_hot_list(market.codes, market.rng())).encode()
+                    return self._send(200, body, "application/json")
+                self._send(404, b"", "text/plain")
+
+            def do_POST(self):
+                market.requests["webhook"] += 1
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self._send(200, b'{"code":0}', "application/json")
+
+        return Handler
+
+    def start(self) -> "FakeMarket":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
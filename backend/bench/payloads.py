@@ -0,0 +1,70 @@
+"""
+Synthetic market-data payloads in the upstream wire formats, for benchmarks.
+Shapes follow recorded responses; values are random but plausible.
+"""
+import random
+
+# 硚 is b"\xb3~" in GBK: its trail byte is the quote field separator
+_NAME_CHARS = "中国平安银行科技电子能源医药股份控股集团新材料光伏智能制造汽车证券硚"
+
+
+def fake_name(rng: random.Random) -> str:
+    name = "".join(rng.choice(_NAME_CHARS) for _ in range(rng.randint(2, 4)))
+    return ("*ST" if rng.random() < 0.02 else "") + name
+
+
+def quote_line(symbol: str, name: str, rng: random.Random) -> str:
+    """One qt.gtimg.cn quote record: v_sh600519="1~name~code~price~...~" (88 fields)."""
+    code = symbol[2:]
+    suspended = rng.random() < 0.01
+    prev = round(rng.uniform(2, 200), 2)
+    price = 0.0 if suspended else round(prev * rng.uniform(0.9, 1.1), 2)
+    f = [""] * 88
+    f[0], f[1], f[2] = "1" if symbol.startswith("sh") else "51", name, code
+    f[3], f[4], f[5] = f"{price:.2f}", f"{prev:.2f}", f"{prev:.2f}"
+    vol = rng.randint(1000, 5_000_000)
+    f[6], f[7], f[8] = str(vol), str(vol // 2), str(vol - vol // 2)
+    for i in range(9, 29):
+        f[i] = f"{price:.2f}" if i % 2 else str(rng.randint(1, 9999))
+    f[30] = "20261016150003"
+    f[31] = f"{price - prev:.2f}"
+    f[32] = f"{(price - prev) / prev * 100:.2f}" if price else "0.00"
+    f[33], f[34] = f"{price * 1.02:.2f}", f"{price * 0.98:.2f}"
+    amount = vol * price / 100
+    f[35] = f"{price:.2f}/{vol}/{int(amount * 10000)}"
+    f[36], f[37] = str(vol), f"{amount:.0f}"
+    f[38] = f"{rng.uniform(0.05, 25):.2f}"
+    f[39] = f"{rng.uniform(-50, 300):.2f}"
+    for i in range(40, 88):
+        f[i] = f"{rng.uniform(0, 100):.2f}"
+    f[49] = "" if rng.random() < 0.01 else f"{rng.lognormvariate(0, 0.5):.2f}"
+    return f'v_{symbol}="{"~".join(f)}";\n'
+
+
+def quote_payload(symbols: list[str], names: dict[str, str], rng: random.Random) -> bytes:
+    """A full qt.gtimg.cn response body (GBK, as served) for the given symbols."""
+    return "".join(quote_line(s, names.get(s[2:], s), rng) for s in symbols).encode("gbk")
+
+
+def guba_page(code: str, rng: random.Random) -> str:
+    """A guba list page: the stats live in an inline `var article_list = {...};`."""
+    import json
+    articles = [
+        {"post_id": rng.randint(10**9, 10**10), "post_title": f"{code} 讨论 {i}",
+         "post_click_count": rng.randint(0, 20000), "post_comment_count": rng.randint(0, 300)}
+        for i in range(80)
+    ]
+    data = {"count": rng.randint(0, 500000), "re": articles}
+    return (
+        "<html><head><title>股吧</title></head><body>"
+        + "<div class='filler'>" + "x" * 20000 + "</div>"
+        + f"<script>var article_list = {json.dumps(data, ensure_ascii=False)};</script></body></html>"
+    )
+
+
+def ths_hot_list(codes: list[str], rng: random.Random) -> dict:
+    """10jqka hot list JSON (top 100 by heat)."""
+    top = rng.sample(codes, min(100, len(codes)))
+    return {"status_code": 0, "data": {"stock_list": [
+        {"code": c, "name": c, "rate": f"{rng.uniform(1e3, 1e6):.1f}", "order": i + 1} for i, c in enumerate(top)
+    ]}}
@@ -0,0 +1,363 @@
+"""
+Query-plan regression check over a synthetic full-retention database.
+
+Builds `--days` of scans, heat, sentiment, alerts and job logs for a
+synthetic universe, runs one live scan against the fake market servers,
+every anomaly detector path, the API handlers and the nightly jobs, and
+records each distinct SQL statement they execute (by call site). Every
+statement is then EXPLAIN QUERY PLAN'd and timed on the populated database.
+Exits non-zero when a statement fully scans one of the large tables and is
+not listed in ACCEPTED_SCANS.
+
+    cd backend && python -m bench.query_plans --codes 1000 --days 90 --out query_plans.json
+"""
+import argparse, asyncio, json, os, platform, re, sqlite3, statistics, sys, tempfile, time
+import numpy as np
+
+import config
+import db
+import partitions
+import scans
+from bench.fake_servers import FakeMarket
+from bench.run_scan_bench import _point_collectors, _reset_state
+from bench.universe import make_universe
+
+# Tables that grow with retention; a full scan of any of them is a regression
+LARGE_TABLES = set(partitions.TABLES) | set(db.ROLLUP_TABLES) | {"alerts", "job_logs", "scans"}
+
+# Full scans that are the point of the statement, with the reason
+ACCEPTED_SCANS = [
+    (r"^SELECT COUNT\(\*\) as c FROM (alerts|job_logs)$", "unfiltered pagination total"),
+    (r"ROW_NUMBER\(\) OVER \(PARTITION BY code ORDER BY bucket DESC\)", "loads every code's baseline window"),
+    (r"^SELECT DISTINCT substr\(ts,1,10\) FROM", "nightly archive lists a partition's days"),
+    (r"^SELECT id, code, .* WHERE ts >= \? AND ts < \? ORDER BY id$", "nightly archive export of one day"),
+    (r"^DELETE FROM heat_rollup_\w+ WHERE bucket <", "nightly retention sweep"),
+    (r"^SELECT id FROM scans WHERE \w+_at IS NOT NULL ORDER BY started_at DESC", "the newest scans have the phase"),
+    (r"^SELECT 1 FROM (heat_rollup_1d|heat_scores) LIMIT 1$", "emptiness probe, stops at the first row"),
+]
+
+_WRITES = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+_KEYWORDS = {"WHERE", "LEFT", "INNER", "JOIN", "ON", "ORDER", "GROUP", "LIMIT", "UNION", "USING", "SET"}
+_SCAN_RE = re.compile(r"^SCAN (\S+)(?: USING (?:COVERING )?INDEX (\S+))?")
+_FROM_RE = re.compile(r"\b(?:FROM|JOIN|UPDATE|INTO)\s+([\w.]+)(?:\s+(?:AS\s+)?(\w+))?", re.IGNORECASE)
+
+
+class Recorder:
+    """Distinct statements executed through db's timed cursors, keyed by call site and SQL."""
+
+    def __init__(self):
+        self.statements: dict[tuple[str, str], dict] = {}
+        self._orig = None
+
+    def _record(self, cur, sql: str, params):
+        text = " ".join(sql.split())
+        if not text.upper().startswith(("SELECT", "WITH") + _WRITES):
+            return
+        entry = self.statements.get((cur.site, text))
+        if entry is None:
+            # Plan it now, on the executing connection: temp tables and dropped partitions are gone later
+            try:
+                plan = [r[3] for r in sqlite3.Cursor(cur.connection).execute("EXPLAIN QUERY PLAN " + sql, params)]
+            except sqlite3.Error as e:
+                plan = [f"error: {e}"]
+            entry = self.statements[(cur.site, text)] = {
+                "site": cur.site, "sql": text, "params": params, "plan": plan, "calls": 0,
+            }
+        entry["calls"] += 1
+
+    def start(self):
+        from metrics import call_site
+        cursor = db._TimedCursor
+        self._orig = cursor.execute, cursor.executemany
+        execute, executemany = self._orig
+        recorder = self
+
+        def recorded_execute(cur, sql, params=()):
+            cur.site = cur.site or call_site()
+            recorder._record(cur, sql, params)
+            return execute(cur, sql, params)
+
+        def recorded_executemany(cur, sql, seq):
+            cur.site = cur.site or call_site()
+            seq = list(seq)
+            if seq:
+                recorder._record(cur, sql, seq[0])
+            return executemany(cur, sql, seq)
+
+        cursor.execute, cursor.executemany = recorded_execute, recorded_executemany
+
+    def stop(self):
+        if self._orig:
+            db._TimedCursor.execute, db._TimedCursor.executemany = self._orig
+            self._orig = None
+
+
+# ── Synthetic history ────────────────────────────────────────
+
+def _trading_days(days: int) -> list[str]:
+    import datetime
+    today = datetime.date.today()
+    out = [today - datetime.timedelta(days=d) for d in range(days, 0, -1)]
+    return [str(d) for d in out if d.weekday() < 5]
+
+
+def seed_full_history(conn, universe: list[dict], days: int, scans_per_day: int, seed: int = 4):
+    """Scans, trade/heat/sentiment snapshots, alerts and job logs for every trading day in `days`, rolled up."""
+    from engine import rollup
+    rng = np.random.default_rng(seed)
+    codes = [s["code"] for s in universe]
+    names = [s["name"] for s in universe]
+    n = len(codes)
+    interval = config.get()["scanner"]["interval_minutes"]
+    touched = set()
+    for day in _trading_days(days):
+        logs = [("sync_basic", "ok", "synced", 3.0, f"{day} 09:00:00")]
+        for k in range(scans_per_day):
+            minute = 9 * 60 + 30 + k * interval
+            ts = f"{day} {minute // 60:02d}:{minute % 60:02d}:00"
+            scan_id = scans.begin(conn, ts)
+            for phase in scans.PHASES:
+                scans.mark(conn, scan_id, phase, ts)
+            price = rng.lognormal(2.5, 0.8, n)
+            change = rng.normal(0, 2, n)
+            volume_ratio = rng.lognormal(0, 0.4, n)
+            trade = rng.lognormal(-3.5, 0.6, n)
+            sentiment = np.where(rng.random(n) < 0.1, rng.random(n), 0.0)
+            total = trade * 0.6 + sentiment * 0.4
+            part = partitions.table(conn, "trade_snapshots", ts)
+            conn.executemany(
+                f"INSERT INTO {part}(code,name,price,change_pct,volume,amount,turnover_rate,volume_ratio,ts,scan_id) "
+                "VALUES(?,?,?,?,?,?,?,?,?,?)",
+                zip(codes, names, price.tolist(), change.tolist(), (price * 1e4).tolist(), (price * 1e6).tolist(),
+                    rng.random(n).tolist(), volume_ratio.tolist(), [ts] * n, [scan_id] * n),
+            )
+            touched.add(partitions.table(conn, "heat_scores", ts))
+            conn.executemany(
+                f"INSERT INTO {partitions.table(conn, 'heat_scores', ts)}"
+                "(code,name,trade_heat,sentiment_heat,total_heat,zscore,ts,scan_id) VALUES(?,?,?,?,?,?,?,?)",
+                zip(codes, names, trade.tolist(), sentiment.tolist(), total.tolist(),
+                    rng.normal(0, 1, n).tolist(), [ts] * n, [scan_id] * n),
+            )
+            top = np.argsort(-trade)[:100]
+            conn.executemany(
+                f"INSERT INTO {partitions.table(conn, 'sentiment_snapshots', ts)}(code,source,post_count,comment_count,ts) "
+                "VALUES(?,?,?,?,?)",
+                [(codes[i], src, int(rng.integers(0, 200)), int(rng.integers(0, 2000)), ts)
+                 for i in top for src in ("guba", "xueqiu")],
+            )
+            conn.executemany(
+                "INSERT INTO alerts(code,name,total_heat,zscore,change_pct,volume_ratio,message,scan_id,delivery_status,ts) "
+                "VALUES(?,?,?,?,?,?,'',?,?,?)",
+                [(codes[i], names[i], float(total[i]), 3.5, float(change[i]), float(volume_ratio[i]), scan_id,
+                  rng.choice(["sent"] * 8 + ["failed", None]), ts)
+                 for i in top[:int(rng.integers(0, 4))]],
+            )
+            for job in ("collect_trade", "calc_heat", "collect_sentiment", "calc_heat", "detect_anomaly"):
+                failed = rng.random() < 0.02
+                logs.append((job, "error" if failed else "ok", "boom" if failed else "done", 1.0, ts))
+        logs += [("archive", "ok", "archived", 20.0, f"{day} 02:30:00"), ("cleanup", "ok", "", 2.0, f"{day} 03:00:00")]
+        conn.executemany("INSERT INTO job_logs(job_name,status,message,duration_sec,ts) VALUES(?,?,?,?,?)", logs)
+        conn.commit()
+    for part in sorted(touched):
+        rollup.update_since(conn, 0, part)
+    conn.commit()
+
+
+# ── Workload ─────────────────────────────────────────────────
+
+def run_workload(universe: list[dict]):
+    """Every code path whose SQL is checked: a live scan, all detector paths, the API and the nightly jobs."""
+    import main
+    from api import routes, ranking_cache
+    from engine import anomaly_detector, rolling_stats
+    from notifier import webhook
+    import sentiment_store
+
+    rolling_stats.warm_start()
+    sentiment_store.hydrate()
+    webhook.start()
+    main.run_scan()
+    webhook._queue.join()
+
+    with db.get_conn() as conn:
+        scan_id = scans.latest(conn, "heat")
+        heat_df = db.query_frame(
+            conn, f"SELECT * FROM {partitions.for_scan(conn, 'heat_scores', scan_id)} WHERE scan_id=?", (scan_id,)
+        )
+    anomaly_detector.detect_batch(heat_df)
+    anomaly_detector.detect_online(heat_df)
+    anomaly_detector.detect_rowwise(heat_df.head(20))
+    main.job_detect_anomaly()
+    main.job_calc_heat()
+
+    codes = [s["code"] for s in universe]
+    ranking_cache._current = None
+    calls = [
+        routes.system_status(_=None),
+        routes.heat_ranking(page=1, size=50, sort="total_heat", _=None),
+        routes.alerts(page=1, size=50, code="", _=None),
+        routes.alerts(page=1, size=50, code=codes[0], _=None),
+        routes.stock_list(keyword="", _=None),
+        routes.stock_list(keyword=codes[0][:4], _=None),
+        routes.job_list(_=None),
+        routes.job_logs(job_name="", page=1, size=50, _=None),
+        routes.job_logs(job_name="calc_heat", page=2, size=50, _=None),
+        routes.heat_trends(codes=",".join(codes[:20]), hours=24, points=300, _=None),
+    ]
+    for hours in (6, 24, 24 * 7, 24 * 60):
+        calls.append(routes.heat_trend(codes[0], hours=hours, points=0, _=None))
+
+    async def _api():
+        with db.get_conn() as conn:
+            alert_id = conn.execute("SELECT MAX(id) FROM alerts").fetchone()[0]
+        for call in calls + [routes.alert_detail(alert_id, _=None)]:
+            await call
+    asyncio.run(_api())
+
+    main.job_archive()
+    main.job_cleanup()
+
+
+# ── Plans and timings ────────────────────────────────────────
+
+def _aliases(sql: str) -> dict[str, str]:
+    out = {}
+    for table, alias in _FROM_RE.findall(sql):
+        table = table.split(".")[-1]
+        out[table] = table
+        if alias and alias.upper() not in _KEYWORDS:
+            out[alias] = table
+    return out
+
+
+def _base_table(name: str) -> str:
+    return re.sub(r"_\d{6}$", "", name)
+
+
+def full_scans(sql: str, plan: list[str]) -> list[str]:
+    """
+    Plan lines that read a whole large table. An index-ordered scan counts
+    too unless the statement has no WHERE and a LIMIT, i.e. stops after
+    the first rows it reads.
+    """
+    aliases = _aliases(sql)
+    early_exit = re.search(r"\bLIMIT\b", sql, re.I) and not re.search(r"\bWHERE\b", sql, re.I)
+    subqueries = {m.group(1) for m in map(re.compile(r"^(?:CO-ROUTINE|MATERIALIZE) (\S+)").match, plan) if m}
+    out = []
+    for line in plan:
+        m = _SCAN_RE.match(line)
+        if not m or m.group(1) in subqueries:
+            continue
+        table = _base_table(aliases.get(m.group(1), m.group(1)))
+        if table in LARGE_TABLES and not (m.group(2) and early_exit):
+            out.append(line)
+    return out
+
+
+def _accepted(sql: str) -> str | None:
+    for pattern, reason in ACCEPTED_SCANS:
+        if re.search(pattern, sql):
+            return reason
+    return None
+
+
+def analyze(db_path: str, statements: list[dict], repeat: int) -> list[dict]:
+    """
+    Classify each recorded plan and time the statement on the final
+    database (writes are rolled back). Statements whose tables are gone by
+    then (temp tables, archived partitions) keep their plan but no timing.
+    """
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    results = []
+    try:
+        for st in statements:
+            sql, params, plan = st["sql"], st["params"], st["plan"]
+            scans_ = full_scans(sql, plan)
+            accepted = _accepted(sql) if scans_ else None
+            out = {"site": st["site"], "sql": sql, "calls": st["calls"], "plan": plan, "full_scans": scans_,
+                   "accepted": accepted, "status": "ok" if not scans_ else ("accepted" if accepted else "full_scan")}
+            write = sql.upper().startswith(_WRITES)
+            times = []
+            try:
+                for _ in range(repeat):
+                    if write:
+                        conn.execute("SAVEPOINT query_plans")
+                    t0 = time.perf_counter()
+                    conn.execute(sql, params).fetchall()
+                    times.append(time.perf_counter() - t0)
+                    if write:
+                        conn.execute("ROLLBACK TO query_plans")
+                        conn.execute("RELEASE query_plans")
+            except sqlite3.Error as e:
+                if write:
+                    conn.execute("ROLLBACK TO query_plans")
+                    conn.execute("RELEASE query_plans")
+                out["error"] = str(e)
+            if times:
+                out["median_ms"] = round(statistics.median(times) * 1000, 3)
+            results.append(out)
+    finally:
+        conn.close()
+    return results
+
+
+def _report(results: list[dict]):
+    for r in sorted(results, key=lambda r: -r.get("median_ms", 0)):
+        ms = f"{r['median_ms']:9.2f}ms" if "median_ms" in r else " " * 11
+        print(f"{r['status']:9} {ms}  {r['site']}: {r['sql'][:110]}")
+        for line in r.get("full_scans", []):
+            print(f"{'':23}{line}" + (f"  ({r['accepted']})" if r["accepted"] else ""))
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    ap.add_argument("--codes", type=int, default=1000)
+    ap.add_argument("--days", type=int, default=90, help="calendar days of history (retention)")
+    ap.add_argument("--scans-per-day", type=int, default=12)
+    ap.add_argument("--repeat", type=int, default=5, help="timed runs per statement")
+    ap.add_argument("--out", default="query_plans.json")
+    args = ap.parse_args(argv)
+
+    universe = make_universe(args.codes)
+    recorder = Recorder()
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "query_plans.db")
+        market = FakeMarket(universe).start()
+        try:
+            _point_collectors(market)
+            _reset_state(db_path, market.url + "/webhook", 1000.0)
+            config.get()["data"]["archive_dir"] = os.path.join(tmp, "archive")
+            db.init_db()
+            t0 = time.perf_counter()
+            with db.get_conn() as conn:
+                conn.executemany("INSERT INTO stock_basic(code,name,market) VALUES(:code,:name,:market)", universe)
+                seed_full_history(conn, universe, args.days, args.scans_per_day)
+            print(f"seeded {args.days} days in {time.perf_counter() - t0:.1f}s", flush=True)
+            recorder.start()
+            try:
+                run_workload(universe)
+            finally:
+                recorder.stop()
+        finally:
+            market.stop()
+            db.read_pool.close()
+            if getattr(db._local, "conn", None) is not None:
+                db._local.conn.close()
+                db._local.conn = None
+        results = analyze(db_path, list(recorder.statements.values()), args.repeat)
+
+    _report(results)
+    failed = [r for r in results if r["status"] == "full_scan"]
+    with open(args.out, "w") as f:
+        json.dump({
+            "meta": {"started_at": time.strftime("%Y-%m-%d %H:%M:%S"), "python": sys.version.split()[0],
+                     "sqlite": sqlite3.sqlite_version, "platform": platform.platform(), "args": vars(args)},
+            "statements": results,
+        }, f, indent=2, ensure_ascii=False, default=str)
+    print(f"wrote {args.out}: {len(results)} statements, {len(failed)} full-scan regressions")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
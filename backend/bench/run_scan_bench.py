@@ -0,0 +1,212 @@
+"""
+End-to-end scan benchmark against local fake market-data servers.
+
+Runs the run_scan stages on a fresh database per universe size and reports,
+per stage: wall time, rows written per table, SQL statements executed on
+every connection (scan thread, webhook worker, read pool; each executemany
+row counts) and, with --trace-memory, the Python heap peak. Results are
+written as JSON for regression tracking.
+
+    cd backend && python -m bench.run_scan_bench --sizes 5000,20000,50000 --out scan_bench.json
+"""
+import argparse, json, os, platform, sys, tempfile, threading, time, tracemalloc
+from requests.adapters import HTTPAdapter
+
+import config
+import db
+from bench.fake_servers import FakeMarket
+from bench.universe import make_universe, seed_history
+
+TABLES = ("trade_snapshots", "heat_scores", "sentiment_snapshots", "alerts", "job_logs", "scans") + db.ROLLUP_TABLES
+
+
+def _point_collectors(market: FakeMarket):
+    from collector import trade_collector, guba_collector, xueqiu_collector
+    trade_collector.QT_URL = market.url + "/q="
+    guba_collector.BASE_URL = market.url
+    xueqiu_collector._URL = market.url + "/ths"
+    for session in (trade_collector._SESSION, guba_collector._SESSION, xueqiu_collector._SESSION):
+        session.mount("http://", HTTPAdapter(pool_maxsize=32))
+
+
+def _reset_state(db_path: str, webhook_url: str, guba_rate: float):
+    """Fresh config/connection/in-memory caches for one universe size."""
+    from collector import trade_collector
+    from engine import rolling_stats
+    from api import ranking_cache
+    if getattr(db._local, "conn", None) is not None:
+        db._local.conn.close()
+        db._local.conn = None
+    cfg = config.load()
+    cfg["data"]["db_path"] = db_path
+    cfg["alert"]["webhook_url"] = webhook_url
+    cfg.setdefault("collector", {}).setdefault("rate_limits", {})["guba.eastmoney.com"] = guba_rate
+    trade_collector._batch_size = 0
+    rolling_stats._engine = None
+    ranking_cache._current = None
+
+
+def _counts(conn) -> dict:
+    return {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in TABLES}
+
+
+class _StatementCounter:
+    """SQL statements executed on any connection db opens, via one trace callback per connection."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._paused = threading.local()
+
+    def trace(self, _sql):
+        if not getattr(self._paused, "on", False):
+            with self._lock:
+                self.count += 1
+
+    def paused(self):
+        counter = self
+
+        class _Paused:
+            def __enter__(self):
+                counter._paused.on = True
+
+            def __exit__(self, *exc):
+                counter._paused.on = False
+        return _Paused()
+
+
+_statements = _StatementCounter()
+
+
+class _TracedConnection(db._TimedConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.set_trace_callback(_statements.trace)
+
+
+class Probe:
+    """Per-stage wall time, SQL statements, row deltas and (optionally) Python heap peak."""
+
+    def __init__(self, trace_memory: bool = False):
+        with db.get_conn() as conn:
+            self.conn = conn
+        self.trace_memory = trace_memory
+
+    def run(self, fn) -> dict:
+        with _statements.paused():
+            before = _counts(self.conn)
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        statements = _statements.count
+        t0 = time.perf_counter()
+        fn()
+        wall = time.perf_counter() - t0
+        statements = _statements.count - statements
+        with _statements.paused():
+            after = _counts(self.conn)
+        delta = {t: after[t] - before[t] for t in TABLES if after[t] != before[t]}
+        out = {
+            "wall_s": round(wall, 4),
+            "rows_by_table": delta,
+            "rows_written": sum(v for v in delta.values() if v > 0),
+            "sql_statements": statements,
+        }
+        if self.trace_memory:
+            out["py_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+        return out
+
+
+def bench_size(size: int, args, tmp: str) -> list[dict]:
+    import main
+    from notifier import webhook
+    from engine import rolling_stats
+
+    universe = make_universe(size)
+    market = FakeMarket(universe, latency_ms=args.latency_ms, max_symbols=args.max_symbols).start()
+    try:
+        _point_collectors(market)
+        _reset_state(os.path.join(tmp, f"bench_{size}.db"), market.url + "/webhook", args.guba_rate)
+        config.get()["scanner"]["top_n_for_sentiment"] = args.sentiment_n
+        db.init_db()
+        with db.get_conn() as conn:
+            conn.executemany("INSERT INTO stock_basic(code,name,market) VALUES(:code,:name,:market)", universe)
+            seed_history(conn, universe, args.history_days)
+
+        probe = Probe(args.trace_memory)
+        notify_stats = {}
+        real_notify = webhook.notify
+
+        def timed_notify(*a, **kw):
+            notify_stats.update(probe_nested.run(lambda: real_notify(*a, **kw)))
+
+        probe_nested = Probe(args.trace_memory)
+        webhook.notify = timed_notify
+        runs = []
+        try:
+            warm = probe.run(lambda: rolling_stats.warm_start())
+            for scan in range(args.scans):
+                ctx = main.ScanContext()
+                stages = {"warm_start": warm} if scan == 0 else {}
+                for name, fn in (
+                    ("collect_trade", main.job_collect_trade),
+                    ("calc_heat", main.job_calc_heat),
+                    ("collect_sentiment", main.job_collect_sentiment),
+                    ("calc_heat_2", main.job_calc_heat),
+                    ("detect_anomaly", main.job_detect_anomaly),
+                ):
+                    stages[name] = probe.run(lambda: fn(ctx))
+                if notify_stats:
+                    stages["notify"] = dict(notify_stats, note="included in detect_anomaly")
+                    notify_stats.clear()
+                total = sum(s["wall_s"] for k, s in stages.items() if k != "notify")
+                runs.append({"size": size, "scan": scan + 1, "total_s": round(total, 3), "stages": stages,
+                             "upstream_requests": dict(market.requests)})
+                market.requests.clear()
+                print(f"size={size} scan={scan + 1} total={total:.2f}s " + " ".join(
+                    f"{k}={v['wall_s']:.2f}s" for k, v in stages.items()), flush=True)
+        finally:
+            webhook.notify = real_notify
+        return runs
+    finally:
+        market.stop()
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    ap.add_argument("--sizes", default="5000,20000,50000")
+    ap.add_argument("--scans", type=int, default=2, help="scan cycles per size")
+    ap.add_argument("--history-days", type=int, default=20)
+    ap.add_argument("--sentiment-n", type=int, default=200, help="top_n_for_sentiment")
+    ap.add_argument("--guba-rate", type=float, default=1000.0, help="guba requests/s allowed by the token bucket")
+    ap.add_argument("--latency-ms", type=float, default=0.0, help="simulated upstream latency")
+    ap.add_argument("--max-symbols", type=int, default=0, help="reject quote lists longer than this (0 = no limit)")
+    ap.add_argument("--trace-memory", action="store_true", help="report each stage's Python heap peak (slower)")
+    ap.add_argument("--out", default="scan_bench.json")
+    args = ap.parse_args(argv)
+
+    results = {
+        "meta": {"started_at": time.strftime("%Y-%m-%d %H:%M:%S"), "python": sys.version.split()[0],
+                 "platform": platform.platform(), "args": vars(args)},
+        "runs": [],
+    }
+    # Connections opened from here on (each size resets this thread's) count their statements
+    timed_connection, db._TimedConnection = db._TimedConnection, _TracedConnection
+    if args.trace_memory:
+        tracemalloc.start()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for size in (int(s) for s in args.sizes.split(",")):
+                results["runs"].extend(bench_size(size, args, tmp))
+            if getattr(db._local, "conn", None) is not None:
+                db._local.conn.close()
+                db._local.conn = None
+    finally:
+        db._TimedConnection = timed_connection
+        tracemalloc.stop()
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
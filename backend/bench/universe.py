@@ -0,0 +1,46 @@
+"""Synthetic stock universes and daily heat history for benchmarks."""
+import random
+from bench.payloads import fake_name
+
+
+def make_universe(n: int, seed: int = 1) -> list[dict]:
+    """n unique A-share-like codes (SH 6xxxxx, SZ 0xxxxx/3xxxxx) with names."""
+    rng = random.Random(seed)
+    out = []
+    for i in range(n):
+        code = f"{'603'[i % 3]}{i // 3:05d}"
+        out.append({"code": code, "name": fake_name(rng), "market": "SH" if code.startswith("6") else "SZ"})
+    return out
+
+
+def seed_history(conn, universe: list[dict], days: int, seed: int = 2):
+    """
+    Insert one closing heat snapshot per stock per past day and roll it up.
+    Each day's trade heat comes from calc_trade_heat over quotes drawn like
+    bench.payloads.quote_line, so live scans land inside the baseline and
+    only the occasional stock is flagged, as in production.
+    """
+    import datetime
+    import numpy as np
+    import pandas as pd
+    import partitions
+    from engine import heat_calculator, rollup
+    rng = np.random.default_rng(seed)
+    n = len(universe)
+    today = datetime.date.today()
+    for d in range(days, 0, -1):
+        ts = f"{today - datetime.timedelta(days=d)} 15:00:00"
+        price = rng.uniform(2, 200, n) * rng.uniform(0.9, 1.1, n)
+        quotes = pd.DataFrame({
+            "amount": rng.integers(1000, 5_000_000, n) * price / 100,
+            "turnover_rate": rng.uniform(0.05, 25, n),
+            "volume_ratio": rng.lognormal(0, 0.5, n),
+        })
+        trade = heat_calculator.calc_trade_heat(quotes).to_numpy()
+        rows = [(s["code"], s["name"], th, 0.0, th * 0.6, 0.0, ts) for s, th in zip(universe, trade.tolist())]
+        part = partitions.table(conn, "heat_scores", ts)
+        last_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {part}").fetchone()[0]
+        conn.executemany(
+            f"INSERT INTO {part}(code,name,trade_heat,sentiment_heat,total_heat,zscore,ts) VALUES(?,?,?,?,?,?,?)", rows
+        )
+        rollup.update_since(conn, last_id, part)
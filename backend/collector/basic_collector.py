@@ -1,6 +1,8 @@
 import logging
 import requests
 from db import get_conn
+import metrics
+import stock_search
 
 log = logging.getLogger(__name__)
 
@@ -9,7 +11,7 @@ SINA_URL = "https://vip.stock.finance.sina.com.cn/quotes_service/api/json_v2.php
 
 def sync():
     """Sync all A-share stock basic info from Sina."""
-    session = requests.Session()
+    session = metrics.instrument_session(requests.Session())
     session.headers.update({"User-Agent": "Mozilla/5.0"})
     session.trust_env = False
 
@@ -43,4 +45,5 @@ def sync():
             all_rows,
         )
     log.info("Synced %d stocks to stock_basic", len(all_rows))
+    stock_search.rebuild(all_rows)
     return len(all_rows)
@@ -1,22 +1,67 @@
 import logging, time, random, re, json
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from config import get as get_config
 from db import get_conn
+from collector import ratelimit
+import metrics
+import partitions
+import sentiment_store
 
 log = logging.getLogger(__name__)
 
-_SESSION = requests.Session()
+HOST = "guba.eastmoney.com"
+BASE_URL = f"https://{HOST}"
+_MAX_WORKERS = 16
+_RETRIES = 3
+_THROTTLED = {403, 429, 500, 502, 503, 504}
+_BUDGET_SHARE = 0.5     # of the scan interval one collection may take before skipping the rest
+
+_SESSION = metrics.instrument_session(requests.Session())
 _SESSION.headers.update({
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
     "Referer": "https://guba.eastmoney.com/",
 })
 _SESSION.trust_env = False
+_SESSION.mount("https://", HTTPAdapter(pool_maxsize=_MAX_WORKERS))
+
+
+class _OutOfTime(Exception):
+    pass
+
+
+def _get(url: str, deadline: float) -> requests.Response:
+    """
+    GET through the host's token bucket, backing off on errors and throttling.
+    Raises _OutOfTime instead of waiting past `deadline` (time.monotonic()).
+    """
+    bucket = ratelimit.bucket_for(HOST)
+    for attempt in range(_RETRIES + 1):
+        if not bucket.acquire(deadline):
+            raise _OutOfTime
+        try:
+            resp = _SESSION.get(url, timeout=8)
+            if resp.status_code not in _THROTTLED:
+                bucket.recover()
+                return resp
+            err = f"HTTP {resp.status_code}"
+        except requests.RequestException as e:
+            err = e
+        bucket.penalize()
+        if attempt == _RETRIES:
+            raise RuntimeError(f"gave up after {_RETRIES + 1} attempts: {err}")
+        pause = 0.5 * 2 ** attempt + random.uniform(0, 0.3)
+        if time.monotonic() + pause > deadline:
+            raise _OutOfTime
+        time.sleep(pause)
 
 
-def _fetch_one(code: str) -> dict:
-    """Fetch discussion stats from guba page scraping."""
-    url = f"https://guba.eastmoney.com/list,{code}.html"
+def _fetch_one(code: str, deadline: float) -> dict | None:
+    """Fetch discussion stats from guba page scraping; None if the time budget ran out first."""
+    url = f"{BASE_URL}/list,{code}.html"
     try:
-        resp = _SESSION.get(url, timeout=8)
+        resp = _get(url, deadline)
         m = re.search(r'var\s+article_list\s*=\s*(\{.*?\});', resp.text, re.DOTALL)
         if not m:
             return {"post_count": 0, "comment_count": 0}
@@ -28,22 +73,39 @@ def _fetch_one(code: str) -> dict:
         total_clicks = sum((a.get("post_click_count") or 0) for a in articles)
         total_comments = sum((a.get("post_comment_count") or 0) for a in articles)
         return {"post_count": post_count, "comment_count": total_clicks + total_comments}
+    except _OutOfTime:
+        return None
     except Exception as e:
         log.debug("Guba fetch failed for %s: %s", code, e)
         return {"post_count": 0, "comment_count": 0}
 
 
-def collect(codes: list[str]):
-    results = []
-    for code in codes:
-        info = _fetch_one(code)
-        results.append({"code": code, "source": "guba", **info})
-        time.sleep(random.uniform(0.3, 0.6))
+def collect(codes: list[str], budget: float | None = None):
+    """
+    Fetch and store guba stats for codes. Stops starting requests after
+    `budget` seconds (default: half the scan interval) so a throttled host
+    cannot hold up the next scan; codes left over keep their last sentiment.
+    """
+    cfg = get_config()
+    workers = min(_MAX_WORKERS, max(1, cfg.get("collector", {}).get("guba_workers", 4)))
+    if budget is None:
+        budget = cfg["scanner"]["interval_minutes"] * 60 * _BUDGET_SHARE
+    t0 = time.time()
+    deadline = time.monotonic() + budget
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="guba") as pool:
+        infos = list(pool.map(_fetch_one, codes, [deadline] * len(codes)))
+    results = [{"code": code, "source": "guba", **info} for code, info in zip(codes, infos) if info is not None]
+    log.debug("Fetched %d guba pages in %.1fs with %d workers", len(results), time.time() - t0, workers)
+    skipped = len(codes) - len(results)
+    if skipped:
+        metrics.SENTIMENT_SKIPPED.inc(skipped, source="guba")
+        log.warning("Guba time budget of %.0fs ran out: skipped %d of %d stocks", budget, skipped, len(codes))
     if results:
         with get_conn() as conn:
             conn.executemany(
-                "INSERT INTO sentiment_snapshots(code,source,post_count,comment_count) VALUES(:code,:source,:post_count,:comment_count)",
+                f"INSERT INTO {partitions.table(conn, 'sentiment_snapshots')}(code,source,post_count,comment_count) VALUES(:code,:source,:post_count,:comment_count)",
                 results,
             )
+        sentiment_store.update(results)
     log.info("Collected guba sentiment for %d stocks", len(results))
     return results
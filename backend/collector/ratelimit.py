@@ -0,0 +1,61 @@
+"""
+Per-host token-bucket rate limiting shared by collector worker threads.
+Rates come from collector.rate_limits in config.yaml (requests/second).
+"""
+import threading, time
+from config import get as get_config
+
+DEFAULT_RATE = 2.0
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float | None = None):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline: float | None = None) -> bool:
+        """
+        Block until a request may be sent. With a `deadline` (time.monotonic())
+        give up and return False as soon as the wait would run past it.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def penalize(self):
+        """Halve the rate after an error or throttling response (floor: 1/10 of the base rate)."""
+        with self._lock:
+            self.rate = max(self.base_rate / 10, self.rate / 2)
+            self._tokens = min(self._tokens, 0)
+
+    def recover(self):
+        """Creep back towards the configured rate after a success."""
+        with self._lock:
+            if self.rate < self.base_rate:
+                self.rate = min(self.base_rate, self.rate * 1.1)
+
+
+_buckets: dict[str, TokenBucket] = {}
+_lock = threading.Lock()
+
+
+def bucket_for(host: str) -> TokenBucket:
+    rate = get_config().get("collector", {}).get("rate_limits", {}).get(host, DEFAULT_RATE)
+    with _lock:
+        b = _buckets.get(host)
+        if b is None or b.base_rate != rate:
+            b = _buckets[host] = TokenBucket(rate)
+        return b
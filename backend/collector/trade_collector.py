@@ -1,12 +1,43 @@
-import logging
+import logging, time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
+from config import get as get_config
 from db import get_conn
+import scans
+import partitions
+import metrics
 
 log = logging.getLogger(__name__)
 
 QT_URL = "https://qt.gtimg.cn/q="
 
+_MIN_BATCH = 10
+_MAX_WORKERS = 32
+
+_SESSION = metrics.instrument_session(requests.Session())
+_SESSION.headers.update({"User-Agent": "Mozilla/5.0"})
+_SESSION.trust_env = False
+_SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=_MAX_WORKERS))
+
+# Largest symbol list Tencent accepted on the last scan; shrinks on rejected lists, grows back slowly
+_batch_size = 0
+
+# Numeric quote fields and their "~"-separated index in a Tencent quote line
+_FIELDS = (
+    ("price", 3),
+    ("change_pct", 32),
+    ("volume", 6),          # 成交量(手)
+    ("amount", 37),         # 成交额(万)
+    ("turnover_rate", 38),  # 换手率
+    ("volume_ratio", 49),   # 量比
+)
+_FIELD_IDX = tuple(i for _, i in _FIELDS)
+_LAST_FIELD = max(_FIELD_IDX)
+QUOTE_DTYPE = np.dtype([("code", "U8"), ("name", "U16")] + [(f, "f8") for f, _ in _FIELDS])
+
 
 def _build_symbol(code: str) -> str:
     if code.startswith("6") or code.startswith("9"):
@@ -15,7 +46,10 @@ def _build_symbol(code: str) -> str:
 
 
 def _parse_line(line: str) -> dict | None:
-    """Parse one Tencent quote line: v_sh600519="1~name~code~price~..."."""
+    """Parse one Tencent quote line: v_sh600519="1~name~code~price~...".
+
+    Reference implementation for bench/bench_parser.py; collect() uses _parse_payload.
+    """
     line = line.strip().rstrip(";")
     if "=" not in line or '~' not in line:
         return None
@@ -38,22 +72,98 @@ def _parse_line(line: str) -> dict | None:
         return None
 
 
-def _fetch_batch(symbols: list[str]) -> list[dict]:
+def _parse_payload(data: bytes, encoding: str = "gbk") -> np.ndarray:
+    """
+    Parse a raw Tencent response into a QUOTE_DTYPE structured array.
+    Splits each record only up to the last needed field and decodes just the
+    code and name; suspended stocks (price 0) are skipped.
+
+    "~" (0x7E) is also a GBK trail byte ('硚' is b"\\xb3~"), so a name can
+    split in two. Such a record shows up as a field 2 that is not a 6-digit
+    code and is split again after decoding.
+    """
+    rows = []
+    for rec in data.split(b";"):
+        start = rec.find(b'"') + 1
+        if not start:
+            continue
+        end = rec.rfind(b'"')
+        body = rec[start:end if end >= start else len(rec)]
+        p = body.split(b"~", _LAST_FIELD + 1)
+        if len(p) > 2 and not (len(p[2]) == 6 and p[2].isdigit()):
+            p = body.decode(encoding, "replace").split("~", _LAST_FIELD + 1)
+        if len(p) <= _LAST_FIELD:
+            continue
+        try:
+            vals = tuple(float(p[i] or 0) for i in _FIELD_IDX)
+        except ValueError:
+            continue
+        if vals[0] > 0:
+            code, name = p[2], p[1]
+            if isinstance(code, bytes):
+                code, name = code.decode("ascii", "replace"), name.decode(encoding, "replace")
+            rows.append((code, name) + vals)
+    return np.array(rows, dtype=QUOTE_DTYPE)
+
+
+def _count_records(data: bytes) -> int:
+    """Quote records in a response, including v_pv_none_match answers for unknown symbols."""
+    return data.count(b'="')
+
+
+def _fetch_batch(symbols: list[str]) -> tuple[np.ndarray | None, str]:
+    """
+    Fetch one symbol list. Returns (rows, status): "ok"; "rejected" when
+    Tencent refused the list (4xx) or answered fewer records than asked,
+    i.e. the list is too long; "failed" for transport errors, 429 and 5xx.
+    """
     try:
-        r = requests.get(QT_URL + ",".join(symbols), timeout=15)
-        results = []
-        for line in r.text.split(";"):
-            d = _parse_line(line)
-            if d and d["price"] > 0:
-                results.append(d)
-        return results
-    except Exception as e:
-        log.warning("Tencent batch fetch failed: %s", e)
-        return []
+        r = _SESSION.get(QT_URL + ",".join(symbols), timeout=15)
+    except requests.RequestException as e:
+        log.warning("Tencent batch fetch failed (%d symbols): %s", len(symbols), e)
+        return None, "failed"
+    if r.status_code >= 400:
+        rejected = r.status_code < 500 and r.status_code != 429
+        log.warning("Tencent batch fetch %s (%d symbols): HTTP %d",
+                    "rejected" if rejected else "failed", len(symbols), r.status_code)
+        return None, "rejected" if rejected else "failed"
+    answered = _count_records(r.content)
+    if answered < len(symbols):
+        log.warning("Tencent answered %d of %d symbols", answered, len(symbols))
+        return None, "rejected"
+    return _parse_payload(r.content, r.encoding or "gbk"), "ok"
+
+
+def _fetch_adaptive(symbols: list[str]) -> tuple[np.ndarray, int | None]:
+    """Fetch a batch, splitting it in halves only when Tencent rejects the list size.
+
+    Returns (rows, limit): the size of the largest list Tencent accepted, or
+    None when nothing was learnt about the size. Failed requests are retried
+    once, then the batch is skipped without splitting: a timeout says nothing
+    about the list size, and splitting would multiply the waiting.
+    """
+    t0 = time.time()
+    rows, status = _fetch_batch(symbols)
+    if status == "failed":
+        rows, status = _fetch_batch(symbols)
+    log.debug("Tencent batch of %d symbols -> %s in %.2fs",
+              len(symbols), status if rows is None else f"{len(rows)} rows", time.time() - t0)
+    if status == "ok":
+        return rows, len(symbols)
+    if status == "failed":
+        return np.empty(0, dtype=QUOTE_DTYPE), None
+    if len(symbols) <= _MIN_BATCH:
+        return np.empty(0, dtype=QUOTE_DTYPE), 0
+    mid = len(symbols) // 2
+    left, left_ok = _fetch_adaptive(symbols[:mid])
+    right, right_ok = _fetch_adaptive(symbols[mid:])
+    known = [ok for ok in (left_ok, right_ok) if ok is not None]
+    return np.concatenate([left, right]), max(known) if known else None
 
 
 def collect() -> pd.DataFrame:
     """Fetch all A-share quotes from Tencent and store snapshot."""
+    global _batch_size
     with get_conn() as conn:
         rows = conn.execute("SELECT code FROM stock_basic").fetchall()
     codes = [r["code"] for r in rows]
@@ -62,22 +172,40 @@ def collect() -> pd.DataFrame:
         log.warning("No stocks in stock_basic, run sync_basic first")
         return pd.DataFrame()
 
-    all_rows = []
-    batch_size = 50
-    for i in range(0, len(codes), batch_size):
-        batch = [_build_symbol(c) for c in codes[i:i + batch_size]]
-        all_rows.extend(_fetch_batch(batch))
+    cfg = get_config().get("collector", {})
+    max_batch = max(_MIN_BATCH, cfg.get("trade_batch_size", 80))
+    workers = min(_MAX_WORKERS, max(1, cfg.get("trade_workers", 8)))
+    batch_size = min(_batch_size or max_batch, max_batch)
+
+    symbols = [_build_symbol(c) for c in codes]
+    batches = [symbols[i:i + batch_size] for i in range(0, len(symbols), batch_size)]
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="qt") as pool:
+        results = list(pool.map(_fetch_adaptive, batches))
+
+    quotes = np.concatenate([rows for rows, _ in results])
+    shrunk = [ok for (_, ok), b in zip(results, batches) if ok is not None and ok < len(b)]
+    if shrunk:
+        # Tencent rejected full-size lists: remember the size that worked
+        _batch_size = max(_MIN_BATCH, min(shrunk))
+    else:
+        _batch_size = min(max_batch, batch_size + max(1, batch_size // 4))
+    log.info("Fetched %d batches (size=%d, workers=%d) in %.1fs, next batch size %d",
+             len(batches), batch_size, workers, time.time() - t0, _batch_size)
 
-    if not all_rows:
+    if not len(quotes):
         log.warning("No trade data fetched")
         return pd.DataFrame()
 
-    df = pd.DataFrame(all_rows)
+    df = pd.DataFrame(quotes)
     with get_conn() as conn:
+        scan_id = scans.begin(conn)
         conn.executemany(
-            "INSERT INTO trade_snapshots(code,name,price,change_pct,volume,amount,turnover_rate,volume_ratio) "
-            "VALUES(:code,:name,:price,:change_pct,:volume,:amount,:turnover_rate,:volume_ratio)",
-            all_rows,
+            f"INSERT INTO {partitions.for_scan(conn, 'trade_snapshots', scan_id)}(code,name,price,change_pct,volume,amount,turnover_rate,volume_ratio,scan_id) "
+            "VALUES(?,?,?,?,?,?,?,?,?)",
+            (row + (scan_id,) for row in quotes.tolist()),
         )
-    log.info("Collected %d trade records from Tencent", len(all_rows))
+        scans.mark(conn, scan_id, "trade")
+    df["scan_id"] = scan_id
+    log.info("Collected %d trade records from Tencent (scan %d)", len(quotes), scan_id)
     return df
@@ -6,10 +6,13 @@
 import logging
 import requests
 from db import get_conn
+import metrics
+import partitions
+import sentiment_store
 
 log = logging.getLogger(__name__)
 
-_SESSION = requests.Session()
+_SESSION = metrics.instrument_session(requests.Session())
 _SESSION.headers.update({"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"})
 _SESSION.trust_env = False
 
@@ -47,8 +50,9 @@ def collect(codes: list[str] = None):
     if results:
         with get_conn() as conn:
             conn.executemany(
-                "INSERT INTO sentiment_snapshots(code,source,post_count,comment_count) VALUES(:code,:source,:post_count,:comment_count)",
+                f"INSERT INTO {partitions.table(conn, 'sentiment_snapshots')}(code,source,post_count,comment_count) VALUES(:code,:source,:post_count,:comment_count)",
                 results,
             )
+        sentiment_store.update(results)
     log.info("Collected THS hot sentiment for %d stocks", len(results))
     return results
@@ -1,9 +1,15 @@
-import sqlite3, os, threading
+import asyncio, sqlite3, os, re, threading, time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from config import get as get_config
+import metrics
+import partitions
+import archive
 
 _local = threading.local()
 
+ROLLUP_TABLES = ("heat_rollup_5m", "heat_rollup_1h", "heat_rollup_1d")
+
 
 def _db_path():
     p = get_config()["data"]["db_path"]
@@ -13,10 +19,112 @@ def _db_path():
     return full
 
 
+_INSERT_RE = re.compile(r"^\s*(?:INSERT|REPLACE)\s+(?:OR\s+\w+\s+)?(?:INTO\s+)?(\w+)", re.IGNORECASE)
+_insert_tables: dict[str, str | None] = {}
+
+
+def _insert_table(sql: str) -> str | None:
+    table = _insert_tables.get(sql, False)
+    if table is False:
+        m = _INSERT_RE.match(sql)
+        table = _insert_tables[sql] = m.group(1) if m else None
+    return table
+
+
+_sites: dict[str, str] = {}
+_MAX_SITES = 4096
+
+
+def _site(sql: str) -> str:
+    """Call site of the statement's caller, walked once per SQL text."""
+    site = _sites.get(sql)
+    if site is None:
+        if len(_sites) >= _MAX_SITES:    # generated IN (?,?,..) lists: don't grow without bound
+            _sites.clear()
+        site = _sites[sql] = metrics.call_site(3)
+    return site
+
+
+class _TimedCursor(sqlite3.Cursor):
+    """Cursor that reports statement and fetch time to metrics under its call site."""
+    site = None
+
+    def _record(self, t0: float):
+        metrics.QUERY_DURATION.observe(time.perf_counter() - t0, site=self.site)
+
+    def execute(self, sql, params=()):
+        self.site = self.site or _site(sql)
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self._record(t0)
+            table = _insert_table(sql)
+            if table and self.rowcount > 0:
+                metrics.ROWS_INSERTED.inc(self.rowcount, table=table)
+
+    def executemany(self, sql, seq):
+        self.site = self.site or _site(sql)
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq)
+        finally:
+            self._record(t0)
+            table = _insert_table(sql)
+            if table and self.rowcount > 0:
+                metrics.ROWS_INSERTED.inc(self.rowcount, table=table)
+
+    def fetchone(self):
+        t0 = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._record(t0)
+
+    def fetchmany(self, size=None):
+        t0 = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            self._record(t0)
+
+    def fetchall(self):
+        t0 = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._record(t0)
+
+
+class _TimedConnection(sqlite3.Connection):
+    """Connection whose shortcut execute methods go through _TimedCursor."""
+
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        cur = self.cursor()
+        cur.site = _site(sql)
+        return cur.execute(sql, params)
+
+    def executemany(self, sql, seq):
+        cur = self.cursor()
+        cur.site = _site(sql)
+        return cur.executemany(sql, seq)
+
+    def executescript(self, script):
+        t0 = time.perf_counter()
+        try:
+            return super().executescript(script)
+        finally:
+            metrics.QUERY_DURATION.observe(time.perf_counter() - t0, site=metrics.call_site())
+
+
 @contextmanager
 def get_conn():
+    """This thread's read-write connection (scheduler jobs, collectors); commits on exit."""
     if not hasattr(_local, "conn") or _local.conn is None:
-        _local.conn = sqlite3.connect(_db_path())
+        _local.conn = sqlite3.connect(_db_path(), factory=_TimedConnection)
         _local.conn.row_factory = sqlite3.Row
         _local.conn.execute("PRAGMA journal_mode=WAL")
     try:
@@ -27,6 +135,96 @@ def get_conn():
         raise
 
 
+class ReadPool:
+    """
+    Read-only WAL connections for the API. Each belongs to one worker of a
+    dedicated executor, so route queries run off the event loop, at most
+    `size` at a time, and never share a connection with the writers.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self._executor: ThreadPoolExecutor | None = None
+        self._local = threading.local()
+        self._conns: list[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                f"file:{_db_path()}?mode=ro", uri=True, factory=_TimedConnection, check_same_thread=False
+            )
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self.size = max(1, get_config()["data"].get("read_pool_size", 4))
+                self._executor = ThreadPoolExecutor(self.size, thread_name_prefix="db-read")
+                metrics.DB_POOL_SIZE.set(self.size)
+            return self._executor
+
+    def _call(self, fn, args, queued_at: float):
+        metrics.DB_POOL_WAITING.dec()
+        metrics.DB_POOL_WAIT.observe(time.perf_counter() - queued_at)
+        metrics.DB_POOL_IN_USE.inc()
+        try:
+            return fn(self._connect(), *args)
+        finally:
+            metrics.DB_POOL_IN_USE.dec()
+
+    @staticmethod
+    def _done(future):
+        # A call cancelled while still queued never reaches _call to leave the queue
+        if future.cancelled():
+            metrics.DB_POOL_WAITING.dec()
+
+    async def run(self, fn, *args):
+        """Await fn(conn, *args) on a pooled read-only connection."""
+        executor = self._get_executor()
+        metrics.DB_POOL_WAITING.inc()
+        future = executor.submit(self._call, fn, args, time.perf_counter())
+        future.add_done_callback(self._done)
+        return await asyncio.wrap_future(future)
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            conns, self._conns = self._conns, []
+        if executor:
+            executor.shutdown(wait=True)
+        for conn in conns:
+            conn.close()
+        self._local = threading.local()
+
+
+read_pool = ReadPool()
+read = read_pool.run
+
+
+def query_frame(conn, sql: str, params=()):
+    """Run a query straight into a DataFrame, skipping the per-row sqlite3.Row/dict step."""
+    import pandas as pd
+    cur = conn.cursor()
+    cur.row_factory = None
+    if isinstance(cur, _TimedCursor):
+        cur.site = _site(sql)
+    cur.execute(sql, params)
+    cols = [d[0] for d in cur.description]
+    return pd.DataFrame.from_records(cur.fetchall(), columns=cols)
+
+
+def _add_column(conn, table: str, column: str, decl: str):
+    cols = {r["name"] for r in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in cols:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
 def init_db():
     with get_conn() as conn:
         conn.executescript("""
@@ -38,42 +236,6 @@ def init_db():
             updated_at DATETIME DEFAULT (datetime('now','localtime'))
         );
 
-        CREATE TABLE IF NOT EXISTS trade_snapshots (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            code TEXT NOT NULL,
-            name TEXT,
-            price REAL,
-            change_pct REAL,
-            volume REAL,
-            amount REAL,
-            turnover_rate REAL,
-            volume_ratio REAL,
-            ts DATETIME DEFAULT (datetime('now','localtime'))
-        );
-        CREATE INDEX IF NOT EXISTS idx_trade_code_ts ON trade_snapshots(code, ts);
-
-        CREATE TABLE IF NOT EXISTS sentiment_snapshots (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            code TEXT NOT NULL,
-            source TEXT NOT NULL,
-            post_count INTEGER DEFAULT 0,
-            comment_count INTEGER DEFAULT 0,
-            ts DATETIME DEFAULT (datetime('now','localtime'))
-        );
-        CREATE INDEX IF NOT EXISTS idx_sent_code_ts ON sentiment_snapshots(code, ts);
-
-        CREATE TABLE IF NOT EXISTS heat_scores (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            code TEXT NOT NULL,
-            name TEXT,
-            trade_heat REAL,
-            sentiment_heat REAL,
-            total_heat REAL,
-            zscore REAL,
-            ts DATETIME DEFAULT (datetime('now','localtime'))
-        );
-        CREATE INDEX IF NOT EXISTS idx_heat_code_ts ON heat_scores(code, ts);
-
         CREATE TABLE IF NOT EXISTS alerts (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             code TEXT NOT NULL,
@@ -86,6 +248,7 @@ def init_db():
             ts DATETIME DEFAULT (datetime('now','localtime'))
         );
         CREATE INDEX IF NOT EXISTS idx_alerts_ts ON alerts(ts);
+        CREATE INDEX IF NOT EXISTS idx_alerts_code_ts ON alerts(code, ts);
 
         CREATE TABLE IF NOT EXISTS job_logs (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -96,10 +259,61 @@ def init_db():
             ts DATETIME DEFAULT (datetime('now','localtime'))
         );
         CREATE INDEX IF NOT EXISTS idx_job_logs_ts ON job_logs(ts);
+        CREATE INDEX IF NOT EXISTS idx_job_logs_name_ts ON job_logs(job_name, ts);
+        CREATE INDEX IF NOT EXISTS idx_job_logs_status_ts ON job_logs(status, ts);
+
+        CREATE TABLE IF NOT EXISTS scans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started_at DATETIME DEFAULT (datetime('now','localtime')),
+            trade_at DATETIME,
+            heat_at DATETIME,
+            sentiment_at DATETIME,
+            anomaly_at DATETIME
+        );
+        CREATE INDEX IF NOT EXISTS idx_scans_started ON scans(started_at);
         """)
+        # scan_id stamps (see scans.py); added in place for databases created before scans existed
+        _add_column(conn, "alerts", "scan_id", "INTEGER")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_alerts_scan ON alerts(scan_id, code)")
+        # Webhook outcome: NULL (not sent), 'pending', 'sent' or 'failed' (see notifier/webhook.py)
+        _add_column(conn, "alerts", "delivery_status", "TEXT")
+        # Only undelivered alerts, for the webhook worker's restart recovery
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_alerts_pending ON alerts(ts) WHERE delivery_status='pending'")
+        # Per-code heat rollups, last snapshot per bucket (see engine/rollup.py)
+        for tbl in ROLLUP_TABLES:
+            conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS {tbl} (
+                code TEXT NOT NULL,
+                bucket DATETIME NOT NULL,
+                trade_heat REAL,
+                sentiment_heat REAL,
+                total_heat REAL,
+                zscore REAL,
+                max_total_heat REAL,
+                samples INTEGER DEFAULT 0,
+                last_id INTEGER,
+                PRIMARY KEY (code, bucket)
+            );
+            CREATE INDEX IF NOT EXISTS idx_{tbl}_last_id ON {tbl}(last_id);
+            """)
+        # trade_snapshots, sentiment_snapshots and heat_scores: monthly partitions behind views
+        if "heat_scores" in partitions.init(conn):
+            # Legacy heat ids moved into their month's id range; follow them in the rollups
+            for tbl in ROLLUP_TABLES:
+                conn.execute(
+                    f"UPDATE {tbl} SET last_id = last_id + {partitions.ID_BASE_SQL.format(col='bucket')} WHERE last_id < ?",
+                    (1 << partitions.ID_BITS,),
+                )
 
 
 def cleanup_old_data(days: int = 90):
+    """Drop snapshot partitions entirely older than `days` (so up to one extra month is kept); trim the small tables."""
     with get_conn() as conn:
-        for tbl in ("trade_snapshots", "sentiment_snapshots", "heat_scores", "alerts", "job_logs"):
-            conn.execute(f"DELETE FROM {tbl} WHERE ts < datetime('now','localtime','-{days} days')")
+        cutoff = conn.execute(f"SELECT datetime('now','localtime','-{days} days')").fetchone()[0]
+        partitions.drop_before(conn, cutoff)
+        archive.purge_before(cutoff[:10])
+        for tbl in ("alerts", "job_logs"):
+            conn.execute(f"DELETE FROM {tbl} WHERE ts < ?", (cutoff,))
+        for tbl in ROLLUP_TABLES:
+            conn.execute(f"DELETE FROM {tbl} WHERE bucket < datetime('now','localtime','-{days} days')")
+        conn.execute(f"DELETE FROM scans WHERE started_at < datetime('now','localtime','-{days} days')")
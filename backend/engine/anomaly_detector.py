@@ -1,7 +1,10 @@
 import logging
 import numpy as np
+import pandas as pd
 from config import get as get_config
 from db import get_conn
+from engine import rollup, rolling_stats
+import partitions
 
 log = logging.getLogger(__name__)
 
@@ -25,6 +28,24 @@ def _calc_stats(current: float, past: list[float]) -> dict:
     return {"zscore": zscore, "box_cv": box_cv, "box_upper": box_upper, "box_lower": box_lower, "breakout": breakout, "mean": mean, "std": std}
 
 
+def _anomaly_record(row, current_trade, current_total, zscore, stats, is_zscore_anomaly, is_breakout) -> dict:
+    return {
+        "code": row["code"],
+        "name": row.get("name", ""),
+        "total_heat": round(current_total, 4),
+        "trade_heat": round(current_trade, 4),
+        "zscore": round(zscore, 2),
+        "change_pct": row.get("change_pct", 0),
+        "volume_ratio": row.get("volume_ratio", 0),
+        "breakout": round(stats["breakout"], 2),
+        "box_cv": round(stats["box_cv"], 4),
+        "box_upper": round(stats["box_upper"], 4),
+        "box_lower": round(stats["box_lower"], 4),
+        "hist_mean": round(stats["mean"], 4),
+        "anomaly_type": "box_breakout" if (is_breakout and not is_zscore_anomaly) else "zscore",
+    }
+
+
 def detect(heat_df) -> list[dict]:
     """
     Detect anomalies by comparing today's trade_heat against
@@ -33,13 +54,213 @@ def detect(heat_df) -> list[dict]:
     """
     if heat_df.empty:
         return []
+    mode = get_config()["detection"].get("engine", "online")
+    if mode == "online" and {"id", "ts"}.issubset(heat_df.columns):
+        anomalies = detect_online(heat_df)
+    elif mode == "rowwise":
+        anomalies = detect_rowwise(heat_df)
+    else:
+        anomalies = detect_batch(heat_df)
+    log.info("Detected %d anomalies", len(anomalies))
+    return anomalies
+
+
+def _load_history_matrix(conn, codes: list[str], window: int):
+    """
+    Load daily trade_heat for all codes in one query on the daily rollup.
+    Returns (matrix, latest_ids): matrix[i] holds the `window` most recent
+    past days of codes[i] (newest first, NaN-padded), excluding the latest day;
+    latest_ids[i] is the id of the code's newest heat row (0 if none).
+    """
+    rows = conn.execute(
+        "SELECT code, last_id AS id, trade_heat FROM ("
+        "SELECT code, last_id, trade_heat, "
+        "ROW_NUMBER() OVER (PARTITION BY code ORDER BY bucket DESC) AS rn FROM heat_rollup_1d"
+        ") WHERE rn <= ? ORDER BY code, rn",
+        (window + 1,),
+    ).fetchall()
+
+    index = {c: i for i, c in enumerate(codes)}
+    matrix = np.full((len(codes), window), np.nan)
+    latest_ids = np.zeros(len(codes), dtype=np.int64)
+    prev_code, rank = None, 0
+    for r in rows:
+        code = r["code"]
+        rank = rank + 1 if code == prev_code else 0
+        prev_code = code
+        i = index.get(code)
+        if i is None or rank > window:
+            continue
+        if rank == 0:
+            latest_ids[i] = r["id"]
+        elif r["trade_heat"] is not None:
+            matrix[i, rank - 1] = r["trade_heat"]
+    return matrix, latest_ids
+
+
+def _derive_stats(current, mean, std, box_upper, box_lower) -> dict:
+    """Vectorized _calc_stats on precomputed window moments and quartiles."""
+    iqr = box_upper - box_lower
+    with np.errstate(divide="ignore", invalid="ignore"):
+        zscore = np.where(
+            std > 1e-9, (current - mean) / std,
+            np.where(current > mean, (current - mean) / 1e-9, 0.0),
+        )
+        box_cv = np.where(mean > 1e-9, std / mean, 999)
+        breakout = np.where(
+            iqr > 1e-9, np.maximum(0, (current - box_upper) / iqr),
+            np.where((current > mean) & (mean > 1e-9), (current - mean) / mean * 10, 0.0),
+        )
+    return {"zscore": zscore, "box_cv": box_cv, "box_upper": box_upper, "box_lower": box_lower,
+            "breakout": breakout, "mean": mean, "std": std}
+
+
+def _batch_stats(current: np.ndarray, past: np.ndarray) -> dict:
+    """Vectorized _calc_stats: one row of `past` per element of `current`."""
+    return _derive_stats(
+        current, np.nanmean(past, axis=1), np.nanstd(past, axis=1),
+        np.nanpercentile(past, 75, axis=1), np.nanpercentile(past, 25, axis=1),
+    )
+
+
+def rolling_zscores(daily: pd.DataFrame) -> pd.Series:
+    """
+    Z-score of every (code, day) row of `daily` (columns code, day,
+    trade_heat) against the code's previous `window_size` days in the frame,
+    as detection computes it for the latest day; 0 where history is short.
+    Used to fill baselines for many historical days at once.
+    """
+    cfg = get_config()["detection"]
+    window, min_pts = cfg["window_size"], max(1, cfg["min_data_points"])
+    daily = daily.sort_values(["code", "day"])
+    past = daily.groupby("code")["trade_heat"].shift(1)
+    roll = past.groupby(daily["code"]).rolling(window, min_periods=1)
+    n = roll.count().to_numpy()
+    stats = _derive_stats(
+        daily["trade_heat"].to_numpy(dtype=float), roll.mean().to_numpy(), roll.std(ddof=0).to_numpy(),
+        roll.quantile(0.75).to_numpy(), roll.quantile(0.25).to_numpy(),
+    )
+    z = np.where(n >= min_pts, stats["zscore"], 0.0)
+    return pd.Series(z, index=daily.index)
+
+
+def _write_zscores(conn, zscores: np.ndarray, ids: np.ndarray):
+    pairs = list(zip(zscores.tolist(), ids.tolist()))
+    for part, rows in partitions.group_by_id("heat_scores", pairs, lambda p: p[1]).items():
+        conn.executemany(f"UPDATE {part} SET zscore=? WHERE id=?", rows)
+    rollup.set_zscores(conn, pairs)
+
+
+def _evaluate(heat_df, idx: np.ndarray, cur: np.ndarray, total: np.ndarray, stats: dict, threshold: float) -> list[dict]:
+    """Apply the anomaly rules to stats computed for heat_df rows `idx`."""
+    mean, zscore = stats["mean"], stats["zscore"]
+    is_zscore_anomaly = zscore >= threshold
+    is_breakout = (stats["box_cv"] < 0.3) & (stats["breakout"] >= 3.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        heat_lift = np.where(mean > 1e-4, (cur - mean) / mean, 0)
+    is_meaningful = (heat_lift > 1.0) & (cur > 0.08)
+    is_meaningful &= (mean <= 0.05) | (heat_lift > 2.0)
+
+    anomalies = []
+    for j in np.flatnonzero((is_zscore_anomaly | is_breakout) & is_meaningful):
+        i = idx[j]
+        row_stats = {k: float(v[j]) for k, v in stats.items()}
+        anomalies.append(_anomaly_record(
+            heat_df.iloc[i], float(cur[j]), float(total[i]), row_stats["zscore"], row_stats,
+            bool(is_zscore_anomaly[j]), bool(is_breakout[j]),
+        ))
+    anomalies.sort(key=lambda x: x["zscore"], reverse=True)
+    return anomalies
+
+
+def _heat_arrays(heat_df):
+    total = heat_df["total_heat"].to_numpy(dtype=float)
+    trade = heat_df["trade_heat"].to_numpy(dtype=float) if "trade_heat" in heat_df else total
+    return total, trade
+
+
+def detect_batch(heat_df) -> list[dict]:
+    """Same rules as detect_rowwise, evaluated for all stocks at once."""
+    cfg = get_config()["detection"]
+    window = cfg["window_size"]
+    min_pts = max(1, cfg["min_data_points"])
+
+    heat_df = heat_df.reset_index(drop=True)
+    codes = heat_df["code"].tolist()
+    total, trade = _heat_arrays(heat_df)
+
+    with get_conn() as conn:
+        matrix, latest_ids = _load_history_matrix(conn, codes, window)
+        valid = np.count_nonzero(~np.isnan(matrix), axis=1) >= min_pts
+        idx = np.flatnonzero(valid)
+        if not len(idx):
+            return []
+        cur = trade[idx]
+        stats = _batch_stats(cur, matrix[idx])
+        _write_zscores(conn, stats["zscore"], latest_ids[idx])
+
+    return _evaluate(heat_df, idx, cur, total, stats, cfg["zscore_threshold"])
+
+
+def detect_online(heat_df) -> list[dict]:
+    """
+    Same rules against the in-memory rolling baseline. Needs heat_df to carry
+    the heat row `id` and `ts`; the first scan after a day boundary is
+    cross-checked against the SQL baseline and rewarms the engine on drift.
+    """
+    cfg = get_config()["detection"]
+    min_pts = max(1, cfg["min_data_points"])
+
+    heat_df = heat_df.reset_index(drop=True)
+    codes = heat_df["code"].tolist()
+    total, trade = _heat_arrays(heat_df)
+    day = str(heat_df["ts"].max())[:10]
+
+    engine = rolling_stats.get(day)
+    if engine.observe(day, codes, trade) and not check_consistency(engine, codes):
+        engine = rolling_stats.warm_start(day)
+
+    base = engine.baseline(codes)
+    idx = np.flatnonzero(base["n"] >= min_pts)
+    if not len(idx):
+        return []
+    cur = trade[idx]
+    stats = _derive_stats(cur, base["mean"][idx], base["std"][idx], base["box_upper"][idx], base["box_lower"][idx])
+    with get_conn() as conn:
+        _write_zscores(conn, stats["zscore"], heat_df["id"].to_numpy(dtype=np.int64)[idx])
+
+    return _evaluate(heat_df, idx, cur, total, stats, cfg["zscore_threshold"])
 
+
+def check_consistency(engine, codes: list[str], tol: float = 1e-6) -> bool:
+    """Compare the online baseline with the one derived from heat_rollup_1d."""
+    with get_conn() as conn:
+        matrix, _ = _load_history_matrix(conn, codes, engine.window)
+    sql_n = np.count_nonzero(~np.isnan(matrix), axis=1)
+    has = sql_n > 0
+    base = engine.baseline(codes)
+    with np.errstate(invalid="ignore"):
+        sql_mean = np.nanmean(matrix[has], axis=1)
+        sql_std = np.nanstd(matrix[has], axis=1)
+    bad = (base["n"][has] != sql_n[has]) \
+        | ~np.isclose(base["mean"][has], sql_mean, rtol=0, atol=tol) \
+        | ~np.isclose(base["std"][has], sql_std, rtol=0, atol=tol)
+    n_bad = int(np.count_nonzero(bad)) + int(np.count_nonzero(base["n"][~has]))
+    if n_bad:
+        log.warning("Rolling baseline drifted from SQL baseline for %d/%d stocks, rewarming", n_bad, len(codes))
+        return False
+    return True
+
+
+def detect_rowwise(heat_df) -> list[dict]:
+    """Reference implementation: one history query and one update per stock."""
     cfg = get_config()["detection"]
     threshold = cfg["zscore_threshold"]
     window = cfg["window_size"]
-    min_pts = cfg["min_data_points"]
+    min_pts = max(1, cfg["min_data_points"])
 
     anomalies = []
+    updates = []
     with get_conn() as conn:
         for _, row in heat_df.iterrows():
             code = row["code"]
@@ -48,17 +269,15 @@ def detect(heat_df) -> list[dict]:
 
             # Get daily-deduplicated history: one record per day (latest per day)
             history = conn.execute(
-                "SELECT trade_heat, total_heat, DATE(ts) as day "
-                "FROM heat_scores WHERE code=? AND id IN "
-                "(SELECT MAX(id) FROM heat_scores WHERE code=? GROUP BY DATE(ts)) "
-                "ORDER BY day DESC LIMIT ?",
-                (code, code, window + 1),
+                "SELECT trade_heat, total_heat, bucket as day, last_id "
+                "FROM heat_rollup_1d WHERE code=? ORDER BY bucket DESC LIMIT ?",
+                (code, window + 1),
             ).fetchall()
+            if not history:
+                continue
 
             # Exclude today, keep only past days
-            today_day = None
-            if history:
-                today_day = history[0]["day"]
+            today_day = history[0]["day"]
             past_trade = [h["trade_heat"] for h in history[1:] if h["trade_heat"] is not None]
 
             if len(past_trade) < min_pts:
@@ -82,28 +301,14 @@ def detect(heat_df) -> list[dict]:
                 is_meaningful = is_meaningful and heat_lift > 2.0  # need 3x for warm stocks
 
             # Update zscore in db
-            conn.execute(
-                "UPDATE heat_scores SET zscore=? WHERE code=? AND id=(SELECT MAX(id) FROM heat_scores WHERE code=?)",
-                (zscore, code, code),
-            )
+            last_id = history[0]["last_id"]
+            conn.execute(f"UPDATE {partitions.table_for_id('heat_scores', last_id)} SET zscore=? WHERE id=?", (zscore, last_id))
+            updates.append((zscore, last_id))
 
             if (is_zscore_anomaly or is_breakout) and is_meaningful:
-                anomalies.append({
-                    "code": code,
-                    "name": row.get("name", ""),
-                    "total_heat": round(current_total, 4),
-                    "trade_heat": round(current_trade, 4),
-                    "zscore": round(zscore, 2),
-                    "change_pct": row.get("change_pct", 0),
-                    "volume_ratio": row.get("volume_ratio", 0),
-                    "breakout": round(stats["breakout"], 2),
-                    "box_cv": round(stats["box_cv"], 4),
-                    "box_upper": round(stats["box_upper"], 4),
-                    "box_lower": round(stats["box_lower"], 4),
-                    "hist_mean": round(stats["mean"], 4),
-                    "anomaly_type": "box_breakout" if (is_breakout and not is_zscore_anomaly) else "zscore",
-                })
+                anomalies.append(_anomaly_record(row, current_trade, current_total, zscore, stats,
+                                                 is_zscore_anomaly, is_breakout))
+        rollup.set_zscores(conn, updates)
 
     anomalies.sort(key=lambda x: x["zscore"], reverse=True)
-    log.info("Detected %d anomalies", len(anomalies))
     return anomalies
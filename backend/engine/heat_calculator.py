@@ -1,40 +1,46 @@
-import logging
+import logging, time
 import pandas as pd
 import numpy as np
 from config import get as get_config
 from db import get_conn
+from engine import rollup
+import scans
+import partitions
+import sentiment_store
 
 log = logging.getLogger(__name__)
 
 
-def _normalize(series: pd.Series) -> pd.Series:
-    """Min-max normalize, handle edge case where max==min."""
+def _normalize(series: pd.Series, by=None) -> pd.Series:
+    """Min-max normalize, handle edge case where max==min. With `by`, normalize within each group."""
+    if by is not None:
+        g = series.groupby(by)
+        mn, span = g.transform("min"), g.transform("max") - g.transform("min")
+        return ((series - mn) / span).where(span != 0, 0.0)
     mn, mx = series.min(), series.max()
     if mx == mn:
         return pd.Series(0.0, index=series.index)
     return (series - mn) / (mx - mn)
 
 
-def calc_trade_heat(df: pd.DataFrame) -> pd.Series:
+def calc_trade_heat(df: pd.DataFrame, by=None) -> pd.Series:
+    """Trade heat of a cross-section; `by` (e.g. the date column) computes many cross-sections at once."""
     w = get_config()["heat_weights"]
-    vr = _normalize(df["volume_ratio"].fillna(0)) * w["volume_ratio"]
-    tr = _normalize(df["turnover_rate"].fillna(0)) * w["turnover_rate"]
-    amt = _normalize(df["amount"].fillna(0)) * w["amount_change"]
+    vr = _normalize(df["volume_ratio"].fillna(0), by) * w["volume_ratio"]
+    tr = _normalize(df["turnover_rate"].fillna(0), by) * w["turnover_rate"]
+    amt = _normalize(df["amount"].fillna(0), by) * w["amount_change"]
     return vr + tr + amt
 
 
 def calc_sentiment_heat(codes: list[str]) -> dict[str, float]:
-    """Calculate sentiment heat from latest snapshot for given codes."""
+    """
+    Calculate sentiment heat for given codes from the fresh records of the
+    in-memory sentiment store (which the collectors keep up to date).
+    """
     if not codes:
         return {}
     w = get_config()["heat_weights"]
-    placeholders = ",".join("?" * len(codes))
-    with get_conn() as conn:
-        rows = conn.execute(
-            f"SELECT code, source, post_count, comment_count FROM sentiment_snapshots "
-            f"WHERE code IN ({placeholders}) AND ts >= datetime('now','localtime','-10 minutes')",
-            codes,
-        ).fetchall()
+    rows = sentiment_store.latest(codes)
 
     if not rows:
         return {}
@@ -68,8 +74,12 @@ def calc_sentiment_heat(codes: list[str]) -> dict[str, float]:
     return result
 
 
-def calculate(trade_df: pd.DataFrame) -> pd.DataFrame:
-    """Calculate combined heat scores and store them."""
+def calculate(trade_df: pd.DataFrame, scan_id: int | None = None) -> pd.DataFrame:
+    """
+    Calculate combined heat scores and store them under `scan_id`.
+    Re-running for the same scan (the post-sentiment pass) replaces its rows.
+    The returned frame carries each stored row's heat `id` and `ts`.
+    """
     if trade_df.empty:
         return pd.DataFrame()
 
@@ -89,13 +99,54 @@ def calculate(trade_df: pd.DataFrame) -> pd.DataFrame:
     # Store heat scores
     records = trade_df[["code", "name", "trade_heat", "sentiment_heat", "total_heat"]].copy()
     records["zscore"] = 0.0  # will be filled by anomaly detector
+    records["scan_id"] = scan_id
+    records["ts"] = trade_df["ts"] = time.strftime("%Y-%m-%d %H:%M:%S")
     rows = records.to_dict("records")
     if rows:
         with get_conn() as conn:
+            if scan_id is not None:
+                part = partitions.for_scan(conn, "heat_scores", scan_id)
+                conn.execute(f"DELETE FROM {part} WHERE scan_id=?", (scan_id,))
+            else:
+                part = partitions.table(conn, "heat_scores", rows[0]["ts"])
+            last_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {part}").fetchone()[0]
             conn.executemany(
-                "INSERT INTO heat_scores(code,name,trade_heat,sentiment_heat,total_heat,zscore) "
-                "VALUES(:code,:name,:trade_heat,:sentiment_heat,:total_heat,:zscore)",
+                f"INSERT INTO {part}(code,name,trade_heat,sentiment_heat,total_heat,zscore,scan_id,ts) "
+                "VALUES(:code,:name,:trade_heat,:sentiment_heat,:total_heat,:zscore,:scan_id,:ts)",
                 rows,
             )
+            ids = dict(conn.execute(f"SELECT code, id FROM {part} WHERE id > ?", (last_id,)).fetchall())
+            rollup.update_since(conn, last_id, part)
+            if scan_id is not None:
+                scans.mark(conn, scan_id, "heat")
+        trade_df["id"] = trade_df["code"].map(ids)
     log.info("Calculated heat scores for %d stocks", len(rows))
     return trade_df
+
+
+def apply_sentiment(heat_df: pd.DataFrame, scan_id: int | None) -> pd.DataFrame:
+    """
+    Post-sentiment pass: fold sentiment into heat rows `calculate` already
+    stored for the scan, updating in place only the rows whose sentiment heat
+    changed. Reads the same fresh window as `calculate`, so codes this scan
+    did not collect keep their recent sentiment rather than dropping to 0.
+    """
+    if heat_df.empty:
+        return heat_df
+    cfg = get_config()["heat_weights"]
+    heat_df = heat_df.copy()
+    sent = heat_df["code"].map(calc_sentiment_heat(heat_df["code"].tolist())).fillna(0)
+    changed = sent.to_numpy() != heat_df["sentiment_heat"].to_numpy()
+    heat_df["sentiment_heat"] = sent
+    heat_df["total_heat"] = heat_df["trade_heat"] * cfg["trade"] + heat_df["sentiment_heat"] * cfg["sentiment"]
+    rows = heat_df.loc[changed, ["sentiment_heat", "total_heat", "id"]].dropna(subset=["id"])
+    with get_conn() as conn:
+        if not rows.empty:
+            rows = list(rows.astype({"id": "int64"}).itertuples(index=False, name=None))
+            part = partitions.table_for_id("heat_scores", rows[0][2])
+            conn.executemany(f"UPDATE {part} SET sentiment_heat=?, total_heat=? WHERE id=?", rows)
+            rollup.set_heat(conn, rows)
+        if scan_id is not None:
+            scans.mark(conn, scan_id, "heat")
+    log.info("Updated sentiment in %d of %d heat scores", int(changed.sum()), len(heat_df))
+    return heat_df
@@ -0,0 +1,168 @@
+"""
+Online per-stock baseline of daily trade_heat.
+
+Each code owns a fixed-size ring buffer of closed days plus running
+(shifted) moments, so the baseline for a scan is an O(1) lookup instead of
+a history query. The current day's latest value is held as "pending" and
+pushed into the buffer when the first scan of the next day arrives.
+"""
+import logging, threading, time
+import numpy as np
+from config import get as get_config
+from db import get_conn
+
+log = logging.getLogger(__name__)
+
+
+class RollingStats:
+    def __init__(self, window: int):
+        self.window = window
+        self.day = None
+        self._index: dict[str, int] = {}
+        self._buf = np.full((0, window), np.nan)
+        self._head = np.zeros(0, dtype=np.int64)      # next slot to overwrite
+        self._shift = np.full(0, np.nan)              # per-code shift keeps moments well-conditioned
+        self._s1 = np.zeros(0)                        # sum of (v - shift)
+        self._s2 = np.zeros(0)                        # sum of (v - shift)^2
+        self._n = np.zeros(0, dtype=np.int64)
+        self._q25 = np.full(0, np.nan)
+        self._q75 = np.full(0, np.nan)
+        self._pending = np.full(0, np.nan)            # latest value of the current day
+        self._lock = threading.Lock()
+
+    def _rows(self, codes) -> np.ndarray:
+        new = [c for c in dict.fromkeys(codes) if c not in self._index]
+        if new:
+            k = len(new)
+            for c in new:
+                self._index[c] = len(self._index)
+            self._buf = np.vstack([self._buf, np.full((k, self.window), np.nan)])
+            self._head = np.concatenate([self._head, np.zeros(k, dtype=np.int64)])
+            self._shift = np.concatenate([self._shift, np.full(k, np.nan)])
+            self._s1 = np.concatenate([self._s1, np.zeros(k)])
+            self._s2 = np.concatenate([self._s2, np.zeros(k)])
+            self._n = np.concatenate([self._n, np.zeros(k, dtype=np.int64)])
+            self._q25 = np.concatenate([self._q25, np.full(k, np.nan)])
+            self._q75 = np.concatenate([self._q75, np.full(k, np.nan)])
+            self._pending = np.concatenate([self._pending, np.full(k, np.nan)])
+        return np.fromiter((self._index[c] for c in codes), dtype=np.int64, count=len(codes))
+
+    def _push(self, rows: np.ndarray, values: np.ndarray, quartiles: bool = True):
+        """
+        Close one day for each of `rows` (unique): evict the oldest slot, add
+        the value. Bulk loads pass quartiles=False and call _quartiles once.
+        """
+        if not len(rows):
+            return
+        unset = np.isnan(self._shift[rows]) & ~np.isnan(values)
+        self._shift[rows[unset]] = values[unset]
+        shift = self._shift[rows]
+
+        old = self._buf[rows, self._head[rows]]
+        had = ~np.isnan(old)
+        self._s1[rows] -= np.where(had, old - shift, 0.0)
+        self._s2[rows] -= np.where(had, (old - shift) ** 2, 0.0)
+        self._n[rows] -= had
+
+        has = ~np.isnan(values)
+        self._s1[rows] += np.where(has, values - shift, 0.0)
+        self._s2[rows] += np.where(has, (values - shift) ** 2, 0.0)
+        self._n[rows] += has
+
+        self._buf[rows, self._head[rows]] = values
+        self._head[rows] = (self._head[rows] + 1) % self.window
+        if quartiles:
+            self._quartiles(rows)
+
+    def _quartiles(self, rows: np.ndarray):
+        filled = rows[self._n[rows] > 0]
+        self._q25[filled] = np.nanpercentile(self._buf[filled], 25, axis=1)
+        self._q75[filled] = np.nanpercentile(self._buf[filled], 75, axis=1)
+
+    def observe(self, day: str, codes, values) -> bool:
+        """Record the latest value of `day` for codes; returns True if a day boundary was crossed."""
+        values = np.asarray(values, dtype=float)
+        with self._lock:
+            rows = self._rows(codes)
+            rolled = self.day is not None and day > self.day
+            if rolled:
+                closing = np.flatnonzero(~np.isnan(self._pending))
+                self._push(closing, self._pending[closing])
+                self._pending[:] = np.nan
+            if self.day is None or rolled:
+                self.day = day
+            self._pending[rows] = values
+        return rolled
+
+    def baseline(self, codes) -> dict:
+        """Window statistics of the closed days for codes (NaN where there is no history)."""
+        with self._lock:
+            rows = self._rows(codes)
+            n = self._n[rows]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                m1 = self._s1[rows] / n
+                var = np.maximum(self._s2[rows] / n - m1 ** 2, 0.0)
+            return {
+                "n": n,
+                "mean": self._shift[rows] + m1,
+                "std": np.sqrt(var),
+                "box_lower": self._q25[rows].copy(),
+                "box_upper": self._q75[rows].copy(),
+            }
+
+    def load(self, conn, day: str):
+        """Fill buffers from the daily rollup: days before `day` are closed, `day` itself is pending."""
+        rows = conn.execute(
+            "SELECT code, bucket, trade_heat FROM ("
+            "SELECT code, bucket, trade_heat, "
+            "ROW_NUMBER() OVER (PARTITION BY code ORDER BY bucket DESC) AS rn "
+            "FROM heat_rollup_1d WHERE bucket <= ?"
+            ") WHERE rn <= ?",
+            (day, self.window + 1),
+        ).fetchall()
+        with self._lock:
+            self.day = day
+            # Push day by day, oldest first, so each code's buffer stays chronological
+            by_day: dict[str, tuple[list, list]] = {}
+            pending_codes, pending_vals = [], []
+            for r in rows:
+                v = np.nan if r["trade_heat"] is None else r["trade_heat"]
+                if r["bucket"] == day:
+                    pending_codes.append(r["code"])
+                    pending_vals.append(v)
+                    continue
+                codes, vals = by_day.setdefault(r["bucket"], ([], []))
+                codes.append(r["code"])
+                vals.append(v)
+            for bucket in sorted(by_day):
+                codes, vals = by_day[bucket]
+                self._push(self._rows(codes), np.array(vals, dtype=float), quartiles=False)
+            # Only the final windows matter: one percentile pass instead of one per day
+            self._quartiles(np.arange(len(self._index)))
+            pending_rows = self._rows(pending_codes)     # may grow the arrays: look up before indexing them
+            self._pending[pending_rows] = pending_vals
+        log.info("Rolling stats warmed for %d stocks (window=%d, day=%s)", len(self._index), self.window, day)
+
+
+_engine: RollingStats | None = None
+_engine_lock = threading.Lock()
+
+
+def warm_start(day: str | None = None) -> RollingStats:
+    """(Re)build the engine from the database and make it current."""
+    global _engine
+    day = day or time.strftime("%Y-%m-%d")
+    engine = RollingStats(get_config()["detection"]["window_size"])
+    with get_conn() as conn:
+        engine.load(conn, day)
+    with _engine_lock:
+        _engine = engine
+    return engine
+
+
+def get(day: str) -> RollingStats:
+    """Current engine, rebuilt when missing, when window_size changed, or when asked about an older day."""
+    engine = _engine
+    if engine is None or engine.window != get_config()["detection"]["window_size"] or day < (engine.day or day):
+        engine = warm_start(day)
+    return engine
@@ -0,0 +1,85 @@
+import logging
+import archive
+
+log = logging.getLogger(__name__)
+
+# Rollup table -> SQL expression mapping a heat_scores.ts to its bucket start
+RESOLUTIONS = {
+    "heat_rollup_5m": "strftime('%Y-%m-%d %H:', ts) || printf('%02d', CAST(strftime('%M', ts) AS INTEGER) / 5 * 5) || ':00'",
+    "heat_rollup_1h": "strftime('%Y-%m-%d %H:00:00', ts)",
+    "heat_rollup_1d": "DATE(ts)",
+}
+
+
+def table_for_hours(hours: int) -> str | None:
+    """Pick the resolution for a trend window; None means raw heat_scores."""
+    if hours <= 6:
+        return None
+    if hours <= 72:
+        return "heat_rollup_5m"
+    if hours <= 24 * 30:
+        return "heat_rollup_1h"
+    return "heat_rollup_1d"
+
+
+def update_since(conn, after_id: int, source: str = "heat_scores"):
+    """Fold heat rows with id > after_id into every rollup (last value per bucket wins).
+
+    `source` narrows the read to one heat_scores partition (see partitions.py).
+    """
+    for table, bucket in RESOLUTIONS.items():
+        conn.execute(
+            f"INSERT INTO {table}(code,bucket,trade_heat,sentiment_heat,total_heat,zscore,max_total_heat,samples,last_id) "
+            f"SELECT code, {bucket}, trade_heat, sentiment_heat, total_heat, zscore, total_heat, 1, id "
+            f"FROM {source} WHERE id > ? ORDER BY id "
+            f"ON CONFLICT(code,bucket) DO UPDATE SET "
+            f"trade_heat=excluded.trade_heat, sentiment_heat=excluded.sentiment_heat, "
+            f"total_heat=excluded.total_heat, zscore=excluded.zscore, "
+            f"max_total_heat=MAX(COALESCE(max_total_heat, excluded.max_total_heat), excluded.max_total_heat), "
+            f"samples=samples+1, last_id=excluded.last_id",
+            (after_id,),
+        )
+
+
+def set_zscores(conn, pairs):
+    """Mirror z-score updates (zscore, heat_scores.id) into the buckets holding those rows."""
+    pairs = list(pairs)
+    for table in RESOLUTIONS:
+        conn.executemany(f"UPDATE {table} SET zscore=? WHERE last_id=?", pairs)
+
+
+def set_heat(conn, rows):
+    """Mirror in-place heat updates (sentiment_heat, total_heat, heat_scores.id) into the buckets holding those rows."""
+    rows = [(s, t, t, i) for s, t, i in rows]
+    for table in RESOLUTIONS:
+        conn.executemany(
+            f"UPDATE {table} SET sentiment_heat=?, total_heat=?, max_total_heat=MAX(COALESCE(max_total_heat, 0), ?) "
+            f"WHERE last_id=?",
+            rows,
+        )
+
+
+def ensure_built(conn):
+    """Build rollups from raw heat_scores once, for databases created before rollups existed."""
+    if conn.execute("SELECT 1 FROM heat_rollup_1d LIMIT 1").fetchone():
+        return
+    archived = archive.days("heat_scores")
+    if not archived and not conn.execute("SELECT 1 FROM heat_scores LIMIT 1").fetchone():
+        return
+    cold = sorted(set(archived) - archive.hot_days(conn, "heat_scores")) if archived else []
+    log.info("Building heat rollups from existing heat_scores (%d archived days)...", len(cold))
+    # Archived days are older than anything still in SQLite: fold them first, one day at a time
+    conn.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS heat_archive_day "
+        "(id INTEGER, code TEXT, trade_heat REAL, sentiment_heat REAL, total_heat REAL, zscore REAL, ts TEXT)"
+    )
+    for day in cold:
+        df = archive.frame("heat_scores", day)
+        conn.execute("DELETE FROM temp.heat_archive_day")
+        conn.executemany(
+            "INSERT INTO temp.heat_archive_day VALUES(?,?,?,?,?,?,?)",
+            df[["id", "code", "trade_heat", "sentiment_heat", "total_heat", "zscore", "ts"]].itertuples(index=False),
+        )
+        update_since(conn, 0, "temp.heat_archive_day")
+    conn.execute("DROP TABLE temp.heat_archive_day")
+    update_since(conn, 0)
@@ -7,19 +7,26 @@ from contextlib import asynccontextmanager
 for k in ("http_proxy", "https_proxy", "HTTP_PROXY", "HTTPS_PROXY"):
     os.environ.pop(k, None)
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 from apscheduler.schedulers.background import BackgroundScheduler
 
 import config
-from db import init_db, cleanup_old_data, get_conn
+from db import init_db, cleanup_old_data, get_conn, query_frame, read_pool
+import scans
+import partitions
+import archive
+import sentiment_store
+import stock_search
+import metrics
 from collector import basic_collector, trade_collector, guba_collector, xueqiu_collector
-from engine import heat_calculator, anomaly_detector
+from engine import heat_calculator, anomaly_detector, rollup, rolling_stats
 from notifier import webhook
 from api.routes import router
-from api.ws import ws_endpoint, broadcast_sync
+from api import ranking_cache
+from api.ws import ws_endpoint, broadcast_sync, publish_sync, bus
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
 log = logging.getLogger(__name__)
@@ -37,6 +44,7 @@ def _log_job(name, func):
     try:
         result = func()
         dur = time.time() - t0
+        metrics.JOB_DURATION.observe(dur, job=name, status="ok")
         with get_conn() as conn:
             conn.execute(
                 "INSERT INTO job_logs(job_name,status,message,duration_sec) VALUES(?,?,?,?)",
@@ -48,6 +56,7 @@ def _log_job(name, func):
         return result
     except Exception as e:
         dur = time.time() - t0
+        metrics.JOB_DURATION.observe(dur, job=name, status="error")
         with get_conn() as conn:
             conn.execute(
                 "INSERT INTO job_logs(job_name,status,message,duration_sec) VALUES(?,?,?,?)",
@@ -62,80 +71,147 @@ def _log_job(name, func):
 def job_sync_basic():
     return _log_job("sync_basic", basic_collector.sync)
 
-def job_collect_trade():
-    return _log_job("collect_trade", trade_collector.collect)
+class ScanContext:
+    """
+    In-memory hand-off between the stages of one run_scan cycle. A stage
+    finding its input missing (e.g. triggered alone via the API) loads it
+    from the database instead.
+    """
+    def __init__(self):
+        self.scan_id: int | None = None
+        self.trade_df = None       # trade_collector.collect() output
+        self.heat_df = None        # latest heat_calculator.calculate() output, with heat ids
+        self.sentiment = False     # sentiment collected during this scan (into sentiment_store)
 
-def job_collect_sentiment():
+
+def job_collect_trade(ctx: ScanContext | None = None):
+    def _do():
+        df = trade_collector.collect()
+        if df.empty:
+            return "no trade data"
+        if ctx:
+            ctx.scan_id, ctx.trade_df = int(df["scan_id"].iloc[0]), df
+        return f"trade for {len(df)} stocks"
+    return _log_job("collect_trade", _do)
+
+def job_collect_sentiment(ctx: ScanContext | None = None):
     def _do():
         cfg = config.get()
         top_n = cfg["scanner"]["top_n_for_sentiment"]
+        codes = []
+        if ctx and ctx.heat_df is not None:
+            codes = ctx.heat_df.nlargest(top_n, "trade_heat")["code"].tolist()
         with get_conn() as conn:
-            rows = conn.execute(
-                "SELECT code FROM heat_scores WHERE ts=(SELECT MAX(ts) FROM heat_scores) ORDER BY trade_heat DESC LIMIT ?", (top_n,)
-            ).fetchall()
-        codes = [r["code"] for r in rows]
-        if not codes:
-            with get_conn() as conn:
-                rows = conn.execute(
-                    "SELECT code FROM trade_snapshots WHERE ts=(SELECT MAX(ts) FROM trade_snapshots) ORDER BY volume_ratio DESC LIMIT ?", (top_n,)
-                ).fetchall()
-            codes = [r["code"] for r in rows]
+            if not codes:
+                heat_scan = scans.latest(conn, "heat")
+                if heat_scan:
+                    rows = conn.execute(
+                        f"SELECT code FROM {partitions.for_scan(conn, 'heat_scores', heat_scan)} "
+                        "WHERE scan_id=? ORDER BY trade_heat DESC LIMIT ?", (heat_scan, top_n)
+                    ).fetchall()
+                    codes = [r["code"] for r in rows]
+            if not codes:
+                trade_scan = scans.latest(conn, "trade")
+                if trade_scan:
+                    rows = conn.execute(
+                        f"SELECT code FROM {partitions.for_scan(conn, 'trade_snapshots', trade_scan)} "
+                        "WHERE scan_id=? ORDER BY volume_ratio DESC LIMIT ?", (trade_scan, top_n)
+                    ).fetchall()
+                    codes = [r["code"] for r in rows]
         if not codes:
             return "no codes"
-        guba_collector.collect(codes[:100])
-        xueqiu_collector.collect(codes[:100])
-        return f"sentiment for {len(codes[:100])} stocks"
+        guba_collector.collect(codes)
+        xueqiu_collector.collect(codes)
+        if ctx:
+            ctx.sentiment = True
+        with get_conn() as conn:
+            scan_id = (ctx and ctx.scan_id) or scans.latest(conn, "trade")
+            if scan_id:
+                scans.mark(conn, scan_id, "sentiment")
+        return f"sentiment for {len(codes)} stocks"
     return _log_job("collect_sentiment", _do)
 
-def job_calc_heat():
+def _publish_ranking(scan_id: int | None):
+    """Serve the scan's heat from /api/heat/ranking right away, not only once detection is done."""
+    with get_conn() as conn:
+        ranking_cache.publish(conn, scan_id)
+
+def job_calc_heat(ctx: ScanContext | None = None):
     def _do():
-        with get_conn() as conn:
-            latest_ts = conn.execute("SELECT MAX(ts) as ts FROM trade_snapshots").fetchone()["ts"]
-            if not latest_ts:
-                return "no trade data"
-            rows = conn.execute(
-                "SELECT code,name,price,change_pct,volume,amount,turnover_rate,volume_ratio FROM trade_snapshots WHERE ts=?", (latest_ts,)
-            ).fetchall()
-        if not rows:
+        if ctx and ctx.heat_df is not None and ctx.sentiment:
+            # Second pass of a scan: fold in the sentiment just collected
+            ctx.heat_df = heat_calculator.apply_sentiment(ctx.heat_df, ctx.scan_id)
+            if not ctx.heat_df.empty:
+                _publish_ranking(ctx.scan_id)
+            return f"sentiment heat for {len(ctx.heat_df)} stocks"
+        if ctx and ctx.trade_df is not None:
+            scan_id, df = ctx.scan_id, ctx.trade_df
+        else:
+            with get_conn() as conn:
+                scan_id = scans.latest(conn, "trade")
+                if not scan_id:
+                    return "no trade data"
+                df = query_frame(
+                    conn, "SELECT code,name,price,change_pct,volume,amount,turnover_rate,volume_ratio "
+                    f"FROM {partitions.for_scan(conn, 'trade_snapshots', scan_id)} WHERE scan_id=?", (scan_id,)
+                )
+        if df.empty:
             return "no trade data"
-        import pandas as pd
-        df = pd.DataFrame([dict(r) for r in rows])
-        heat_df = heat_calculator.calculate(df)
+        heat_df = heat_calculator.calculate(df, scan_id)
+        if ctx:
+            ctx.heat_df = heat_df
+        if not heat_df.empty:
+            _publish_ranking(scan_id)
         return f"heat for {len(heat_df)} stocks"
     return _log_job("calc_heat", _do)
 
-def job_detect_anomaly():
+def job_detect_anomaly(ctx: ScanContext | None = None):
     def _do():
-        with get_conn() as conn:
-            latest_ts = conn.execute("SELECT MAX(ts) as ts FROM heat_scores").fetchone()["ts"]
-            if not latest_ts:
-                return "no heat data"
-            rows = conn.execute(
-                "SELECT h.code, h.name, h.total_heat, h.trade_heat, h.sentiment_heat, "
-                "t.change_pct, t.volume_ratio "
-                "FROM heat_scores h LEFT JOIN trade_snapshots t ON h.code=t.code "
-                "AND t.ts=(SELECT MAX(ts) FROM trade_snapshots) WHERE h.ts=?", (latest_ts,)
-            ).fetchall()
-        if not rows:
+        if ctx and ctx.heat_df is not None:
+            scan_id, df = ctx.scan_id, ctx.heat_df
+        else:
+            with get_conn() as conn:
+                scan_id = scans.latest(conn, "heat")
+                if not scan_id:
+                    return "no heat data"
+                df = query_frame(
+                    conn,
+                    "SELECT h.id, h.code, h.name, h.total_heat, h.trade_heat, h.sentiment_heat, h.ts, "
+                    "t.change_pct, t.volume_ratio "
+                    f"FROM {partitions.for_scan(conn, 'heat_scores', scan_id)} h "
+                    f"LEFT JOIN {partitions.for_scan(conn, 'trade_snapshots', scan_id)} t ON t.scan_id=h.scan_id AND t.code=h.code "
+                    "WHERE h.scan_id=?", (scan_id,)
+                )
+        if df.empty:
             return "no data"
-        import pandas as pd
-        df = pd.DataFrame([dict(r) for r in rows])
         anomalies = anomaly_detector.detect(df)
-        webhook.notify(anomalies)
+        webhook.notify(anomalies, scan_id)
+        with get_conn() as conn:
+            scans.mark(conn, scan_id, "anomaly")
+            ranking_cache.publish(conn, scan_id)
 
-        top_items = df.nlargest(50, "total_heat")[
-            ["code", "name", "total_heat", "trade_heat", "sentiment_heat", "change_pct", "volume_ratio"]
-        ].to_dict("records")
-        broadcast_sync({"type": "update", "ranking": top_items, "anomalies": anomalies[:20]})
+        cols = ["code", "name", "total_heat", "trade_heat", "sentiment_heat", "change_pct", "volume_ratio"]
+        publish_sync("ranking", df.nlargest(50, "total_heat")[cols].to_dict("records"))
+        publish_sync("anomalies", anomalies[:20])
+        publish_sync("codes", df[cols].to_dict("records"))
         return f"{len(anomalies)} anomalies"
     return _log_job("detect_anomaly", _do)
 
+def job_archive():
+    def _do():
+        keep = config.get()["data"].get("archive_after_days", 3)
+        with get_conn() as conn:
+            written = archive.archive_closed_days(conn, keep)
+        return ", ".join(f"{tbl}: {len(d)} days" for tbl, d in written.items()) or "nothing to archive"
+    return _log_job("archive", _do)
+
 def job_cleanup():
     retention = config.get()["data"]["retention_days"]
     return _log_job("cleanup", lambda: cleanup_old_data(retention))
 
 def run_scan():
     log.info("=== Scan cycle start ===")
+    t0 = time.perf_counter()
     _running_jobs["full_scan"] = {"status": "running", "started_at": time.strftime("%H:%M:%S"), "progress": ""}
     steps = [
         ("collect_trade", job_collect_trade),
@@ -144,10 +220,16 @@ def run_scan():
         ("calc_heat_2", job_calc_heat),
         ("detect_anomaly", job_detect_anomaly),
     ]
+    ctx = ScanContext()
     for i, (step_name, fn) in enumerate(steps):
         _running_jobs["full_scan"]["progress"] = f"{i+1}/{len(steps)} {step_name}"
         broadcast_sync({"type": "job_status", "jobs": _running_jobs})
-        fn()
+        with metrics.STAGE_DURATION.time(stage=step_name):
+            fn(ctx)
+    dur = time.perf_counter() - t0
+    metrics.SCAN_DURATION.observe(dur)
+    metrics.SCAN_LAST_DURATION.set(dur)
+    metrics.SCAN_LAST_FINISHED.set(time.time())
     _running_jobs.pop("full_scan", None)
     broadcast_sync({"type": "job_done", "job": "full_scan", "status": "ok", "jobs": _running_jobs})
     log.info("=== Scan cycle done ===")
@@ -161,19 +243,51 @@ def get_running_jobs():
 async def lifespan(application):
     config.load()
     init_db()
+    with get_conn() as conn:
+        rollup.ensure_built(conn)
+        ranking_cache.publish(conn)
+    rolling_stats.warm_start()
+    sentiment_store.hydrate()
+    stock_search.rebuild()
+    webhook.start()
     cfg = config.get()
     interval = cfg["scanner"]["interval_minutes"]
+    metrics.SCAN_INTERVAL.set(interval * 60)
     scheduler.add_job(job_sync_basic, "cron", hour=9, minute=0, id="sync_basic", replace_existing=True)
     scheduler.add_job(run_scan, "cron", minute=f"*/{interval}", hour="9-15", id="full_scan", replace_existing=True)
+    scheduler.add_job(job_archive, "cron", hour=2, minute=30, id="archive", replace_existing=True)
     scheduler.add_job(job_cleanup, "cron", hour=3, id="cleanup", replace_existing=True)
+    await bus.start()
     scheduler.start()
     log.info("Scheduler started, scan interval=%d min", interval)
     yield
     scheduler.shutdown(wait=False)
+    await bus.stop()
+    read_pool.close()
 
 
 app = FastAPI(title="A-Stock Heat Pulse", lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+
+
+@app.middleware("http")
+async def api_latency(request: Request, call_next):
+    if not request.url.path.startswith("/api/"):
+        return await call_next(request)
+    t0 = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Label by route template so path parameters don't explode cardinality
+        route = request.scope.get("route")
+        metrics.API_DURATION.observe(
+            time.perf_counter() - t0, method=request.method,
+            route=getattr(route, "path", "unmatched"), status=status,
+        )
+
 app.include_router(router)
 app.add_api_websocket_route("/ws", ws_endpoint)
 
@@ -0,0 +1,185 @@
+"""
+In-process metrics rendered in the Prometheus text exposition format
+(served at /api/metrics). Counters, gauges and histograms are plain
+lock-protected dicts keyed by label values, cheap enough for hot paths.
+"""
+import sys, threading, time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+# Seconds; covers sub-ms SQLite statements up to scans overrunning a 3-minute interval
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_registry: list["_Metric"] = []
+
+
+def _escape(v) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labelstr(names, values, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(n, "") for n in self.labels)
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, val in items:
+            out.extend(self._render_one(key, val))
+        return out
+
+    def _render_one(self, key, val) -> list[str]:
+        return [f"{self.name}{_labelstr(self.labels, key)} {val:g}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = state[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def _render_one(self, key, val) -> list[str]:
+        counts, total, n = val
+        out, cum = [], 0
+        for bound, c in zip(self.buckets, counts):
+            cum += c
+            le = 'le="%g"' % bound
+            out.append(f"{self.name}_bucket{_labelstr(self.labels, key, le)} {cum}")
+        inf = 'le="+Inf"'
+        out.append(f"{self.name}_bucket{_labelstr(self.labels, key, inf)} {n}")
+        out.append(f"{self.name}_sum{_labelstr(self.labels, key)} {total:g}")
+        out.append(f"{self.name}_count{_labelstr(self.labels, key)} {n}")
+        return out
+
+
+def render() -> str:
+    lines = []
+    for m in _registry:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+# ── Metrics ──────────────────────────────────────────────────
+
+JOB_DURATION = Histogram("heatpulse_job_duration_seconds", "Duration of scheduler jobs.", ("job", "status"))
+STAGE_DURATION = Histogram("heatpulse_scan_stage_duration_seconds", "Duration of each run_scan stage.", ("stage",))
+SCAN_DURATION = Histogram("heatpulse_scan_duration_seconds", "Duration of a full run_scan cycle.")
+SCAN_LAST_DURATION = Gauge("heatpulse_scan_last_duration_seconds", "Duration of the most recent run_scan cycle.")
+SCAN_LAST_FINISHED = Gauge("heatpulse_scan_last_finished_timestamp_seconds", "Unix time the most recent run_scan cycle finished.")
+SCAN_INTERVAL = Gauge("heatpulse_scan_interval_seconds", "Configured run_scan interval.")
+
+HTTP_DURATION = Histogram("heatpulse_http_client_duration_seconds", "Outbound HTTP request latency per host.", ("host",))
+HTTP_ERRORS = Counter("heatpulse_http_client_errors_total", "Outbound HTTP failures per host (status code or exception type).", ("host", "reason"))
+
+SENTIMENT_SKIPPED = Counter("heatpulse_sentiment_skipped_total", "Stocks left out of a sentiment collection when its time budget ran out.", ("source",))
+
+ROWS_INSERTED = Counter("heatpulse_db_rows_inserted_total", "Rows written by INSERT statements (upserts included) per table.", ("table",))
+QUERY_DURATION = Histogram("heatpulse_db_query_duration_seconds", "SQLite statement time (execute plus fetch) per call site.", ("site",))
+
+WS_CLIENTS = Gauge("heatpulse_ws_clients", "Connected WebSocket clients.")
+WS_BROADCAST_DURATION = Histogram("heatpulse_ws_broadcast_duration_seconds", "Time from publishing an update to queueing it for every client.")
+WS_DROPPED = Counter("heatpulse_ws_dropped_total", "Job events dropped from full client queues and clients dropped for stuck sends.", ("reason",))
+
+DB_POOL_SIZE = Gauge("heatpulse_db_read_pool_size", "Read-only connections available to API requests.")
+DB_POOL_IN_USE = Gauge("heatpulse_db_read_pool_in_use", "Read-only connections running a query.")
+DB_POOL_WAITING = Gauge("heatpulse_db_read_pool_waiting", "API queries waiting for a read-only connection.")
+DB_POOL_WAIT = Histogram("heatpulse_db_read_pool_wait_seconds", "Time API queries waited for a read-only connection.")
+
+WEBHOOK_DELIVERIES = Counter("heatpulse_webhook_deliveries_total", "Webhook messages by final delivery status.", ("status",))
+
+API_DURATION = Histogram("heatpulse_api_request_duration_seconds", "API request latency per route.", ("method", "route", "status"))
+
+
+def call_site(depth: int = 2) -> str:
+    """'module.function' of the frame `depth` levels above the caller."""
+    f = sys._getframe(depth)
+    return f"{f.f_globals.get('__name__', '?')}.{f.f_code.co_name}"
+
+
+def instrument_session(session):
+    """Record latency and failures of every request made through a requests.Session."""
+    request = session.request
+
+    def timed_request(method, url, *args, **kwargs):
+        host = urlsplit(url).hostname or "?"
+        t0 = time.perf_counter()
+        try:
+            resp = request(method, url, *args, **kwargs)
+        except Exception as e:
+            HTTP_ERRORS.inc(host=host, reason=type(e).__name__)
+            raise
+        finally:
+            HTTP_DURATION.observe(time.perf_counter() - t0, host=host)
+        if resp.status_code >= 400:
+            HTTP_ERRORS.inc(host=host, reason=str(resp.status_code))
+        return resp
+
+    session.request = timed_request
+    return session
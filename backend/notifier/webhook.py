@@ -1,73 +1,210 @@
-import logging, json
+"""
+Alert storage and webhook delivery.
+
+notify() runs inside the scan: it filters anomalies through an in-memory
+dedup cache (code -> last alert time, rebuilt from `alerts` at startup),
+stores the alerts and queues the webhook message. A background worker
+posts queued messages with retries and records the outcome in
+alerts.delivery_status ('pending' -> 'sent' / 'failed'), so a slow or
+unreachable webhook never stalls a scan.
+"""
+import logging, queue, random, threading, time
 import requests
+from requests.adapters import HTTPAdapter
 from config import get as get_config
 from db import get_conn
+import metrics
 
 log = logging.getLogger(__name__)
 
+_MAX_ITEMS = 10          # stocks listed per message
+_QUEUE_SIZE = 100
+_RETRIES = 4
+_TIMEOUT = 10
+
+_SESSION = metrics.instrument_session(requests.Session())
+_SESSION.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=2))
+
+_queue: queue.Queue = queue.Queue(maxsize=_QUEUE_SIZE)
+_worker: threading.Thread | None = None
+_worker_lock = threading.Lock()
+
+
+class _DedupCache:
+    """Last alert time per code, for the alert.dedup_minutes window."""
+
+    def __init__(self):
+        self._last: dict[str, float] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def hydrate(self, minutes: int):
+        with get_conn() as conn:
+            # Ordered by time, so each code keeps its latest alert; ts-range search, no grouping of the table
+            rows = conn.execute(
+                "SELECT code, ts FROM alerts WHERE ts >= datetime('now','localtime',? || ' minutes') ORDER BY ts",
+                (f"-{minutes}",),
+            ).fetchall()
+        last = {r["code"]: time.mktime(time.strptime(r["ts"][:19], "%Y-%m-%d %H:%M:%S")) for r in rows}
+        with self._lock:
+            self._last = last
+            self._loaded = True
+        log.info("Alert dedup cache loaded with %d codes", len(last))
+
+    def filter(self, anomalies: list[dict], minutes: int) -> list[dict]:
+        """Anomalies whose code has no alert in the window; marks them as alerted now."""
+        if not self._loaded:
+            self.hydrate(minutes)
+        now = time.time()
+        horizon = now - minutes * 60
+        with self._lock:
+            self._last = {c: t for c, t in self._last.items() if t >= horizon}
+            fresh = [a for a in anomalies if a["code"] not in self._last]
+            for a in fresh:
+                self._last[a["code"]] = now
+        return fresh
 
-def _is_dedup(code: str) -> bool:
-    minutes = get_config()["alert"]["dedup_minutes"]
-    with get_conn() as conn:
-        row = conn.execute(
-            "SELECT 1 FROM alerts WHERE code=? AND ts >= datetime('now','localtime',? || ' minutes')",
-            (code, f"-{minutes}"),
-        ).fetchone()
-    return row is not None
+
+_dedup = _DedupCache()
 
 
 def _format_message(items: list[dict]) -> str:
     lines = ["🔥 A股热度异常告警\n"]
-    for i, it in enumerate(items[:10], 1):
+    for i, it in enumerate(items[:_MAX_ITEMS], 1):
         lines.append(
             f"{i}. {it['name']}({it['code']}) "
             f"热度:{it['total_heat']:.3f} Z:{it['zscore']:.1f} "
-            f"涨跌:{it.get('change_pct',0):.2f}% 量比:{it.get('volume_ratio',0):.2f}"
+            f"涨跌:{(it.get('change_pct') or 0):.2f}% 量比:{(it.get('volume_ratio') or 0):.2f}"
         )
     return "\n".join(lines)
 
 
-def _send_feishu(url: str, text: str):
-    payload = {"msg_type": "text", "content": {"text": text}}
-    requests.post(url, json=payload, timeout=10)
+def _payload(kind: str, text: str) -> dict:
+    if kind == "feishu":
+        return {"msg_type": "text", "content": {"text": text}}
+    return {"msgtype": "text", "text": {"content": text}}
+
+
+def _post(url: str, kind: str, text: str):
+    resp = _SESSION.post(url, json=_payload(kind, text), timeout=_TIMEOUT)
+    resp.raise_for_status()
+    try:
+        body = resp.json()
+    except ValueError:
+        return
+    # Both APIs answer HTTP 200 with a non-zero code on errors
+    code = body.get("code", body.get("StatusCode", body.get("errcode", 0)))
+    if code:
+        raise RuntimeError(f"webhook error {code}: {body.get('msg') or body.get('errmsg')}")
+
+
+def _set_status(ids: list[int], status: str):
+    with get_conn() as conn:
+        conn.executemany("UPDATE alerts SET delivery_status=? WHERE id=?", [(status, i) for i in ids])
+    metrics.WEBHOOK_DELIVERIES.inc(status=status)
+
+
+def _deliver(ids: list[int], url: str, kind: str, text: str):
+    for attempt in range(_RETRIES + 1):
+        try:
+            _post(url, kind, text)
+            _set_status(ids, "sent")
+            log.info("Sent webhook for %d stocks", len(ids))
+            return
+        except Exception as e:
+            err = e
+        if attempt < _RETRIES:
+            time.sleep(2 ** attempt + random.uniform(0, 0.5))
+    _set_status(ids, "failed")
+    log.error("Failed to send webhook after %d attempts: %s", _RETRIES + 1, err)
+
+
+def _run():
+    while True:
+        job = _queue.get()
+        try:
+            _deliver(*job)
+        except Exception:
+            log.exception("Webhook worker error")
+        finally:
+            _queue.task_done()
+
+
+def _ensure_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name="webhook", daemon=True)
+            _worker.start()
 
 
-def _send_dingtalk(url: str, text: str):
-    payload = {"msgtype": "text", "text": {"content": text}}
-    requests.post(url, json=payload, timeout=10)
+def _enqueue(ids: list[int], url: str, kind: str, text: str):
+    _ensure_worker()
+    try:
+        _queue.put_nowait((ids, url, kind, text))
+    except queue.Full:
+        _set_status(ids, "failed")
+        log.error("Webhook queue full, dropping message for %d stocks", len(ids))
+
+
+def start():
+    """Rebuild the dedup cache and requeue messages left pending by a previous run."""
+    cfg = get_config()["alert"]
+    minutes = cfg["dedup_minutes"]
+    _dedup.hydrate(minutes)
+    with get_conn() as conn:
+        rows = conn.execute(
+            "SELECT * FROM alerts WHERE delivery_status='pending' AND ts >= datetime('now','localtime',? || ' minutes') "
+            "ORDER BY ts, id",
+            (f"-{minutes}",),
+        ).fetchall()
+        # Anything older is stale news by now
+        conn.execute(
+            "UPDATE alerts SET delivery_status='failed' WHERE delivery_status='pending' AND ts < datetime('now','localtime',? || ' minutes')",
+            (f"-{minutes}",),
+        )
+    url = cfg.get("webhook_url", "")
+    batches: dict = {}
+    for r in rows:
+        batches.setdefault(r["scan_id"], []).append(dict(r))
+    for items in batches.values():
+        ids = [a["id"] for a in items]
+        if url:
+            _enqueue(ids, url, cfg["webhook_type"], _format_message(items))
+        else:
+            _set_status(ids, "failed")
+    if batches:
+        log.info("Requeued %d pending webhook messages", len(batches))
 
 
-def notify(anomalies: list[dict]):
+def notify(anomalies: list[dict], scan_id: int | None = None):
     if not anomalies:
         return
 
     cfg = get_config()["alert"]
 
     # Filter duplicates
-    filtered = [a for a in anomalies if not _is_dedup(a["code"])]
+    filtered = _dedup.filter(anomalies, cfg["dedup_minutes"])
     if not filtered:
         log.info("All anomalies deduped, skipping")
         return
 
-    # Always store alerts
+    # Always store alerts; the ones listed in the webhook message start out pending
+    url = cfg.get("webhook_url", "")
+    sent = len(filtered[:_MAX_ITEMS]) if url else 0
     with get_conn() as conn:
         conn.executemany(
-            "INSERT INTO alerts(code,name,total_heat,zscore,change_pct,volume_ratio,message) "
-            "VALUES(:code,:name,:total_heat,:zscore,:change_pct,:volume_ratio,:message)",
-            [{**a, "message": ""} for a in filtered],
+            "INSERT INTO alerts(code,name,total_heat,zscore,change_pct,volume_ratio,message,scan_id,delivery_status) "
+            "VALUES(:code,:name,:total_heat,:zscore,:change_pct,:volume_ratio,:message,:scan_id,:delivery_status)",
+            [
+                {**a, "message": "", "scan_id": scan_id, "delivery_status": "pending" if i < sent else None}
+                for i, a in enumerate(filtered)
+            ],
         )
+        # One writer per transaction, so the batch got consecutive ids
+        last = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
     log.info("Stored %d alerts", len(filtered))
 
-    # Send webhook if configured
-    url = cfg.get("webhook_url", "")
-    if not url:
-        return
-    msg = _format_message(filtered)
-    try:
-        if cfg["webhook_type"] == "feishu":
-            _send_feishu(url, msg)
-        else:
-            _send_dingtalk(url, msg)
-        log.info("Sent webhook for %d stocks", len(filtered))
-    except Exception as e:
-        log.error("Failed to send webhook: %s", e)
+    if sent:
+        first = last - len(filtered) + 1
+        _enqueue(list(range(first, first + sent)), url, cfg["webhook_type"], _format_message(filtered))
@@ -0,0 +1,201 @@
+"""
+Monthly partitions of the high-volume snapshot tables.
+
+Each table in TABLES is stored as one table per month (heat_scores_202610,
+...) and read through a UNION ALL view under the original name, so
+time-range SELECTs are unchanged and SQLite pushes their WHERE clause into
+every partition's indexes. Writes, and reads keyed by scan, name their
+partition directly (table() / for_scan() / table_for_id()).
+
+Row ids are allocated from a per-month range (month index << 32): they keep
+increasing across months and an id alone identifies its partition.
+Retention drops whole partitions instead of deleting rows.
+"""
+import logging, threading, time
+
+log = logging.getLogger(__name__)
+
+# Columns in the order of the original unpartitioned tables, so views keep their shape
+TABLES = {
+    "trade_snapshots": """
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        code TEXT NOT NULL,
+        name TEXT,
+        price REAL,
+        change_pct REAL,
+        volume REAL,
+        amount REAL,
+        turnover_rate REAL,
+        volume_ratio REAL,
+        ts DATETIME DEFAULT (datetime('now','localtime')),
+        scan_id INTEGER""",
+    "sentiment_snapshots": """
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        code TEXT NOT NULL,
+        source TEXT NOT NULL,
+        post_count INTEGER DEFAULT 0,
+        comment_count INTEGER DEFAULT 0,
+        ts DATETIME DEFAULT (datetime('now','localtime'))""",
+    "heat_scores": """
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        code TEXT NOT NULL,
+        name TEXT,
+        trade_heat REAL,
+        sentiment_heat REAL,
+        total_heat REAL,
+        zscore REAL,
+        ts DATETIME DEFAULT (datetime('now','localtime')),
+        scan_id INTEGER""",
+}
+INDEXES = {
+    "trade_snapshots": {"code_ts": "code, ts", "scan": "scan_id, code"},
+    "sentiment_snapshots": {"code_ts": "code, ts", "ts": "ts"},
+    "heat_scores": {"code_ts": "code, ts", "scan": "scan_id, code"},
+}
+
+ID_BITS = 32
+# SQL for the id base of the partition holding a 'YYYY-MM...' column, e.g. to remap rollup last_ids
+ID_BASE_SQL = "((CAST(substr({col},1,4) AS INTEGER)*12 + CAST(substr({col},6,2) AS INTEGER) - 1) << %d)" % ID_BITS
+
+_lock = threading.Lock()
+_known: set[str] = set()    # partitions known to exist, so writes skip the catalog lookup
+
+
+def month_of(ts: str | None = None) -> str:
+    """Partition key 'YYYYMM' of a 'YYYY-MM-DD ...' timestamp (default: now)."""
+    ts = ts or time.strftime("%Y-%m-%d")
+    return ts[:4] + ts[5:7]
+
+
+def id_base(month: str) -> int:
+    return (int(month[:4]) * 12 + int(month[4:]) - 1) << ID_BITS
+
+
+def month_of_id(row_id: int) -> str:
+    y, m = divmod(row_id >> ID_BITS, 12)
+    return f"{y:04d}{m + 1:02d}"
+
+
+def months(conn, table: str) -> list[str]:
+    """Existing partitions of `table`, oldest first."""
+    rows = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name GLOB ?", (f"{table}_[0-9][0-9][0-9][0-9][0-9][0-9]",)
+    ).fetchall()
+    return sorted(r[0][-6:] for r in rows)
+
+
+def _refresh_view(conn, table: str):
+    parts = months(conn, table)
+    conn.execute(f"DROP VIEW IF EXISTS {table}")
+    if parts:
+        conn.execute(f"CREATE VIEW {table} AS " + " UNION ALL ".join(f"SELECT * FROM {table}_{m}" for m in parts))
+
+
+def _create_indexes(conn, table: str, name: str):
+    for suffix, cols in INDEXES[table].items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_{suffix} ON {name}({cols})")
+
+
+def ensure(conn, table: str, month: str) -> str:
+    """Create the partition of `table` for `month` if needed; returns its name."""
+    name = f"{table}_{month}"
+    if name in _known:
+        return name
+    with _lock:
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone()
+        if not exists:
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {name} ({TABLES[table]})")
+            _create_indexes(conn, table, name)
+            # Start AUTOINCREMENT at the month's id range
+            conn.execute(
+                "INSERT INTO sqlite_sequence(name, seq) SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name=?)",
+                (name, id_base(month), name),
+            )
+            _refresh_view(conn, table)
+            log.info("Created partition %s", name)
+        _known.add(name)
+    return name
+
+
+def table(conn, table: str, ts: str | None = None) -> str:
+    """Partition to write rows stamped `ts` (default: now) into."""
+    return ensure(conn, table, month_of(ts))
+
+
+def for_scan(conn, table: str, scan_id: int) -> str:
+    """Partition holding a scan's rows (the month the scan started in)."""
+    row = conn.execute("SELECT started_at FROM scans WHERE id=?", (scan_id,)).fetchone()
+    return ensure(conn, table, month_of(row[0] if row else None))
+
+
+def table_for_id(table: str, row_id: int) -> str:
+    return f"{table}_{month_of_id(row_id)}"
+
+
+def group_by_id(table: str, rows, id_of) -> dict[str, list]:
+    """Split rows by the partition of the id `id_of(row)` returns."""
+    out: dict[str, list] = {}
+    for r in rows:
+        out.setdefault(table_for_id(table, id_of(r)), []).append(r)
+    return out
+
+
+def drop(conn, table: str, month: str):
+    """Drop one partition and its rows."""
+    name = f"{table}_{month}"
+    with _lock:
+        conn.execute(f"DROP TABLE IF EXISTS {name}")
+        conn.execute("DELETE FROM sqlite_sequence WHERE name=?", (name,))
+        _known.discard(name)
+        _refresh_view(conn, table)
+    log.info("Dropped partition %s", name)
+
+
+def drop_before(conn, cutoff: str) -> list[str]:
+    """Drop every partition whose whole month lies before `cutoff` ('YYYY-MM-DD ...')."""
+    keep_from = month_of(cutoff)
+    dropped = []
+    for tbl in TABLES:
+        for m in months(conn, tbl):
+            if m < keep_from:
+                drop(conn, tbl, m)
+                dropped.append(f"{tbl}_{m}")
+    return dropped
+
+
+def _migrate_legacy(conn, tbl: str):
+    """Move an unpartitioned table's rows into monthly partitions, remapping ids into each month's range."""
+    legacy = f"{tbl}_legacy"
+    conn.execute(f"ALTER TABLE {tbl} RENAME TO {legacy}")
+    have = {r[1] for r in conn.execute(f"PRAGMA table_info({legacy})")}
+    cols = [r[1] for r in conn.execute(f"PRAGMA table_info({ensure(conn, tbl, month_of())})") if r[1] in have]
+    src = ", ".join(c if c != "id" else "id + ?" for c in cols)
+    found = [r[0] for r in conn.execute(f"SELECT DISTINCT substr(ts,1,7) FROM {legacy} WHERE ts IS NOT NULL")]
+    log.info("Partitioning %s into %d months...", tbl, len(found))
+    for ym in sorted(found):
+        month = ym.replace("-", "")
+        name = ensure(conn, tbl, month)
+        conn.execute(
+            f"INSERT INTO {name}({', '.join(cols)}) SELECT {src} FROM {legacy} WHERE substr(ts,1,7)=?",
+            (id_base(month), ym),
+        )
+    conn.execute(f"DROP TABLE {legacy}")
+
+
+def init(conn) -> list[str]:
+    """Migrate pre-partitioning tables and make sure this month's partitions exist.
+
+    Returns the tables whose legacy rows were migrated (their ids changed).
+    """
+    _known.clear()
+    migrated = []
+    for tbl in TABLES:
+        row = conn.execute("SELECT type FROM sqlite_master WHERE name=?", (tbl,)).fetchone()
+        if row and row[0] == "table":
+            _migrate_legacy(conn, tbl)
+            migrated.append(tbl)
+        ensure(conn, tbl, month_of())
+        # Indexes added to INDEXES since older partitions were created
+        for m in months(conn, tbl):
+            _create_indexes(conn, tbl, f"{tbl}_{m}")
+    return migrated
@@ -0,0 +1,40 @@
+"""
+Scan registry: one row per scan cycle with an integer id stamped on every
+trade, heat and alert row it produces, and a completion time per phase.
+"""
+
+PHASES = ("trade", "heat", "sentiment", "anomaly")
+
+
+def begin(conn, ts: str | None = None) -> int:
+    """Open a new scan (started now, or at `ts` for historical backfills)."""
+    if ts:
+        cur = conn.execute("INSERT INTO scans(started_at) VALUES(?)", (ts,))
+    else:
+        cur = conn.execute("INSERT INTO scans DEFAULT VALUES")
+    return cur.lastrowid
+
+
+def mark(conn, scan_id: int, phase: str, ts: str | None = None):
+    """Record that `phase` finished for the scan."""
+    if phase not in PHASES:
+        raise ValueError(f"unknown scan phase: {phase}")
+    if ts:
+        conn.execute(f"UPDATE scans SET {phase}_at=? WHERE id=?", (ts, scan_id))
+    else:
+        conn.execute(f"UPDATE scans SET {phase}_at=datetime('now','localtime') WHERE id=?", (scan_id,))
+
+
+def latest(conn, phase: str) -> int | None:
+    """Id of the most recent scan that completed `phase`."""
+    if phase not in PHASES:
+        raise ValueError(f"unknown scan phase: {phase}")
+    row = conn.execute(
+        f"SELECT id FROM scans WHERE {phase}_at IS NOT NULL ORDER BY started_at DESC, id DESC LIMIT 1"
+    ).fetchone()
+    return row["id"] if row else None
+
+
+def get(conn, scan_id: int) -> dict | None:
+    row = conn.execute("SELECT * FROM scans WHERE id=?", (scan_id,)).fetchone()
+    return dict(row) if row else None
@@ -0,0 +1,61 @@
+"""
+Latest sentiment record per (code, source), held in memory. Collectors
+update it as they write sentiment_snapshots; the heat calculator reads the
+records still inside the freshness window. It hydrates itself from the
+last window of sentiment_snapshots after a restart.
+"""
+import logging, threading, time
+from config import get as get_config
+from db import get_conn
+
+log = logging.getLogger(__name__)
+
+DEFAULT_FRESH_MINUTES = 10
+
+_latest: dict[tuple[str, str], tuple[dict, float]] = {}   # (code, source) -> (record, unix time)
+_lock = threading.Lock()
+_hydrated = False
+
+
+def _window() -> float:
+    return get_config()["scanner"].get("sentiment_fresh_minutes", DEFAULT_FRESH_MINUTES) * 60
+
+
+def update(records: list[dict], stamp: float | None = None):
+    """Record freshly collected snapshots (code, source, post_count, comment_count)."""
+    stamp = stamp or time.time()
+    with _lock:
+        for r in records:
+            _latest[(r["code"], r["source"])] = (r, stamp)
+
+
+def hydrate():
+    """Reload the freshness window from sentiment_snapshots (startup)."""
+    global _hydrated
+    minutes = _window() / 60
+    with get_conn() as conn:
+        rows = conn.execute(
+            "SELECT code, source, post_count, comment_count, ts FROM sentiment_snapshots "
+            "WHERE ts >= datetime('now','localtime',? || ' minutes') ORDER BY id",
+            (f"-{minutes:g}",),
+        ).fetchall()
+    with _lock:
+        _latest.clear()
+        for r in rows:
+            stamp = time.mktime(time.strptime(r["ts"][:19], "%Y-%m-%d %H:%M:%S"))
+            rec = {k: r[k] for k in ("code", "source", "post_count", "comment_count")}
+            _latest[(rec["code"], rec["source"])] = (rec, stamp)
+        _hydrated = True
+    log.info("Sentiment store hydrated with %d records", len(rows))
+
+
+def latest(codes: list[str] | None = None) -> list[dict]:
+    """Fresh records, optionally only for `codes`; expired ones are evicted."""
+    if not _hydrated:
+        hydrate()
+    horizon = time.time() - _window()
+    wanted = set(codes) if codes is not None else None
+    with _lock:
+        for key in [k for k, (_, t) in _latest.items() if t < horizon]:
+            del _latest[key]
+        return [r for (code, _), (r, _) in _latest.items() if wanted is None or code in wanted]
@@ -0,0 +1,114 @@
+"""
+In-memory type-ahead index over stock_basic for /api/stocks. Rebuilt
+from the rows basic_collector.sync writes and from stock_basic at startup;
+readers grab the current immutable index once, like ranking_cache.
+
+A keyword matches code prefixes, name substrings and (with pypinyin
+installed) pinyin initials, e.g. "payh" for 平安银行. Results rank exact
+matches first, then prefixes, then other substrings.
+"""
+import bisect, logging
+from db import get_conn
+
+try:
+    from pypinyin import Style, lazy_pinyin
+except ImportError:   # optional: without it there is no pinyin initials search
+    lazy_pinyin = None
+
+log = logging.getLogger(__name__)
+
+_SEP = "\n"           # joins the searchable strings; never part of a keyword
+
+
+def initials(name: str) -> str:
+    """Lower-case pinyin initials of a name, ASCII parts kept ('*ST康美' -> 'stkm'); '' without pypinyin."""
+    if lazy_pinyin is None:
+        return ""
+    return "".join(c for part in lazy_pinyin(name, style=Style.FIRST_LETTER) for c in part if c.isalnum()).lower()
+
+
+class _Column:
+    """One searchable string per stock: sorted for prefix lookups, joined for substring finds."""
+    __slots__ = ("keys", "order", "text", "starts")
+
+    def __init__(self, values: list[str]):
+        self.order = sorted(range(len(values)), key=lambda i: values[i])
+        self.keys = [values[i] for i in self.order]
+        self.text = _SEP.join(values)
+        self.starts, pos = [], 0
+        for v in values:
+            self.starts.append(pos)
+            pos += len(v) + 1
+
+    def prefixed(self, kw: str, limit: int) -> tuple[list[int], list[int]]:
+        """Stocks whose value equals kw, and the others starting with it (in value order)."""
+        lo = bisect.bisect_left(self.keys, kw)
+        eq = bisect.bisect_right(self.keys, kw, lo)
+        hi = bisect.bisect_left(self.keys, kw + "\uffff", eq)
+        return self.order[lo:eq][:limit], self.order[eq:min(hi, eq + limit)]
+
+    def containing(self, kw: str, limit: int) -> list[int]:
+        """Stocks whose value contains kw past its first character, in stock order."""
+        out, pos = [], self.text.find(kw)
+        while pos >= 0 and len(out) < limit:
+            i = bisect.bisect_right(self.starts, pos) - 1
+            if pos > self.starts[i]:
+                out.append(i)
+                pos = self.text.find(kw, self.starts[i + 1] if i + 1 < len(self.starts) else len(self.text))
+            else:
+                pos = self.text.find(kw, pos + 1)
+        return out
+
+
+class StockIndex:
+    __slots__ = ("items", "codes", "names", "initials")
+
+    def __init__(self, rows: list[dict]):
+        rows = sorted(rows, key=lambda r: r["code"])
+        self.items = tuple({"code": r["code"], "name": r["name"], "market": r["market"]} for r in rows)
+        self.codes = _Column([r["code"] for r in rows])
+        self.names = _Column([(r["name"] or "").lower() for r in rows])
+        self.initials = _Column([initials(r["name"] or "") for r in rows]) if lazy_pinyin else None
+
+    def search(self, keyword: str, limit: int = 50) -> list[dict]:
+        kw = keyword.strip().lower()
+        if not kw:
+            return list(self.items[:limit])
+        if _SEP in kw:
+            return []
+        cols = [c for c in (self.codes, self.names, self.initials) if c is not None]
+        exact, prefix, substring = [], [], []
+        for col in cols:
+            eq, starts = col.prefixed(kw, limit)
+            exact += eq
+            prefix += starts
+        for col in cols[1:]:       # codes only match by prefix
+            substring += col.containing(kw, limit)
+        out, seen = [], set()
+        for i in exact + prefix + substring:
+            if i not in seen:
+                seen.add(i)
+                out.append(self.items[i])
+                if len(out) == limit:
+                    break
+        return out
+
+
+_current: StockIndex | None = None
+
+
+def rebuild(rows: list[dict] | None = None) -> StockIndex:
+    """Build the index from `rows` (code, name, market), or from stock_basic, and swap it in."""
+    global _current
+    if rows is None:
+        with get_conn() as conn:
+            rows = [dict(r) for r in conn.execute("SELECT code, name, market FROM stock_basic")]
+    index = StockIndex(rows)
+    _current = index
+    log.info("Stock search index built for %d stocks%s", len(index.items),
+             "" if lazy_pinyin else " (pypinyin not installed, no pinyin initials)")
+    return index
+
+
+def current() -> StockIndex:
+    return _current if _current is not None else rebuild()
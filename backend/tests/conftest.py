@@ -0,0 +1,65 @@
+import datetime, os, sys
+
+import pandas as pd
+import pytest
+
+# Backend modules import each other as top-level names (run from backend/)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import db
+import partitions
+from engine import rollup, rolling_stats
+
+TODAY = datetime.date.today()
+
+
+@pytest.fixture
+def temp_db(tmp_path):
+    """A fresh, initialized database for this test on this thread's connection."""
+    cfg = config.load()
+    cfg["data"]["db_path"] = str(tmp_path / "test.db")
+    cfg["data"]["archive_dir"] = str(tmp_path / "archive")
+    rolling_stats._engine = None
+    db.init_db()
+    yield cfg
+    rolling_stats._engine = None
+    db.read_pool.close()
+    if getattr(db._local, "conn", None) is not None:
+        db._local.conn.close()
+        db._local.conn = None
+
+
+@pytest.fixture
+def seed_heat(temp_db):
+    """
+    seed_heat({code: [day, ...]}) writes each code's daily heat rows (oldest
+    day first, the last one is today) and rolls them up. A day is a
+    trade_heat value, None for a NULL gap, or a list of intraday snapshots
+    ending at 15:00. Returns each code's latest row as a scan's heat_df.
+    """
+    def seed(histories: dict[str, list]) -> pd.DataFrame:
+        with db.get_conn() as conn:
+            for code, days in histories.items():
+                for back, day in enumerate(reversed(days)):
+                    date = TODAY - datetime.timedelta(days=back)
+                    snaps = day if isinstance(day, list) else [day]
+                    for k, value in enumerate(snaps):
+                        ts = f"{date} {15 - len(snaps) + 1 + k:02d}:00:00"
+                        part = partitions.table(conn, "heat_scores", ts)
+                        last_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {part}").fetchone()[0]
+                        conn.execute(
+                            f"INSERT INTO {part}(code,name,trade_heat,sentiment_heat,total_heat,zscore,ts) "
+                            "VALUES(?,?,?,?,?,0,?)",
+                            (code, f"n{code}", value, 0.0, None if value is None else value * 0.6, ts),
+                        )
+                        rollup.update_since(conn, last_id, part)
+            df = db.query_frame(
+                conn, "SELECT id, code, name, trade_heat, total_heat, ts FROM heat_scores WHERE id IN "
+                "(SELECT MAX(id) FROM heat_scores WHERE ts >= ? GROUP BY code) ORDER BY code",
+                (str(TODAY),),
+            )
+        df["change_pct"] = 1.5
+        df["volume_ratio"] = 2.0
+        return df
+    return seed
@@ -0,0 +1,97 @@
+import json, os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import db
+import partitions
+from engine import anomaly_detector
+
+# Expected output of the original per-stock detect() on raw heat_scores
+with open(os.path.join(os.path.dirname(__file__), "fixtures", "baseline_detection.json"), encoding="utf-8") as f:
+    BASELINE = json.load(f)
+
+
+def _histories(window: int) -> dict[str, list]:
+    rng = np.random.default_rng(7)
+    histories = {
+        "000001": [0.02, 0.03, 0.4],                                      # too short
+        "000002": [0.02] * window + [0.3],                                # flat window, spike
+        "000003": [0.02] * window + [0.02],                               # flat window, no change
+        "000004": [0.031, None, 0.042, None, 0.036, 0.029, None, 0.044, 0.033, 0.2],  # NULL gaps
+        "000005": [None] * 8 + [0.05],                                    # gaps leave too few points
+        "000006": list(0.08 + rng.normal(0, 0.005, window)) + [0.2],     # warm: only 2.5x
+        "000007": list(0.08 + rng.normal(0, 0.005, window)) + [0.5],     # warm: 6x
+        "000008": list(0.03 + rng.normal(0, 0.002, window)) + [0.1],     # stable box breakout
+        "000009": list(rng.uniform(0.01, 0.2, window + 5)) + [0.25],      # longer than the window
+        "000010": [0.3],                                                  # today only
+    }
+    for i in range(40):
+        histories[f"3000{i:02d}"] = list(rng.lognormal(-3, 0.5, int(rng.integers(1, window + 4))))
+    return histories
+
+
+def _zscores(df: pd.DataFrame) -> dict[str, float]:
+    """z-scores written to today's heat rows, reset to 0 for the next run."""
+    with db.get_conn() as conn:
+        out = {}
+        for code, row_id in zip(df["code"], df["id"]):
+            part = partitions.table_for_id("heat_scores", int(row_id))
+            out[code] = conn.execute(f"SELECT zscore FROM {part} WHERE id=?", (int(row_id),)).fetchone()[0]
+        conn.execute(f"UPDATE {partitions.table_for_id('heat_scores', int(df['id'].iloc[0]))} SET zscore=0")
+    return out
+
+
+def _assert_same(got: list[dict], expected: list[dict]):
+    assert [a["code"] for a in got] == [a["code"] for a in expected]
+    for g, e in zip(got, expected):
+        assert g.keys() == e.keys()
+        for key, value in e.items():
+            if isinstance(value, float):
+                assert g[key] == pytest.approx(value, rel=1e-9, abs=1e-9), (e["code"], key)
+            else:
+                assert g[key] == value, (e["code"], key)
+
+
+def test_batch_matches_rowwise(temp_db, seed_heat):
+    heat_df = seed_heat(_histories(temp_db["detection"]["window_size"]))
+
+    rowwise = anomaly_detector.detect_rowwise(heat_df)
+    rowwise_z = _zscores(heat_df)
+    batch = anomaly_detector.detect_batch(heat_df)
+    batch_z = _zscores(heat_df)
+
+    assert {"000002", "000007", "000008"} <= {a["code"] for a in rowwise}
+    assert "000006" not in {a["code"] for a in rowwise}
+    _assert_same(batch, rowwise)
+    assert batch_z == pytest.approx(rowwise_z, rel=1e-9, abs=1e-9)
+    assert rowwise_z["000001"] == 0 and rowwise_z["000005"] == 0
+
+
+def test_online_matches_batch(temp_db, seed_heat):
+    heat_df = seed_heat(_histories(temp_db["detection"]["window_size"]))
+
+    batch = anomaly_detector.detect_batch(heat_df)
+    batch_z = _zscores(heat_df)
+    online = anomaly_detector.detect_online(heat_df)     # warm-starts the engine from the rollup
+    online_z = _zscores(heat_df)
+
+    assert batch
+    _assert_same(online, batch)
+    assert online_z == pytest.approx(batch_z, rel=1e-9, abs=1e-9)
+
+
+@pytest.mark.parametrize("detect", [
+    anomaly_detector.detect_batch, anomaly_detector.detect_rowwise, anomaly_detector.detect_online,
+])
+def test_matches_baseline_algorithm(temp_db, seed_heat, detect):
+    temp_db["detection"].update(BASELINE["config"])
+    heat_df = seed_heat(BASELINE["histories"])
+
+    anomalies = detect(heat_df)
+
+    expected = BASELINE["anomalies"]
+    assert [{k: a[k] for k in e} for a, e in zip(anomalies, expected)] == expected
+    assert len(anomalies) == len(expected)
+    assert _zscores(heat_df) == pytest.approx(BASELINE["zscores"], rel=1e-9, abs=1e-9)
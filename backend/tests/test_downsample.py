@@ -0,0 +1,65 @@
+import datetime
+
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import db
+import partitions
+from api import routes
+from api.downsample import lttb
+
+
+@pytest.mark.parametrize("size, n, expected", [
+    (0, 1, []), (1, 1, [0]), (2, 1, [1]), (2, 2, [0, 1]), (2, 3, [0, 1]),
+    (3, 3, [0, 1, 2]), (5, 1, [4]), (5, 2, [0, 4]), (5, 0, []),
+])
+def test_tiny_series(size, n, expected):
+    x = np.arange(size, dtype=float)
+    assert lttb(x, np.sin(x), n).tolist() == expected
+
+
+@pytest.mark.parametrize("n", [3, 4, 10, 99])
+def test_flat_series(n):
+    x = np.arange(100, dtype=float)
+    out = lttb(x, np.full(100, 0.5), n)
+    assert len(out) == n and out[0] == 0 and out[-1] == 99
+    assert (np.diff(out) > 0).all()
+
+
+def test_keeps_peak_and_survives_nan():
+    x = np.arange(1000, dtype=float)
+    y = np.full(1000, 0.1)
+    y[437] = 5.0
+    y[10:20] = np.nan
+    out = lttb(x, y, 20)
+    assert len(out) == 20 and 437 in out
+
+
+@pytest.fixture
+def client(temp_db):
+    now = datetime.datetime.now()
+    with db.get_conn() as conn:
+        for minutes in (30, 10):
+            ts = (now - datetime.timedelta(minutes=minutes)).strftime("%Y-%m-%d %H:%M:%S")
+            conn.execute(
+                f"INSERT INTO {partitions.table(conn, 'heat_scores', ts)}(code,trade_heat,total_heat,zscore,ts) "
+                "VALUES('000001',0.1,0.1,0,?)", (ts,),
+            )
+    app = FastAPI()
+    app.include_router(routes.router)
+    app.dependency_overrides[routes._check_auth] = lambda: None
+    return TestClient(app)
+
+
+def test_trend_points(client):
+    assert len(client.get("/api/heat/trend/000001", params={"hours": 1}).json()) == 2
+    assert len(client.get("/api/heat/trend/000001", params={"hours": 1, "points": 1}).json()) == 1
+    items = client.get("/api/heat/trends", params={"codes": "000001", "hours": 1, "points": 1}).json()["items"]
+    assert len(items["000001"]) == 1
+
+
+def test_trend_points_validated(client):
+    assert client.get("/api/heat/trend/000001", params={"points": -1}).status_code == 422
+    assert client.get("/api/heat/trends", params={"codes": "000001", "points": "x"}).status_code == 422
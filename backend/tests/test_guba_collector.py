@@ -0,0 +1,51 @@
+import random, time
+
+import pytest
+
+import metrics
+from bench.payloads import guba_page
+from collector import guba_collector, ratelimit
+
+
+class _Response:
+    def __init__(self, status_code: int, text: str = ""):
+        self.status_code, self.text = status_code, text
+
+
+class _Session:
+    def __init__(self, status_code: int):
+        self.status_code, self.calls = status_code, 0
+
+    def get(self, url, timeout=None):
+        self.calls += 1
+        return _Response(self.status_code, guba_page("000001", random.Random(1)))
+
+
+@pytest.fixture
+def session(monkeypatch, temp_db):
+    monkeypatch.setattr(ratelimit, "_buckets", {})
+    def install(status_code):
+        s = _Session(status_code)
+        monkeypatch.setattr(guba_collector, "_SESSION", s)
+        return s
+    return install
+
+
+def _skipped() -> float:
+    return metrics.SENTIMENT_SKIPPED._values.get(metrics.SENTIMENT_SKIPPED._key({"source": "guba"}), 0)
+
+
+@pytest.mark.parametrize("status_code", [200, 503])
+def test_budget_skips_remaining_codes(session, status_code):
+    # 2.5 requests/s (config), slower still once 503s penalize the bucket
+    s = session(status_code)
+    codes = [f"{i:06d}" for i in range(1, 41)]
+    before = _skipped()
+
+    t0 = time.monotonic()
+    results = guba_collector.collect(codes, budget=1.0)
+
+    assert time.monotonic() - t0 < 2.0
+    assert 0 < s.calls < len(codes)
+    assert len(results) < len(codes)
+    assert _skipped() - before == len(codes) - len(results)
@@ -0,0 +1,53 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import db
+import metrics
+from api import routes
+
+
+@pytest.fixture
+def client(temp_db, monkeypatch):
+    monkeypatch.setitem(temp_db["auth"], "metrics_token", "scrape-secret")
+    monkeypatch.setattr(routes, "_tokens", {"session-token"})
+    app = FastAPI()
+    app.include_router(routes.router)
+    return TestClient(app)
+
+
+@pytest.mark.parametrize("headers, status", [
+    ({}, 401),
+    ({"Authorization": "Bearer wrong"}, 401),
+    ({"Authorization": "Bearer scrape-secret"}, 200),
+    ({"Authorization": "Bearer session-token"}, 200),
+])
+def test_metrics_route_requires_auth(client, headers, status):
+    resp = client.get("/api/metrics", headers=headers)
+    assert resp.status_code == status
+    if status == 200:
+        assert "heatpulse_db_query_duration_seconds" in resp.text
+
+
+def test_metrics_token_unset_needs_login(client, temp_db):
+    temp_db["auth"]["metrics_token"] = ""
+    assert client.get("/api/metrics", headers={"Authorization": "Bearer "}).status_code == 401
+
+
+def _count_sites(conn):
+    return conn.execute("SELECT COUNT(*) FROM scans").fetchone()
+
+
+def test_call_site_cached_per_sql(temp_db, monkeypatch):
+    walks = []
+    call_site = metrics.call_site
+    monkeypatch.setattr(metrics, "call_site", lambda depth=2: walks.append(depth) or call_site(depth + 1))
+    db._sites.clear()
+
+    with db.get_conn() as conn:
+        for _ in range(3):
+            _count_sites(conn)
+            db.query_frame(conn, "SELECT COUNT(*) AS c FROM scans")
+
+    assert len(walks) == 2
+    assert set(db._sites.values()) == {f"{__name__}._count_sites", f"{__name__}.test_call_site_cached_per_sql"}
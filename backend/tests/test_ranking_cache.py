@@ -0,0 +1,31 @@
+import db
+import main
+import partitions
+import scans
+from api import ranking_cache
+
+
+def _trade_scan(prices: dict[str, float]) -> int:
+    with db.get_conn() as conn:
+        scan_id = scans.begin(conn)
+        conn.executemany(
+            f"INSERT INTO {partitions.for_scan(conn, 'trade_snapshots', scan_id)}"
+            "(code,name,price,change_pct,volume,amount,turnover_rate,volume_ratio,scan_id) VALUES(?,?,?,1,1000,?,1,?,?)",
+            [(code, f"n{code}", p, p * 100, p / 10, scan_id) for code, p in prices.items()],
+        )
+        scans.mark(conn, scan_id, "trade")
+    return scan_id
+
+
+def test_calc_heat_publishes_ranking(temp_db, monkeypatch):
+    monkeypatch.setattr(ranking_cache, "_current", None)
+    first = _trade_scan({"000001": 10, "000002": 20})
+    main.job_calc_heat()
+    assert ranking_cache.current().scan_id == first
+
+    # A later scan that never reaches detection still replaces the ranking
+    second = _trade_scan({"000001": 30, "000002": 5, "000003": 8})
+    main.job_calc_heat()
+    snap = ranking_cache.current()
+    assert snap.scan_id == second
+    assert [it["code"] for it in snap.page("total_heat", 1, 10)] == ["000001", "000003", "000002"]
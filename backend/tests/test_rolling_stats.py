@@ -0,0 +1,52 @@
+import datetime
+
+import numpy as np
+import pytest
+
+import db
+from engine import anomaly_detector, rolling_stats
+
+TODAY = str(datetime.date.today())
+TOMORROW = str(datetime.date.today() + datetime.timedelta(days=1))
+
+
+def test_warm_start_with_today_only_codes(temp_db, seed_heat):
+    seed_heat({"000001": [0.1], "000002": [0.2]})
+
+    engine = rolling_stats.warm_start(TODAY)
+    base = engine.baseline(["000001", "000002"])
+    assert base["n"].tolist() == [0, 0]
+    assert np.isnan(base["mean"]).all()
+
+    # Today's values become the first closed day once tomorrow starts
+    assert engine.observe(TOMORROW, ["000001", "000002"], [0.3, 0.4])
+    base = engine.baseline(["000001", "000002"])
+    assert base["n"].tolist() == [1, 1]
+    assert base["mean"] == pytest.approx([0.1, 0.2])
+
+
+def test_warm_start_mixed_old_and_new_codes(temp_db, seed_heat):
+    window = temp_db["detection"]["window_size"]
+    rng = np.random.default_rng(3)
+    histories = {
+        "000001": list(rng.uniform(0.01, 0.2, window + 3)),   # longer than the window
+        "000002": [0.05, None, 0.07, 0.06],                   # gap
+        "000003": [0.4],                                      # listed today
+        "000004": [0.02, 0.03],
+    }
+    seed_heat(histories)
+    codes = list(histories)
+
+    engine = rolling_stats.warm_start(TODAY)
+    base = engine.baseline(codes)
+    with db.get_conn() as conn:
+        matrix, _ = anomaly_detector._load_history_matrix(conn, codes, window)
+
+    assert base["n"].tolist() == np.count_nonzero(~np.isnan(matrix), axis=1).tolist()
+    has = base["n"] > 0
+    assert has.tolist() == [True, True, False, True]
+    assert base["mean"][has] == pytest.approx(np.nanmean(matrix[has], axis=1))
+    assert base["std"][has] == pytest.approx(np.nanstd(matrix[has], axis=1), abs=1e-12)
+    assert base["box_upper"][has] == pytest.approx(np.nanpercentile(matrix[has], 75, axis=1))
+    assert base["box_lower"][has] == pytest.approx(np.nanpercentile(matrix[has], 25, axis=1))
+    assert anomaly_detector.check_consistency(engine, codes)
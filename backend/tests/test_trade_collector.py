@@ -0,0 +1,89 @@
+import random
+
+import pytest
+import requests
+
+from bench.payloads import quote_payload
+from collector import trade_collector
+
+
+class _Response:
+    def __init__(self, status_code: int, content: bytes = b""):
+        self.status_code, self.content, self.encoding = status_code, content, "GBK"
+
+
+class _Session:
+    """Answers quote requests by `rule(symbols)`: a status code, an exception, or None for a full body."""
+
+    def __init__(self, rule):
+        self.rule, self.calls = rule, []
+
+    def get(self, url, timeout=None):
+        symbols = url[len(trade_collector.QT_URL):].split(",")
+        self.calls.append(len(symbols))
+        outcome = self.rule(symbols)
+        if isinstance(outcome, Exception):
+            raise outcome
+        if isinstance(outcome, int):
+            return _Response(outcome)
+        if isinstance(outcome, list):       # answer only these symbols
+            symbols = outcome
+        return _Response(200, quote_payload(symbols, {}, random.Random(1)))
+
+
+SYMBOLS = [f"sz{i:06d}" for i in range(1, 81)]
+
+
+@pytest.fixture
+def session(monkeypatch):
+    def install(rule):
+        s = _Session(rule)
+        monkeypatch.setattr(trade_collector, "_SESSION", s)
+        return s
+    return install
+
+
+def test_size_rejection_splits(session):
+    s = session(lambda symbols: 414 if len(symbols) > 20 else None)
+    rows, limit = trade_collector._fetch_adaptive(SYMBOLS)
+    assert limit == 20
+    assert set(rows["code"]) <= {sym[2:] for sym in SYMBOLS} and len(rows) > 70    # suspended ones are skipped
+    assert s.calls == [80, 40, 20, 20, 40, 20, 20]
+
+
+def test_short_body_splits(session):
+    session(lambda symbols: symbols[:30] if len(symbols) > 30 else None)
+    _, limit = trade_collector._fetch_adaptive(SYMBOLS)
+    assert limit == 20
+
+
+@pytest.mark.parametrize("failure", [requests.Timeout("read timed out"), requests.ConnectionError("reset"), 503, 429])
+def test_transport_failure_retries_once_without_splitting(session, failure):
+    s = session(lambda symbols: failure)
+    rows, limit = trade_collector._fetch_adaptive(SYMBOLS)
+    assert len(rows) == 0 and limit is None
+    assert s.calls == [80, 80]
+
+
+def test_transient_failure_recovers_on_retry(session):
+    outcomes = [requests.Timeout("read timed out"), None]
+    s = session(lambda symbols: outcomes.pop(0))
+    rows, limit = trade_collector._fetch_adaptive(SYMBOLS)
+    assert limit == 80 and len(rows) > 0
+    assert s.calls == [80, 80]
+
+
+def test_parse_payload_name_with_tilde_trail_byte():
+    # 硚 is b"\xb3~" in GBK: the name must not shift the fields after it
+    names = {"000001": "平安银行", "600002": "硚口科技", "600003": "汉硚", "300004": "硚"}
+    symbols = [trade_collector._build_symbol(c) for c in names]
+    payload = quote_payload(symbols, names, random.Random(5))
+    quotes = trade_collector._parse_payload(payload)
+
+    expected = [trade_collector._parse_line(line) for line in payload.decode("gbk").split(";")]
+    expected = [d for d in expected if d and d["price"] > 0]
+    assert [(q["code"], q["name"]) for q in quotes] == [(d["code"], d["name"]) for d in expected]
+    assert len(quotes) == 4
+    for q, d in zip(quotes, expected):
+        for field, _ in trade_collector._FIELDS:
+            assert q[field] == d[field], (d["code"], field)